@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""end-to-end allocation lifecycle benchmark against the simulated Proxmox API.
+
+for every cluster size the simulator is seeded with that many running VMs,
+then a single allocation is created, its inventory generated, the dashboard
+refreshed and the allocation deleted. every phase reports wall time and the
+number of API calls it made.
+
+run from proxmox/lbprox:
+    python benchmarks/bench_lifecycle.py --scales 10,100,1000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+# lbprox resolves its home directory from $HOME at import time, keep the
+# benchmark's inventories and dashboard away from the real ones
+os.environ["HOME"] = tempfile.mkdtemp(prefix="lbprox-bench-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prettytable import PrettyTable
+
+from lbprox.allocations import teardown
+from lbprox.cli.allocations import cli as allocations_cli
+from lbprox.common import metrics
+from lbprox.common import utils
+from lbprox.common.vm_tags import VMTags
+from lbprox.dashboard import dashboard
+from lbprox.simulator import server
+from lbprox.simulator.ssh import FakeSSHClient
+from lbprox.ssh import ssh
+
+
+STORAGE_ID = "lb-local-storage"
+BASE_URL = "https://repo.example/lightbits/3.10.1/rhel/9/67/"
+
+
+def seed_cluster(cluster: server.FakeCluster, vm_count, machines_per_allocation=4):
+    """add vm_count running VMs, grouped into allocations, spread over the nodes"""
+    nodes = list(cluster.nodes)
+    for idx in range(vm_count):
+        vmid = 10000 + idx
+        node = nodes[idx % len(nodes)]
+        allocation = f"seed{idx // machines_per_allocation:04d}"
+        name = f"{node}-{allocation}-s{idx % machines_per_allocation:02d}"
+        tags = VMTags().set_node(node).set_vm_name(name).set_role("target").set_allocation(allocation)
+        cluster.add_vm(node, vmid, {"name": name, "cores": 2, "memory": 2048, "tags": tags.str()},
+                       status="running")
+
+
+class Phase(object):
+    def __init__(self, scale, name):
+        self.scale = scale
+        self.name = name
+        self.seconds = 0.0
+        self.api_calls = 0
+        self.api_errors = 0
+        self.error = None
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def run_phase(results, scale, name, func, *args, **kwargs):
+    phase = Phase(scale, name)
+    metrics.REGISTRY.reset()
+    start = time.time()
+    result = None
+    try:
+        result = func(*args, **kwargs)
+    except Exception as ex:
+        logging.exception(f"phase {name} failed at scale {scale}")
+        phase.error = str(ex)
+    phase.seconds = time.time() - start
+    for stats in metrics.REGISTRY.snapshot().values():
+        phase.api_calls += stats.count
+        phase.api_errors += stats.errors
+    results.append(phase)
+    return result
+
+
+def bench_scale(scale, args):
+    delays = server.SimulatorDelays(scale=args.delay_scale)
+    cluster = server.FakeCluster(node_count=args.nodes, delays=delays, storage_id=STORAGE_ID)
+    seed_cluster(cluster, scale)
+    fake_server = server.FakeProxmoxServer(cluster).start()
+    host, port = fake_server.address
+    pve = server.connect(host, port)
+    ctx = types.SimpleNamespace(obj=types.SimpleNamespace(
+        pve=pve, config={"username": "root", "password": "light", "light_app_path": os.environ["HOME"]}))
+
+    results = []
+    try:
+        allocation = run_phase(results, scale, "allocate", allocations_cli._create_vms,
+                               pve, None, STORAGE_ID, True, None, True,
+                               ssh_username="root", ssh_password="light",
+                               allocation_descriptor_name=args.descriptor,
+                               clone_mode=args.clone_mode, numa_placement=False,
+                               cpu_overcommit=args.cpu_overcommit)
+        allocation_id = allocation["allocation_id"] if allocation else None
+        if allocation_id:
+            run_phase(results, scale, "deploy-inventory", allocations_cli._generate_inventory,
+                      ctx, allocation_id, BASE_URL)
+        run_phase(results, scale, "dashboard-refresh", dashboard.fetch_vms, pve, "observability")
+        # the local state is reconciled by now, only changes since the previous refresh are fetched
+        run_phase(results, scale, "dashboard-refresh-warm", dashboard.fetch_vms, pve, "observability")
+        if allocation_id:
+            vms = utils.list_cluster_vms(pve, VMTags().set_allocation(allocation_id))
+            run_phase(results, scale, "delete", teardown.teardown_vms,
+                      pve, vms, STORAGE_ID, "root", "light")
+    finally:
+        fake_server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10,100,1000",
+                        help="comma separated number of VMs already in the cluster")
+    parser.add_argument("--nodes", type=int, default=8)
+    parser.add_argument("--descriptor", default="lightbits_cluster_3x_target_tiny_1numa_emulated_ssd_1x_client")
+    parser.add_argument("--clone-mode", default="linked", choices=["linked", "full", "import"])
+    parser.add_argument("--cpu-overcommit", type=float, default=4.0)
+    parser.add_argument("--delay-scale", type=float, default=0.05,
+                        help="multiply the simulated API/task/boot delays by this factor")
+    parser.add_argument("--ssh-latency", type=float, default=0.01)
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+    utils.basicConfig(args.debug)
+    if not args.debug:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    FakeSSHClient.latency = args.ssh_latency
+    ssh.SSHClient = FakeSSHClient
+
+    results = []
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        results += bench_scale(scale, args)
+
+    table = PrettyTable()
+    table.field_names = ["vms", "phase", "seconds", "api calls", "api errors", "error"]
+    table.align = "l"
+    for phase in results:
+        table.add_row([phase.scale, phase.name, f"{phase.seconds:.2f}", phase.api_calls,
+                       phase.api_errors, phase.error or ""])
+    print(table)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump([phase.to_dict() for phase in results], f, indent=2)
+    if any(phase.error for phase in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
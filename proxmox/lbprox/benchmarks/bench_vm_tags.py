@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""micro-benchmarks of VMTags parsing and matching at cluster scale.
+
+builds the tags of N VMs the way allocations tag them and times parsing them,
+filtering the list by allocation (cold and warm parse cache) and is_subset.
+
+run from proxmox/lbprox:
+    python benchmarks/bench_vm_tags.py --vms 1000,5000,20000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prettytable import PrettyTable
+
+from lbprox.common import utils
+from lbprox.common import vm_tags
+from lbprox.common.vm_tags import VMTags
+
+
+def make_vms(count, machines_per_allocation=4):
+    vms = []
+    for idx in range(count):
+        allocation = f"a{idx // machines_per_allocation:06d}"
+        tags = VMTags().set_node(f"pve{idx % 16:02d}").set_vm_name(f"vm-{idx}").set_role("target") \
+            .set_cluster_name(f"cluster-{allocation}").set_cluster_id(f"cid-{allocation}") \
+            .set_version("3.10.1").set_allocation(allocation)
+        vms.append({"vmid": 10000 + idx, "name": f"vm-{idx}", "tags": tags.str()})
+    return vms
+
+
+def measure(func, number):
+    """best per call time in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def bench(count, number):
+    vms = make_vms(count)
+    raw = [vm["tags"] for vm in vms]
+    query = VMTags().set_allocation(f"a{(count // 8):06d}")
+    parsed = [VMTags.parse_tags(tags) for tags in raw]
+
+    def parse_all():
+        for tags in raw:
+            VMTags.parse_tags(tags)
+
+    def filter_cold():
+        vm_tags._parse_cache.clear()
+        utils.filter_tags(vms, query)
+
+    def filter_warm():
+        utils.filter_tags(vms, query)
+
+    def subset_all():
+        for tags in parsed:
+            query.is_subset(tags)
+
+    rows = []
+    for name, func in [("parse_tags", parse_all), ("filter_tags cold", filter_cold),
+                       ("filter_tags warm", filter_warm), ("is_subset", subset_all)]:
+        total = measure(func, number)
+        rows.append([count, name, f"{total / 1000:.2f}", f"{total / count:.3f}"])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vms", default="1000,5000,20000", help="comma separated number of VMs")
+    parser.add_argument("--number", type=int, default=20, help="calls per measurement")
+    args = parser.parse_args()
+
+    table = PrettyTable()
+    table.field_names = ["vms", "operation", "ms per call", "us per vm"]
+    table.align = "l"
+    for count in [int(count) for count in args.vms.split(",")]:
+        for row in bench(count, args.number):
+            table.add_row(row)
+    print(table)
+
+
+if __name__ == "__main__":
+    main()
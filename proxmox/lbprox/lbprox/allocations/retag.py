@@ -0,0 +1,101 @@
+import logging
+
+from lbprox.common import threadpool
+from lbprox.common.vm_tags import VMTags
+
+
+UNCHANGED = "unchanged"
+CHANGED = "changed"
+FAILED = "failed"
+
+
+class RetagResult(object):
+    """outcome of retagging a single VM, changes maps each modified key to
+    its (old, new) value, new is None for removed keys.
+    """
+    def __init__(self, node, vmid, name, changes):
+        self.node = node
+        self.vmid = vmid
+        self.name = name
+        self.changes = changes
+        self.status = CHANGED if changes else UNCHANGED
+        self.error = None
+
+    def failed(self):
+        return self.error is not None
+
+    def describe_changes(self):
+        return ", ".join(f"{key}: {old} -> {new}" for key, (old, new) in sorted(self.changes.items()))
+
+    def to_dict(self):
+        return {
+            "node": self.node,
+            "vmid": self.vmid,
+            "name": self.name,
+            "status": self.status,
+            "changes": {key: list(change) for key, change in self.changes.items()},
+            "error": self.error,
+        }
+
+
+def diff_tags(current: VMTags, new: VMTags):
+    """{key: (old, new)} of the keys that differ, new is None for removed keys"""
+    current_tags = current.get_tags()
+    new_tags = new.get_tags()
+    changes = {}
+    for key, value in new_tags.items():
+        if current_tags.get(key) != value:
+            changes[key] = (current_tags.get(key), value)
+    for key, value in current_tags.items():
+        if key not in new_tags:
+            changes[key] = (value, None)
+    return changes
+
+
+def plan_retag(vms, set_tags: dict=None, remove_keys=()):
+    """[(vm, new VMTags)] for cluster resources entries, applying the same update to all"""
+    plan = []
+    for vm in vms:
+        tags = VMTags.parse_tags(vm.get('tags', "") or "")
+        for key, value in (set_tags or {}).items():
+            tags.set_tag(key, value)
+        for key in remove_keys:
+            tags.get_tags().pop(key, None)
+        plan.append((vm, tags))
+    return plan
+
+
+def _apply(pve, node, vmid, tags):
+    pve.nodes(node).qemu(vmid).config.put(tags=tags)
+
+
+def apply_retag(pve, plan, max_workers=16):
+    """write the new tags of [(vm, VMTags)] concurrently, skipping VMs whose tags
+    would not change. requests take the per-node slots, so a single node is not
+    flooded. returns a RetagResult per VM.
+    """
+    results = {}
+    jobs = []
+    for vm, tags in plan:
+        current = VMTags.parse_tags(vm.get('tags', "") or "")
+        result = RetagResult(vm['node'], vm['vmid'], vm.get('name'), diff_tags(current, tags))
+        results[vm['vmid']] = result
+        if result.status == CHANGED:
+            jobs.append((pve, vm['node'], vm['vmid'], tags.str()))
+    if not jobs:
+        return list(results.values())
+
+    executor = threadpool.JobExecutor(f"retagging {len(jobs)} VMs", max_workers=max_workers,
+                                      node_of=lambda args: args[1])
+    for job_result in executor.run(_apply, jobs):
+        if not job_result.ok():
+            result = results[job_result.args[2]]
+            result.status = FAILED
+            result.error = str(job_result.exception)
+            logging.error(f"failed to retag {result.node}:{result.vmid}: {result.error}")
+    return list(results.values())
+
+
+def retag_vms(pve, vms, set_tags: dict=None, remove_keys=(), max_workers=16):
+    """set and remove tags of many VMs at once, see apply_retag"""
+    return apply_retag(pve, plan_retag(vms, set_tags, remove_keys), max_workers)
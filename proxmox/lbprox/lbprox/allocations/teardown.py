@@ -0,0 +1,126 @@
+import concurrent.futures
+import logging
+
+from lbprox.common import tasks
+from lbprox.common import threadpool
+from lbprox.common import trace
+from lbprox.snippets import ci_snippets
+from lbprox.ssh import ssh
+
+
+class TeardownResult(object):
+    """outcome of tearing down a single VM. stage is the last stage reached:
+    stop, destroy or snippets. error is None when the VM was fully removed.
+    """
+    def __init__(self, node, vmid, name=None):
+        self.node = node
+        self.vmid = vmid
+        self.name = name
+        self.stage = "stop"
+        self.error = None
+
+    def failed(self):
+        return self.error is not None
+
+    def to_dict(self):
+        return {
+            "node": self.node,
+            "vmid": self.vmid,
+            "name": self.name,
+            "stage": self.stage,
+            "error": self.error,
+        }
+
+
+def _wait_for_tasks(pve, upids: dict, results: dict, tmo):
+    """wait for {vmid: upid} tasks concurrently, recording failures in results"""
+    futures = {vmid: tasks.track(pve, upid) for vmid, upid in upids.items()}
+    concurrent.futures.wait(futures.values(), timeout=tmo)
+    for vmid, future in futures.items():
+        if not future.done():
+            future.cancel()
+            results[vmid].error = f"timed out ({tmo}s) waiting for task {future.upid}"
+        elif future.exception():
+            results[vmid].error = str(future.exception())
+
+
+def _teardown_node(pve, node, vms, storage_id, ssh_username, ssh_password, stop_timeout, task_timeout):
+    results = {vm['vmid']: TeardownResult(node, vm['vmid'], vm.get('name')) for vm in vms}
+
+    # issue stop for all running VMs at once
+    stop_upids = {}
+    with trace.span("stop vms", node=node, count=len(vms)):
+        for vm in vms:
+            if vm.get('status') == "stopped":
+                continue
+            try:
+                stop_upids[vm['vmid']] = pve.nodes(node).qemu(vm['vmid']).status.stop.post(timeout=stop_timeout)
+            except Exception as ex:
+                results[vm['vmid']].error = f"failed to stop: {ex}"
+        _wait_for_tasks(pve, stop_upids, results, task_timeout)
+
+    # destroy, emulated ssds are owned by the VM and removed as unreferenced disks
+    destroy_upids = {}
+    with trace.span("destroy vms", node=node, count=len(vms)):
+        for vmid, result in results.items():
+            if result.failed():
+                continue
+            result.stage = "destroy"
+            try:
+                destroy_upids[vmid] = pve.nodes(node).qemu(vmid).delete(**{"purge": 1,
+                                                                           "destroy-unreferenced-disks": 1})
+            except Exception as ex:
+                result.error = f"failed to destroy: {ex}"
+        _wait_for_tasks(pve, destroy_upids, results, task_timeout)
+
+    destroyed = [vmid for vmid, result in results.items() if not result.failed()]
+    if destroyed:
+        for vmid in destroyed:
+            results[vmid].stage = "snippets"
+        ssh_client = None
+        try:
+            with trace.span("remove snippets", node=node, count=len(destroyed)):
+                ssh_client = ssh.SSHClient(node, ssh_username, ssh_password)
+                ci_snippets.CloudInit(ssh_client, storage_id).delete_cloud_init_data_files_bulk(destroyed)
+        except Exception as ex:
+            for vmid in destroyed:
+                results[vmid].error = f"failed to remove cloud-init snippets: {ex}"
+        finally:
+            if ssh_client:
+                ssh_client.close()
+    return list(results.values())
+
+
+def teardown_vms(pve, vms, storage_id, ssh_username, ssh_password,
+                 stop_timeout=60, task_timeout=300):
+    """stop and destroy VMs (cluster resources entries) grouped by node.
+
+    nodes are torn down concurrently. on each node all VMs are stopped at once,
+    then destroyed at once with their disks, and their cloud-init snippets are
+    removed with a single ssh session.
+    returns a TeardownResult per VM.
+    """
+    vms_by_node = {}
+    for vm in vms:
+        vms_by_node.setdefault(vm['node'], []).append(vm)
+    if not vms_by_node:
+        return []
+
+    args = [(pve, node, node_vms, storage_id, ssh_username, ssh_password, stop_timeout, task_timeout)
+            for node, node_vms in vms_by_node.items()]
+    executor = threadpool.JobExecutor(f"deleting {len(vms)} VMs on {len(vms_by_node)} nodes",
+                                      max_workers=len(vms_by_node))
+    results = []
+    for job_result in executor.run(_teardown_node, args):
+        if job_result.ok():
+            results.extend(job_result.result)
+            continue
+        node, node_vms = job_result.args[1], job_result.args[2]
+        for vm in node_vms:
+            result = TeardownResult(node, vm['vmid'], vm.get('name'))
+            result.error = str(job_result.exception)
+            results.append(result)
+    for result in results:
+        if result.failed():
+            logging.error(f"failed to delete {result.node}:{result.vmid} at {result.stage}: {result.error}")
+    return results
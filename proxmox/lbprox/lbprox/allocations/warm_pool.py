@@ -0,0 +1,132 @@
+import logging
+
+import proxmoxer
+
+from lbprox.common import threadpool
+from lbprox.common import utils
+from lbprox.common.vm_tags import VMTags
+
+
+# set while a pool VM is built, it is handed out only after its first boot completed
+BUILDING_TAG = "building"
+
+# pool VMs are kept stopped (no host cpu/memory in use, cold booted on hand-out)
+# or running (rebooted on hand-out, to apply their new identity)
+POOL_STATES = ["stopped", "running"]
+
+
+class PoolVM(object):
+    """a pre-provisioned VM of a flavor, not handed out to an allocation yet"""
+    def __init__(self, vm):
+        self.node = vm['node']
+        self.vmid = vm['vmid']
+        self.name = vm.get('name')
+        self.status = vm.get('status')
+        tags = VMTags.parse_tags(vm.get('tags', ""))
+        self.flavor = tags.get_pool()
+        self.building = bool(tags.get_tag(BUILDING_TAG))
+
+    def ready(self):
+        return not self.building
+
+    def running(self):
+        return self.status == "running"
+
+    def to_dict(self):
+        return {
+            "node": self.node,
+            "vmid": self.vmid,
+            "name": self.name,
+            "flavor": self.flavor,
+            "status": self.status,
+            "state": "building" if self.building else "ready",
+        }
+
+
+def list_pool_vms(pve, flavor=None):
+    """PoolVM of every pool VM in the cluster, optionally of a single flavor"""
+    tags = VMTags().set_pool(flavor) if flavor else None
+    pool_vms = [PoolVM(vm) for vm in utils.list_cluster_vms(pve, tags)]
+    return sorted([pool_vm for pool_vm in pool_vms if pool_vm.flavor], key=lambda pool_vm: pool_vm.vmid)
+
+
+def deficits(pool_vms, sizes: dict):
+    """{flavor: VMs to build} to reach the pool sizes, VMs being built count as present"""
+    counts = {}
+    for pool_vm in pool_vms:
+        counts[pool_vm.flavor] = counts.get(pool_vm.flavor, 0) + 1
+    return {flavor: size - counts.get(flavor, 0) for flavor, size in sizes.items() if size > counts.get(flavor, 0)}
+
+
+def match_machines(machines, pool_vms, anti_affinity=True):
+    """{machine name: PoolVM} for the descriptor machines a ready pool VM of their
+    flavor can serve. with anti_affinity, machines of the same role and failure
+    domain are not served from the same node - those are left to be created.
+    """
+    available = {}
+    for pool_vm in pool_vms:
+        if pool_vm.ready():
+            available.setdefault(pool_vm.flavor, []).append(pool_vm)
+    group_nodes = {}
+    matches = {}
+    for machine in machines:
+        taken = group_nodes.setdefault((machine["role"], machine.get("failure_domain", machine["role"])), set())
+        candidates = available.get(machine["machine_type"], [])
+        pool_vm = next((pool_vm for pool_vm in candidates if not anti_affinity or pool_vm.node not in taken), None)
+        if pool_vm is None:
+            continue
+        candidates.remove(pool_vm)
+        taken.add(pool_vm.node)
+        matches[machine["name"]] = pool_vm
+    return matches
+
+
+def claim(pve, pool_vm: PoolVM, tags: VMTags, name):
+    """hand the pool VM to an allocation by setting its tags and name. the update
+    is conditional on the config digest, so of concurrent claims of the same VM
+    only one succeeds. returns the config before the claim, or None if the VM is
+    no longer available.
+    """
+    config = pve.nodes(pool_vm.node).qemu(pool_vm.vmid).config.get()
+    current = VMTags.parse_tags(config.get('tags', ""))
+    if current.get_pool() != pool_vm.flavor or current.get_tag(BUILDING_TAG):
+        return None
+    try:
+        pve.nodes(pool_vm.node).qemu(pool_vm.vmid).config.put(tags=tags.str(), name=name,
+                                                              digest=config['digest'])
+    except proxmoxer.core.ResourceException as ex:
+        logging.debug(f"claiming pool VM {pool_vm.node}:{pool_vm.vmid} failed: {ex}")
+        return None
+    logging.info(f"claimed pool VM {pool_vm.node}:{pool_vm.vmid} ({pool_vm.flavor}) as {name}")
+    return config
+
+
+def claim_pool_vms(pve, claims: dict):
+    """claim {machine name: (PoolVM, VMTags, name)} concurrently.
+    returns {machine name: (PoolVM, previous config)} of the successful claims.
+    """
+    if not claims:
+        return {}
+    args = [(pve, pool_vm, tags, name) for pool_vm, tags, name in claims.values()]
+    machine_names = {id(pool_vm): machine_name for machine_name, (pool_vm, _, _) in claims.items()}
+    executor = threadpool.JobExecutor(f"claiming {len(args)} pool VMs", max_workers=len(args),
+                                      node_of=lambda args: args[1].node)
+    claimed = {}
+    for job_result in executor.run(claim, args):
+        pool_vm = job_result.args[1]
+        if not job_result.ok():
+            logging.warning(f"failed to claim pool VM {pool_vm.node}:{pool_vm.vmid}: {job_result.exception}")
+        elif job_result.result is not None:
+            claimed[machine_names[id(pool_vm)]] = (pool_vm, job_result.result)
+    return claimed
+
+
+def release_pool_vms(pve, claimed: dict):
+    """return claimed VMs, as returned by claim_pool_vms, to the pool"""
+    for pool_vm, config in claimed.values():
+        try:
+            pve.nodes(pool_vm.node).qemu(pool_vm.vmid).config.put(tags=config.get('tags', ""),
+                                                                  name=config.get('name'))
+            logging.info(f"released pool VM {pool_vm.node}:{pool_vm.vmid} back to the pool")
+        except Exception as ex:
+            logging.error(f"failed to release pool VM {pool_vm.node}:{pool_vm.vmid}: {ex}")
@@ -1,7 +1,7 @@
-import logging
-import time
 import click
-from lbprox.common import utils
+
+from lbprox.common import access_bridge
+from lbprox.ssh import ssh
 
 
 @click.group("access-network")
@@ -13,17 +13,21 @@ def access_network_group():
 @click.option('--bridge-name', default="vmbr0", help="name of the bridge (default: vmbr0)")
 @click.option('--nodes', multiple=True, default=None,
               help="list of nodes to create the network - (default: all nodes)")
+@click.option('--dry-run', is_flag=True, default=False, help="only print what would change on every node")
+@click.option('--task-timeout', default=120, type=int, show_default=True,
+              help="seconds to wait for a node's network reload")
 @click.pass_context
-def create_access_bridge(ctx, bridge_name, nodes):
+def create_access_bridge(ctx, bridge_name, nodes, dry_run, task_timeout):
+    """plan the access bridge of all nodes at once, then create the missing ones in parallel"""
     # HACK: verify we have vmbr0 access network - when we skip the ui install the vmbr is not created
     # only when we deploy the proxmox using ansible on the machine everything is configured correctly
     # when we inaugurate from vm we don't have the real interface yet, so we cant really set this.
-    node_list = nodes if nodes else ctx.obj.pve.nodes.get()
-    node_names = [node.get('node') for node in node_list]
-    ssh_username = ctx.obj.config["username"]
-    ssh_password = ctx.obj.config["password"]
-    for hostname in node_names:
-        utils.get_or_create_access_bridge(ctx.obj.pve, hostname,
-                                          bridge_name, ssh_username,
-                                          ssh_password)
-
+    node_names = list(nodes) if nodes else [node.get('node') for node in ctx.obj.pve.nodes.get()]
+    with ssh.SSHPool(ctx.obj.config["username"], ctx.obj.config["password"]) as pool:
+        plans = access_bridge.plan_access_bridges(ctx.obj.pve, node_names, bridge_name, pool)
+        if not dry_run:
+            access_bridge.apply_access_bridges(ctx.obj.pve, plans, pool, task_timeout)
+    print(access_bridge.plan_table(plans))
+    failures = [plan for plan in plans if plan.failed()]
+    if failures:
+        raise click.ClickException(f"bridge {bridge_name} is not usable on {len(failures)} of {len(plans)} nodes")
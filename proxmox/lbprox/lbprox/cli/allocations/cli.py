@@ -5,18 +5,31 @@ import subprocess
 import time
 import uuid
 import re
+import sqlite3
 
 from lbprox.common import threadpool
+from lbprox.common import trace
 from lbprox.flavors import flavors
 from lbprox.cli import mutex
 from lbprox.allocations import allocation_descriptors
+from lbprox.allocations import retag
+from lbprox.allocations import teardown
+from lbprox.allocations import warm_pool
 from prettytable import PrettyTable
+from lbprox.common.tag_index import Selector
 from lbprox.common.vm_tags import VMTags
 
+from lbprox.common import tasks
 from lbprox.common import utils
+from lbprox.common import vm_templates
+from lbprox.placement import capacity
+from lbprox.placement import numa
+from lbprox.placement import scheduler
 from lbprox.ssh import ssh
+from lbprox.state import store
 from lbprox.snippets import ci_snippets
 from lbprox.deployment import deploy
+from lbprox.deployment import orchestrator
 
 
 minimum_boot_disk_size = "15G"
@@ -46,18 +59,22 @@ def list_machine_types(output_format):
     machine_type_list = flavors.list_machine_types()
     if output_format == 'table':
         table = PrettyTable(align="l")
-        table.field_names = ["index", "name", "cores", "base_memory", "ssds", "ifaces", "numa"]
+        table.field_names = ["index", "name", "cores", "base_memory", "ssds", "ssd profile", "ifaces", "numa",
+                             "pinned"]
         types = machine_type_list["machine_types"]
         idx = 1
         for _, machine_type in types.items():
             properties = machine_type['properties']
             ssd_count = properties["ssds"].get("count", 0) if properties.get("ssds") else 0
+            ssd_profile = properties["ssds"].get("profile", "") if properties.get("ssds") else ""
             table.add_row([idx, machine_type["name"],
                            properties["cores"],
                            properties["base_memory"],
                            ssd_count,
+                           ssd_profile if isinstance(ssd_profile, str) else "custom",
                            len(properties.get("networks", [])),
-                           properties["numa"]])
+                           properties["numa"],
+                           "yes" if properties.get("pin_numa") else ""])
             idx += 1
         print(table)
     else:
@@ -83,9 +100,14 @@ def list_descriptors(output_format):
 
 @allocations_list_group.command("allocations", help="list allocations currently running in cluster")
 @click.option('-o', '--output-format', type=click.Choice(['json', 'table']), default='table')
+@click.option('--max-age', type=float, default=30, show_default=True,
+              help="answer from the local state when it was reconciled in the last MAX_AGE seconds, "
+                   "0 always reconciles it with the cluster first")
 @click.pass_context
-def list_allocation(ctx, output_format):
-    allocations = utils.list_allocations_in_cluster(ctx.obj.pve)
+def list_allocation(ctx, output_format, max_age):
+    state = store.open_store()
+    state.ensure_fresh(ctx.obj.pve, max_age)
+    allocations = state.allocations()
 
     if output_format == 'table':
         table = PrettyTable(align="l")
@@ -101,27 +123,90 @@ def list_allocation(ctx, output_format):
 
 
 @allocations_group.command("create")
-@click.argument('hostname', required=True)
+@click.argument('hostname', required=False, default=None)
 @click.option('-s', '--storage-id', required=False, default="lb-local-storage")
 @click.option('-n', '--allocation-descriptor-name', required=True, type=str)
 @click.option('-t', '--tags', default=None, multiple=True)
 @click.option('--start-vm/--no-start-vm', default=True)
 @click.option('--wait-for-ip/--no-wait-for-ip', default=True)
+@click.option('--clone-mode', type=click.Choice(vm_templates.CLONE_MODES), default="linked",
+              help="create VMs as linked/full clones of a per-node os image template, or import the image into each VM")
+@click.option('--numa-placement/--no-numa-placement', default=True,
+              help="pin the cpus and memory of flavors with pin_numa to host NUMA nodes local to their "
+                   "passthrough devices")
+@click.option('--nodes', multiple=True, default=None,
+              help="nodes to schedule the machines on when HOSTNAME is not given (default: all nodes)")
+@click.option('--placement-policy', type=click.Choice(scheduler.PLACEMENT_POLICIES), default="spread",
+              help="spread machines over the nodes with the most free resources, or pack them on as few nodes as possible")
+@click.option('--anti-affinity/--no-anti-affinity', default=True,
+              help="keep machines of the same role and failure domain (e.g. targets) on different nodes")
+@click.option('--cpu-overcommit', type=float, default=4.0,
+              help="vcpus that may be scheduled per host cpu (default: 4)")
+@click.option('--preflight/--no-preflight', default=True,
+              help="check the nodes have the cores, memory and storage the machines need before creating any VM")
+@click.option('--dry-run', is_flag=True, default=False,
+              help="only print where the machines would be placed and the capacity they need")
+@click.option('--use-pool', is_flag=True, default=False,
+              help="hand out ready VMs of the warm pool for the machines of their flavor, create the rest")
 @click.pass_context
 def create_vms(ctx, hostname, storage_id, allocation_descriptor_name,
-                  tags, start_vm, wait_for_ip=True):
+                  tags, start_vm, wait_for_ip=True, clone_mode="linked",
+                  numa_placement=True, nodes=None, placement_policy="spread",
+                  anti_affinity=True, cpu_overcommit=4.0, preflight=True, dry_run=False,
+                  use_pool=False):
+    """create the VMs of an allocation descriptor on HOSTNAME, or schedule them
+    across the cluster nodes when HOSTNAME is not given"""
+    if dry_run:
+        _print_allocation_plan(ctx.obj.pve, hostname, storage_id, allocation_descriptor_name,
+                               nodes, placement_policy, anti_affinity, cpu_overcommit, clone_mode)
+        return
     if tags is not None:
         tags = ";".join(tags)
-    cluster_vms = _create_vms(ctx.obj.pve,
-                              hostname, storage_id,
-                              start_vm, tags, wait_for_ip,
-                              ssh_username=ctx.obj.config["username"],
-                              ssh_password=ctx.obj.config["password"],
-                              allocation_descriptor_name=allocation_descriptor_name)
+    trace.start("allocations create")
+    try:
+        cluster_vms = _create_vms(ctx.obj.pve,
+                                  hostname, storage_id,
+                                  start_vm, tags, wait_for_ip,
+                                  ssh_username=ctx.obj.config["username"],
+                                  ssh_password=ctx.obj.config["password"],
+                                  allocation_descriptor_name=allocation_descriptor_name,
+                                  clone_mode=clone_mode,
+                                  numa_placement=numa_placement,
+                                  nodes=nodes,
+                                  placement_policy=placement_policy,
+                                  anti_affinity=anti_affinity,
+                                  cpu_overcommit=cpu_overcommit,
+                                  preflight=preflight,
+                                  use_pool=use_pool)
+    except capacity.CapacityError as ex:
+        print(ex.report.table())
+        raise click.ClickException(str(ex))
+    except scheduler.SchedulingError as ex:
+        raise click.ClickException(str(ex))
+    finally:
+        _save_trace(trace.stop())
+        _invalidate_state()
     if cluster_vms:
         print(json.dumps(cluster_vms, indent=2))
 
 
+def _print_allocation_plan(pve, hostname, storage_id, allocation_descriptor_name,
+                           nodes, placement_policy, anti_affinity, cpu_overcommit, clone_mode):
+    allocation_descriptor = allocation_descriptors.allocation_descriptor_by_name(allocation_descriptor_name)
+    if not allocation_descriptor:
+        raise click.BadParameter(f"allocation descriptor not found: {allocation_descriptor_name}",
+                                 param_hint="'-n' / '--allocation-descriptor-name'")
+    try:
+        _, report = _plan_allocation(pve, hostname, storage_id, allocation_descriptor,
+                                     flavors.list_machine_types(), nodes, placement_policy,
+                                     anti_affinity, cpu_overcommit, clone_mode)
+    except scheduler.SchedulingError as ex:
+        raise click.ClickException(str(ex))
+    print(report.table())
+    if not report.ok():
+        raise click.ClickException(str(capacity.CapacityError(report)))
+
+
 @allocations_group.command("create-from-img")
 @click.argument('hostname', required=True)
 @click.option('-s', '--storage-id', required=False, default="lb-local-storage")
@@ -134,11 +219,13 @@ def create_vms(ctx, hostname, storage_id, allocation_descriptor_name,
 @click.option('-t', '--tags', default=None, multiple=True)
 @click.option('--start-vm/--no-start-vm', default=True)
 @click.option('--wait-for-ip/--no-wait-for-ip', default=True)
+@click.option('--clone-mode', type=click.Choice(vm_templates.CLONE_MODES), default="linked",
+              help="create VMs as linked/full clones of a per-node os image template, or import the image into each VM")
 @click.pass_context
 def create_vm_from_image(ctx, hostname, storage_id, image_name,
                          role, machine_name, cores, memory, disk_size,
                          tags, start_vm,
-                         wait_for_ip=True):
+                         wait_for_ip=True, clone_mode="linked"):
     if tags is not None:
         tags = ";".join(tags)
 
@@ -170,12 +257,29 @@ def create_vm_from_image(ctx, hostname, storage_id, image_name,
                                         start_vm, tags, wait_for_ip,
                                         ssh_username=ctx.obj.config["username"],
                                         ssh_password=ctx.obj.config["password"],
-                                        machine_info=machine_info)
+                                        machine_info=machine_info,
+                                        clone_mode=clone_mode)
     if cluster_vms:
         print(json.dumps(cluster_vms, indent=2))
 
 
 
+def _target_selector(allocation_id=None, tags=None):
+    """selector of the VMs a destructive command acts on. it must require at least one tag,
+    and only ever matches VMs created by lbprox - never the other VMs of the cluster.
+    """
+    if not tags:
+        return Selector.from_tags(VMTags().set_allocation(allocation_id)).owned()
+    try:
+        selector = Selector.parse(tags)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint="--tags")
+    if not selector.positive():
+        raise click.BadParameter(f"'{tags}' only excludes tags, it needs a term selecting VMs, "
+                                 "ex: allocation=b178,vm!=s00", param_hint="--tags")
+    return selector.owned()
+
+
 @allocations_group.command("delete")
 @click.option('-s', '--storage-id', required=False, default="lb-local-storage")
 @click.option('-a', '--allocation-id', prompt=True,
@@ -183,23 +287,89 @@ def create_vm_from_image(ctx, hostname, storage_id, image_name,
               type=str, help="allocation ID to deallocate")
 @click.option('-t', '--tags',
               cls=mutex.Mutex, not_required_if=["allocation_id"],
-              type=str, help="tags to deallocate - comma separated, ex: cname=c01,vmname=s00")
+              type=str, help="tag selector of the VMs to deallocate - comma separated, "
+                             "ex: cname=c01,vm!=s00 or 'allocation in (b17,b18)'")
+@click.option('--stop-timeout', default=60, type=int, show_default=True,
+              help="seconds PVE waits for a VM to stop. VMs are stopped immediately, without a guest "
+                   "shutdown, since they are destroyed next")
 @click.pass_context
-def deallocate_vms(ctx, storage_id, allocation_id=None, tags=None):
-    if tags:
-        tags = VMTags.parse_tags(tags)
-    else:
-        tags = VMTags().set_allocation(allocation_id)
-    _delete_allocations(ctx.obj.pve, storage_id,
-                        ctx.obj.config["username"],
-                        ctx.obj.config["password"],
-                        tags)
+def deallocate_vms(ctx, storage_id, allocation_id=None, tags=None, stop_timeout=60):
+    selector = _target_selector(allocation_id, tags)
+    tracer = trace.start("allocations delete")
+    tracer.metadata["allocation_id"] = allocation_id
+    try:
+        vms = utils.select_cluster_vms(ctx.obj.pve, selector)
+        results = teardown.teardown_vms(ctx.obj.pve, vms, storage_id,
+                                        ctx.obj.config["username"],
+                                        ctx.obj.config["password"],
+                                        stop_timeout=stop_timeout)
+    finally:
+        _save_trace(trace.stop())
+        _invalidate_state()
+    failures = [result for result in results if result.failed()]
+    if failures:
+        table = PrettyTable()
+        table.field_names = ["node", "vmid", "name", "stage", "error"]
+        table.align = "l"
+        for result in failures:
+            table.add_row([result.node, result.vmid, result.name, result.stage, result.error])
+        print(table)
+        raise click.ClickException(f"failed to delete {len(failures)} of {len(results)} VMs")
+
 
 
+def _parse_tag_assignments(ctx, param, values):
+    assignments = {}
+    for value in values:
+        key, sep, tag_value = value.partition("=")
+        if not sep or not key or not tag_value:
+            raise click.BadParameter(f"expected key=value, got: {value}")
+        assignments[key] = tag_value
+    return assignments
+
+
+@allocations_group.command("tag")
+@click.option('-a', '--allocation-id', default=None, type=str, help="retag the VMs of this allocation")
+@click.option('-t', '--tags', default=None, type=str,
+              help="retag the VMs matching this tag selector, ex: cname=c01,role=target")
+@click.option('--set', 'set_tags', multiple=True, callback=_parse_tag_assignments,
+              help="tag to set as key=value, ex: --set cname=c02")
+@click.option('--remove', 'remove_keys', multiple=True, help="tag key to remove")
+@click.option('--dry-run', is_flag=True, default=False, help="only print the changes")
+@click.pass_context
+def tag_vms(ctx, allocation_id, tags, set_tags, remove_keys, dry_run):
+    """set or remove tags of many VMs at once, VMs that would not change are skipped"""
+    if bool(allocation_id) == bool(tags):
+        raise click.UsageError("exactly one of --allocation-id or --tags is required")
+    if not set_tags and not remove_keys:
+        raise click.UsageError("nothing to do, use --set and/or --remove")
+    selector = _target_selector(allocation_id, tags)
+    vms = utils.select_cluster_vms(ctx.obj.pve, selector)
+    if not vms:
+        raise click.ClickException(f"no VMs match: {selector}")
+
+    plan = retag.plan_retag(vms, set_tags, remove_keys)
+    if dry_run:
+        results = [retag.RetagResult(vm['node'], vm['vmid'], vm.get('name'),
+                                     retag.diff_tags(VMTags.parse_tags(vm.get('tags', "") or ""), tags))
+                   for vm, tags in plan]
+    else:
+        results = retag.apply_retag(ctx.obj.pve, plan)
+    table = PrettyTable()
+    table.field_names = ["node", "vmid", "name", "status", "changes", "error"]
+    table.align = "l"
+    for result in sorted(results, key=lambda result: result.vmid):
+        table.add_row([result.node, result.vmid, result.name, result.status,
+                       result.describe_changes(), result.error or ""])
+    print(table)
+    failures = [result for result in results if result.failed()]
+    if failures:
+        raise click.ClickException(f"failed to retag {len(failures)} of {len(results)} VMs")
+
 
 @allocations_deploy_group.command("lightbits")
-@click.option('-a', '--allocation-id', required=True, type=str,
-              help="allocation id of the machines we want to deploy")
+@click.option('-a', '--allocation-id', 'allocation_ids', required=True, type=str, multiple=True,
+              help="allocation id of the machines we want to deploy, repeat to deploy several allocations")
 @click.option('-u', '--base-url', required=True, help="full URL for the repository holding lightbits RPMs")
 @click.option('-p', '--profile-name', required=False,
               help="profile name to use for the deployment, if not provided will use the default profile")
@@ -211,40 +381,194 @@ def deallocate_vms(ctx, storage_id, allocation_id=None, tags=None):
               help="should we set ec")
 @click.option('-d', '--initial-device-count', default=4, type=int,
               help="override the default number of devices to create")
+@click.option('-j', '--parallelism', default=2, type=int, show_default=True,
+              help="number of allocations deployed at the same time")
+@click.option('--timeout', default=0, type=int,
+              help="kill a deployment running longer than this many seconds (0 - no limit)")
+@click.option('--idle-timeout', default=1800, type=int, show_default=True,
+              help="kill a deployment that printed nothing for this many seconds (0 - no limit)")
+@click.option('--ansible-profile', type=click.Choice(list(deploy.ANSIBLE_PROFILES)),
+              default=deploy.DEFAULT_ANSIBLE_PROFILE, show_default=True,
+              help="how ansible runs the deployment: tuned (forks, pipelining, fact cache), "
+                   "debug (tuned with -vvv output) or baseline (only -vvv)")
 @click.pass_context
-def lightbits(ctx, allocation_id, base_url, profile_name, run_deploy,
+def lightbits(ctx, allocation_ids, base_url, profile_name, run_deploy,
               stream_output=True, ec_enabled=False,
-              initial_device_count=4):
-    _deploy_lightbits_cluster(ctx, allocation_id,
-                              base_url, profile_name,
-                              run_deploy, stream_output, ec_enabled,
-                              initial_device_count)
+              initial_device_count=4, parallelism=2, timeout=0, idle_timeout=1800,
+              ansible_profile=deploy.DEFAULT_ANSIBLE_PROFILE):
+    _deploy_lightbits_clusters(ctx, allocation_ids,
+                               base_url, profile_name,
+                               run_deploy, stream_output, ec_enabled,
+                               initial_device_count, parallelism, timeout, idle_timeout,
+                               ansible_profile)
 
 
 @allocations_deploy_group.command("initiator")
-@click.option('-a', '--allocation-id', required=True, type=str,
-              help="allocation id of the machines we want to deploy")
+@click.option('-a', '--allocation-id', 'allocation_ids', required=True, type=str, multiple=True,
+              help="allocation id of the machines we want to deploy, repeat to deploy several allocations")
 @click.option('-u', '--base-url', required=True, help="full URL for the repository holding lightbits RPMs")
 @click.option('--run-deploy/--no-run-deploy', default=True,
               help="should we deploy the cluster, or just generate the inventory files")
 @click.option('--stream-output/--no-stream-output', default=True,
               help="should we stream the ansible output to stdout")
+@click.option('-j', '--parallelism', default=2, type=int, show_default=True,
+              help="number of allocations deployed at the same time")
+@click.option('--timeout', default=0, type=int,
+              help="kill a deployment running longer than this many seconds (0 - no limit)")
+@click.option('--idle-timeout', default=1800, type=int, show_default=True,
+              help="kill a deployment that printed nothing for this many seconds (0 - no limit)")
+@click.option('--ansible-profile', type=click.Choice(list(deploy.ANSIBLE_PROFILES)),
+              default=deploy.DEFAULT_ANSIBLE_PROFILE, show_default=True,
+              help="how ansible runs the deployment: tuned (forks, pipelining, fact cache), "
+                   "debug (tuned with -vvv output) or baseline (only -vvv)")
 @click.pass_context
-def nvme_initiator(ctx, allocation_id, base_url, run_deploy, stream_output=True):
-    _deploy_nvme_initiator(ctx.obj.pve, allocation_id, base_url, run_deploy, stream_output)
+def nvme_initiator(ctx, allocation_ids, base_url, run_deploy, stream_output=True, parallelism=2,
+                   timeout=0, idle_timeout=1800, ansible_profile=deploy.DEFAULT_ANSIBLE_PROFILE):
+    _deploy_nvme_initiators(ctx, allocation_ids, base_url, run_deploy, stream_output, parallelism,
+                            timeout, idle_timeout, ansible_profile)
+
+
+@allocations_group.group("pool")
+def allocations_pool_group():
+    """warm pool of pre-created VMs, handed out by `allocations create --use-pool`"""
+    pass
+
+
+def _parse_pool_sizes(ctx, param, values):
+    sizes = {}
+    for value in values:
+        flavor, sep, count = value.partition("=")
+        if not sep or not flavor or not count.isdigit():
+            raise click.BadParameter(f"expected flavor=count, got: {value}")
+        sizes[flavor] = int(count)
+    return sizes
+
+
+def _pool_fill_options(command):
+    options = [
+        click.option('-s', '--storage-id', required=False, default="lb-local-storage"),
+        click.option('-f', '--size', 'sizes', required=True, multiple=True, callback=_parse_pool_sizes,
+                     help="VMs to keep in the pool per flavor as flavor=count, repeat for several flavors"),
+        click.option('--state', type=click.Choice(warm_pool.POOL_STATES), default="stopped", show_default=True,
+                     help="keep pool VMs stopped (no host resources in use) or running (rebooted on hand-out)"),
+        click.option('--nodes', multiple=True, default=None,
+                     help="nodes to build pool VMs on (default: all nodes)"),
+        click.option('--clone-mode', type=click.Choice(vm_templates.CLONE_MODES), default="linked"),
+        click.option('--numa-placement/--no-numa-placement', default=True),
+        click.option('--placement-policy', type=click.Choice(scheduler.PLACEMENT_POLICIES), default="spread"),
+        click.option('--cpu-overcommit', type=float, default=4.0),
+        click.option('-j', '--parallelism', default=4, type=int, show_default=True,
+                     help="pool VMs built at the same time"),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+@allocations_pool_group.command("list")
+@click.option('-o', '--output-format', type=click.Choice(['json', 'table']), default='table')
+@click.pass_context
+def list_pool(ctx, output_format):
+    pool_vms = [pool_vm.to_dict() for pool_vm in warm_pool.list_pool_vms(ctx.obj.pve)]
+    if output_format == 'json':
+        print(json.dumps(pool_vms, indent=2))
+        return
+    table = PrettyTable()
+    table.field_names = ["flavor", "node", "vmid", "name", "status", "state"]
+    table.align = "l"
+    for pool_vm in sorted(pool_vms, key=lambda pool_vm: (pool_vm["flavor"], pool_vm["node"], pool_vm["vmid"])):
+        table.add_row([pool_vm[key] for key in ["flavor", "node", "vmid", "name", "status", "state"]])
+    print(table)
+
+
+@allocations_pool_group.command("fill")
+@_pool_fill_options
+@click.pass_context
+def fill_pool(ctx, storage_id, sizes, state, nodes, clone_mode, numa_placement,
+              placement_policy, cpu_overcommit, parallelism):
+    """build the pool VMs missing to reach the pool sizes"""
+    try:
+        results = _fill_pool(ctx.obj.pve, sizes, storage_id, state,
+                             ctx.obj.config["username"], ctx.obj.config["password"],
+                             nodes, clone_mode, numa_placement, placement_policy,
+                             cpu_overcommit, parallelism)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint="'-f' / '--size'")
+    except (scheduler.SchedulingError, capacity.CapacityError) as ex:
+        raise click.ClickException(str(ex))
+    table = PrettyTable()
+    table.field_names = ["node", "flavor", "vmid", "seconds", "error"]
+    table.align = "l"
+    for result in results:
+        node, flavor = result.args[2], result.args[4]
+        if result.ok():
+            table.add_row([node, flavor, result.result["vmid"], f"{result.duration:.1f}", ""])
+        else:
+            table.add_row([node, flavor, "", f"{result.duration:.1f}", result.exception])
+    if results:
+        print(table)
+    failures = [result for result in results if not result.ok()]
+    if failures:
+        raise click.ClickException(f"failed to build {len(failures)} of {len(results)} pool VMs")
+
+
+@allocations_pool_group.command("serve")
+@_pool_fill_options
+@click.option('-i', "--interval", required=False, default=60, type=int, show_default=True,
+              help="seconds between checks of the pool sizes")
+@click.pass_context
+def serve_pool(ctx, storage_id, sizes, state, nodes, clone_mode, numa_placement,
+               placement_policy, cpu_overcommit, parallelism, interval):
+    """keep refilling the pool as its VMs are handed out"""
+    while True:
+        try:
+            results = _fill_pool(ctx.obj.pve, sizes, storage_id, state,
+                                 ctx.obj.config["username"], ctx.obj.config["password"],
+                                 nodes, clone_mode, numa_placement, placement_policy,
+                                 cpu_overcommit, parallelism)
+            failures = [result for result in results if not result.ok()]
+            if results:
+                logging.info(f"built {len(results) - len(failures)} of {len(results)} pool VMs")
+        except Exception as ex:
+            logging.error(f"failed to fill the warm pool: {ex}")
+        time.sleep(interval)
+
+
+@allocations_pool_group.command("drain")
+@click.option('-s', '--storage-id', required=False, default="lb-local-storage")
+@click.option('-f', '--flavor', default=None, type=str, help="only delete the pool VMs of this flavor")
+@click.pass_context
+def drain_pool(ctx, storage_id, flavor):
+    """delete pool VMs, including ones left half built"""
+    pool_vms = warm_pool.list_pool_vms(ctx.obj.pve, flavor)
+    results = teardown.teardown_vms(ctx.obj.pve,
+                                    [{"node": pool_vm.node, "vmid": pool_vm.vmid, "name": pool_vm.name}
+                                     for pool_vm in pool_vms],
+                                    storage_id, ctx.obj.config["username"], ctx.obj.config["password"])
+    failures = [result for result in results if result.failed()]
+    if failures:
+        raise click.ClickException(f"failed to delete {len(failures)} of {len(results)} pool VMs")
+    print(f"deleted {len(results)} pool VMs")
 
 
 def _create_vm_on_proxmox(pve,
                           hostname, custom_user_data,
                           storage_id, vm_name,
                           machine_name, machine_info,
-                          tags: VMTags):
+                          tags: VMTags, clone_mode="linked",
+                          numa_placement=False):
     free_vf_pci_id = None
     try:
+        template_vmid = None
+        if clone_mode != "import":
+            # building the template reserves a VMID of its own, so it must happen before we get ours
+            with trace.span("template", node=hostname, machine=vm_name):
+                template_vmid = vm_templates.get_or_create_template(pve, hostname, storage_id,
+                                                                    machine_info['os_image'],
+                                                                    minimum_boot_disk_size)
         # Get the next VM ID
-        vmid = pve.cluster().nextid().get()
-
-        os_image_path = f"{utils.get_storage_path(storage_id)}/template/iso/{machine_info['os_image']}.img"
+        with trace.span("reserve vmid", node=hostname, machine=vm_name):
+            vmid = utils.next_vmid(pve)
 
         memory_bytes = utils.convert_size_to_bytes(machine_info['properties']['base_memory'])
         memory_mb = memory_bytes // 1024**2 # convert to MB
@@ -254,34 +578,62 @@ def _create_vm_on_proxmox(pve,
         if not is_valid:
             raise RuntimeError(f"hostname: '{hostname}' is not a valid Proxmox node. Must be one of {node_names}")
 
-        # Create the VM
-        vm = pve.nodes(hostname).qemu.create(
-            vmid=vmid,
-            name=vm_name,
-            memory=memory_mb,
-            cores=cores,
-            sockets=1,
-            cpu="host",
-            onboot=1,
-            agent=1,
-            tags=tags,
-            # net0="virtio,bridge=vmbr0,firewall=1",
-            #ide2="none,media=cdrom",
-            scsihw="virtio-scsi-pci",
-            #scsihw="virtio-scsi-single",
-            virtio0=f"{storage_id}:0,import-from={os_image_path},discard=on",
-            boot="order=virtio0;ide2;net0",
-            citype="nocloud",
-            ciuser="root",
-            ide2=f"{storage_id}:cloudinit",
-        )
-
-        utils.wait_for_vm_status(pve, hostname, vmid, "stopped")
+        with trace.span("import image" if clone_mode == "import" else "clone", node=hostname, machine=vm_name):
+            if clone_mode == "import":
+                os_image_path = f"{utils.get_storage_path(storage_id)}/template/iso/{machine_info['os_image']}.img"
+                # Create the VM
+                upid = pve.nodes(hostname).qemu.create(
+                    vmid=vmid,
+                    name=vm_name,
+                    memory=memory_mb,
+                    cores=cores,
+                    sockets=1,
+                    cpu="host",
+                    onboot=1,
+                    agent=1,
+                    tags=tags,
+                    # net0="virtio,bridge=vmbr0,firewall=1",
+                    #ide2="none,media=cdrom",
+                    scsihw="virtio-scsi-pci",
+                    #scsihw="virtio-scsi-single",
+                    virtio0=f"{storage_id}:0,import-from={os_image_path},discard=on",
+                    boot="order=virtio0;ide2;net0",
+                    citype="nocloud",
+                    ciuser="root",
+                    ide2=f"{storage_id}:cloudinit",
+                )
+                tasks.wait_for_task(pve, upid)
+            else:
+                vm_templates.clone_vm(pve, hostname, template_vmid, vmid, vm_name, storage_id,
+                                      full=(clone_mode == "full"))
+                pve.nodes(hostname).qemu(vmid).config.put(
+                    memory=memory_mb,
+                    cores=cores,
+                    sockets=1,
+                    cpu="host",
+                    onboot=1,
+                    tags=str(tags),
+                )
 
         networks = machine_info['properties']['networks']
+        ssds = machine_info['properties'].get('ssds', None)
+        free_vfs = []
+        if any(network["type"] == "passthrough" for network in networks):
+            free_vfs = utils.find_unattached_vfs(pve, hostname)
+        unattached_ssds = []
+        if ssds and ssds['type'] == "passthrough":
+            unattached_ssds = utils.find_unattached_nvme_ssds(pve, hostname)
+
+        with trace.span("numa placement", node=hostname, machine=vm_name):
+            placement, topology = _place_on_numa_nodes(pve, hostname, vmid, machine_info, memory_mb,
+                                                       free_vfs + unattached_ssds, numa_placement)
+        if placement:
+            # prefer devices local to the VM's NUMA nodes
+            free_vfs = placement.sort_by_locality(free_vfs, topology)
+            unattached_ssds = placement.sort_by_locality(unattached_ssds, topology)
+
         for i, network in enumerate(networks):
             if network["type"] == "passthrough":
-                free_vfs = utils.find_unattached_vfs(pve, hostname)
                 if not free_vfs:
                     raise RuntimeError("No free VF found")
                 free_vf_pci_id = free_vfs[0]
@@ -295,24 +647,27 @@ def _create_vm_on_proxmox(pve,
         # ci = ci_snippets.CloudInit(ssh_client, storage_id)
         # vm_hostname = f"{hostname}-{tags.get_allocation()}-{vm_name}"
         ci: ci_snippets.CloudInit = machine_info["cloud_init"]
-        user_data = ci.create_user_data(vm_name, custom_user_data)
-        ci.upload_user_data(vmid, user_data)
+        with trace.span("cloud-init upload", node=hostname, machine=vm_name):
+            user_data = ci.create_user_data(vm_name, custom_user_data)
+            ci.upload_user_data(vmid, user_data)
         pve.nodes(hostname).qemu(vmid).config.put(**{"cicustom":
                                                      f"user={ci.user_data_volid(vmid)}"})
 
-        ssds = machine_info['properties'].get('ssds', None)
         if ssds:
             if ssds['type'] == "emulated":
                 # this must happen before we create the VM since qm create will delete the VMID directory
                 size = utils.convert_size_to_bytes(ssds['size'])
-                utils.create_emulated_ssds(pve, hostname, vmid, storage_id, ssds["count"], size)
+                with trace.span("create emulated ssds", node=hostname, machine=vm_name, count=ssds["count"]):
+                    utils.create_emulated_ssds(pve, hostname, vmid, storage_id, ssds["count"], size,
+                                               provisioning=ssds.get("provisioning", "sparse"),
+                                               ssh_client=ci.ssh_client)
                 emulated_disks_args = create_args_string(vmid, ssds["count"],
                                                          storage_id,
                                                          tags.get_allocation(),
-                                                         machine_name)
+                                                         machine_name,
+                                                         flavors.get_ssd_profile(ssds))
                 pve.nodes(hostname).qemu(vmid).config.put(args=emulated_disks_args)
             elif ssds['type'] == "passthrough":
-                unattached_ssds = utils.find_unattached_nvme_ssds(pve, hostname)
                 if len(unattached_ssds) < ssds["count"]:
                     raise RuntimeError(f"not enough unattached SSDs - have only {len(unattached_ssds)}, require {ssds['count']}")
                 for i, pci_device in enumerate(unattached_ssds):
@@ -326,7 +681,8 @@ def _create_vm_on_proxmox(pve,
         minimum_boot_disk_size_bytes = utils.convert_size_to_bytes(minimum_boot_disk_size)
         if boot_disk_size < minimum_boot_disk_size_bytes:
             logging.debug(f"resizing boot disk from {boot_disk_size} to {minimum_boot_disk_size}")
-            pve.nodes(hostname).qemu(vmid).resize.put(**{"disk": "virtio0", "size": minimum_boot_disk_size})
+            with trace.span("resize boot disk", node=hostname, machine=vm_name):
+                pve.nodes(hostname).qemu(vmid).resize.put(**{"disk": "virtio0", "size": minimum_boot_disk_size})
 
         logging.debug(f"created VM {vm_name} with vmid: {vmid}")
     except subprocess.CalledProcessError as ex:
@@ -340,6 +696,39 @@ def _create_vm_on_proxmox(pve,
     return vmid
 
 
+def _place_on_numa_nodes(pve, hostname, vmid, machine_info, memory_mb,
+                         candidate_devices, numa_placement):
+    """apply the flavor's NUMA topology to the VM. with numa_placement, the VMs of
+    flavors with pin_numa get their cpus and memory pinned to host NUMA nodes local
+    to the candidate PCI devices.
+    returns (placement, host topology), or (None, None) if the VM was not pinned.
+    """
+    properties = machine_info['properties']
+    numa_count = properties.get('numa') or 1
+    cores = properties['cores']
+    if numa_placement and properties.get('pin_numa'):
+        try:
+            topology = numa.HostTopology.read(machine_info["cloud_init"].ssh_client)
+            placement = numa.reserve_numa_placement(
+                pve, hostname, vmid,
+                lambda used_cpus: numa.plan_numa_placement(topology, cores, memory_mb, numa_count,
+                                                           pci_ids=[device['id'] for device in candidate_devices],
+                                                           used_cpus=used_cpus,
+                                                           hugepages=properties.get('hugepages')))
+            logging.info(f"VM {vmid} NUMA placement on {hostname}: {placement}")
+            try:
+                pve.nodes(hostname).qemu(vmid).config.put(**placement.vm_config())
+            except Exception:
+                numa.release_numa_placement(hostname, vmid)
+                raise
+            return placement, topology
+        except (numa.PlacementError, RuntimeError) as ex:
+            logging.warning(f"not pinning VM {vmid} on {hostname}, using unpinned NUMA topology: {ex}")
+    if numa_count > 1:
+        pve.nodes(hostname).qemu(vmid).config.put(**numa.basic_numa_config(cores, numa_count))
+    return None, None
+
+
 def _extract_cluster_version(repo_base_url):
     # repo_base_url example: https://pulp02.lbits/pulp/content/releases/lightbits/3.10.1/rhel/9/67/
     # we want to extract the version from the URL which is 3.10.1 in this example using regex
@@ -353,11 +742,15 @@ def _generate_inventory(ctx, allocation_id,
                         repo_base_url: str,
                         profile_name: str=None,
                         ec_enabled: bool=False,
-                        initial_device_count: int=4):
+                        initial_device_count: int=4,
+                        ansible_profile: str=deploy.DEFAULT_ANSIBLE_PROFILE):
     cluster_vms = utils.list_cluster_vms(ctx.obj.pve,
                                          VMTags().set_role("target").set_allocation(allocation_id))
     logging.info(f"allocation {allocation_id} has {len(cluster_vms)} VMs with role.target tag")
 
+    # tags are written at once for all the VMs, once the inventory is known
+    retag_plan = []
+
     # if we already have cid we will reuse it
     cluster_id = None
     for vm in cluster_vms:
@@ -405,8 +798,7 @@ def _generate_inventory(ctx, allocation_id,
             "vmid": vmid,
             "tags": tags,
         }
-        if tags.str() != vm.get('tags', ""):
-            ctx.obj.pve.nodes(hostname).qemu(vmid).config.put(tags=tags.str())
+        retag_plan.append((vm, tags))
 
     initiator_vms = utils.list_cluster_vms(ctx.obj.pve,
                                            VMTags().set_role("initiator").set_allocation(allocation_id))
@@ -445,15 +837,20 @@ def _generate_inventory(ctx, allocation_id,
             "vmid": vmid,
             "tags": tags,
         }
-        if tags.str() != vm.get('tags', ""):
-            ctx.obj.pve.nodes(hostname).qemu(vmid).config.put(tags=tags.str())
+        retag_plan.append((vm, tags))
+
+    failures = [result for result in retag.apply_retag(ctx.obj.pve, retag_plan) if result.failed()]
+    if failures:
+        raise RuntimeError(f"failed to tag {len(failures)} VMs of allocation {allocation_id}, "
+                           f"first error: {failures[0].error}")
 
     inventory_path = deploy.generate_inventory(allocation_id,
                                                cluster_info, initiators,
                                                repo_base_url, profile_name,
                                                ec_enabled=ec_enabled,
                                                initial_device_count=initial_device_count,
-                                               light_app_path=ctx.obj.config["light_app_path"])
+                                               light_app_path=ctx.obj.config["light_app_path"],
+                                               ansible_profile=ansible_profile)
     logging.info(f"""Inventory files generated at: {inventory_path}
 To deploy the cluster issue following commands:
 
@@ -463,40 +860,105 @@ To deploy the cluster issue following commands:
     return inventory_path
 
 
-def _deploy_lightbits_cluster(ctx, allocation_id, base_url,
-                              profile_name,
-                              run_deploy, stream_output, ec_enabled,
-                              initial_device_count):
-    inventory_path = _generate_inventory(ctx, allocation_id,
-                                         base_url, profile_name, ec_enabled,
-                                         initial_device_count)
-    if run_deploy:
-        deploy.deploy_cluster(inventory_path, stream_output)
-
-
-def _deploy_nvme_initiator(ctx, allocation_id, base_url, run_deploy, stream_output=None):
-    inventory_path = _generate_inventory(ctx, allocation_id, base_url)
-    if run_deploy:
-        deploy.deploy_nvme_initiator(inventory_path, stream_output)
+def _deploy_allocations(command_name, allocation_ids, service, run_deploy, stream_output,
+                        parallelism, generate_inventory, timeout=0, idle_timeout=0):
+    tracer = trace.start(command_name)
+    tracer.metadata["allocation_ids"] = list(allocation_ids)
+    try:
+        runs = []
+        for allocation_id in allocation_ids:
+            run = orchestrator.DeployRun(allocation_id, deploy.inventory_directory(allocation_id), service)
+            try:
+                with trace.span("generate inventory", allocation=allocation_id):
+                    run.inventory_dir = generate_inventory(allocation_id)
+            except Exception as ex:
+                logging.error(f"failed to generate inventory of allocation {allocation_id}: {ex}")
+                run.error = f"inventory: {ex}"
+            runs.append(run)
+        if run_deploy:
+            orchestrator.deploy_allocations(runs, parallelism, stream_output,
+                                            timeout=timeout or None, idle_timeout=idle_timeout or None)
+    finally:
+        _save_trace(trace.stop())
+    if run_deploy or any(run.error for run in runs):
+        print(orchestrator.summary_table(runs))
+    failures = [run for run in runs if run.error or (run_deploy and not run.ok())]
+    if failures:
+        raise click.ClickException(f"{len(failures)} of {len(runs)} deployments failed")
+
+
+def _deploy_lightbits_clusters(ctx, allocation_ids, base_url,
+                               profile_name,
+                               run_deploy, stream_output, ec_enabled,
+                               initial_device_count, parallelism=2, timeout=0, idle_timeout=0,
+                               ansible_profile=deploy.DEFAULT_ANSIBLE_PROFILE):
+    _deploy_allocations("allocations deploy lightbits", allocation_ids,
+                        orchestrator.LIGHTBITS_SERVICE, run_deploy, stream_output, parallelism,
+                        lambda allocation_id: _generate_inventory(ctx, allocation_id,
+                                                                  base_url, profile_name, ec_enabled,
+                                                                  initial_device_count, ansible_profile),
+                        timeout, idle_timeout)
+
+
+def _deploy_nvme_initiators(ctx, allocation_ids, base_url, run_deploy, stream_output=None, parallelism=2,
+                            timeout=0, idle_timeout=0, ansible_profile=deploy.DEFAULT_ANSIBLE_PROFILE):
+    _deploy_allocations("allocations deploy initiator", allocation_ids,
+                        orchestrator.INITIATOR_SERVICE, run_deploy, stream_output, parallelism,
+                        lambda allocation_id: _generate_inventory(ctx, allocation_id, base_url,
+                                                                  ansible_profile=ansible_profile),
+                        timeout, idle_timeout)
+
+
+def _save_trace(tracer: trace.Tracer):
+    allocation_ids = tracer.metadata.get("allocation_ids") or [tracer.metadata.get("allocation_id")]
+    for allocation_id in allocation_ids:
+        if not allocation_id:
+            continue
+        try:
+            trace.save_allocation_trace(tracer, allocation_id)
+        except OSError as ex:
+            logging.warning(f"failed to save trace of allocation {allocation_id}: {ex}")
+        try:
+            store.open_store().record_phases(allocation_id, tracer.name, tracer.phase_totals())
+        except (OSError, sqlite3.Error) as ex:
+            logging.warning(f"failed to record the phase timings of allocation {allocation_id}: {ex}")
+
+
+def _invalidate_state():
+    """the command changed the cluster VMs, have the next read of the local state reconcile it"""
+    try:
+        store.open_store().invalidate()
+    except (OSError, sqlite3.Error) as ex:
+        logging.warning(f"failed to invalidate the local state: {ex}")
 
 
-def _start_vm(pve, hostname, vmid, wait_for_ip, expected_ip_addresses=1, tmo=60, interval=5):
+def _start_vm(pve, hostname, vmid, wait_for_ip, expected_ip_addresses=1, tmo=60, interval=5, reboot=False):
+    """start the VM, or reboot it when it is already running (ex. a running pool VM that was
+    handed out, so it boots with its new identity), and optionally wait for its IP addresses
+    """
     start = time.time()
     ip_address = None
     try:
-        pve.nodes(hostname).qemu(vmid).status.start.post()
-        logging.debug(f"started VM: {vmid}, waiting for it to be running...")
-        status = utils.wait_for_vm_status(pve, hostname, vmid, "running", tmo=tmo, interval=interval)
+        with trace.span("reboot vm" if reboot else "start vm", node=hostname, vmid=vmid):
+            if reboot:
+                upid = pve.nodes(hostname).qemu(vmid).status.reboot.post()
+            else:
+                upid = pve.nodes(hostname).qemu(vmid).status.start.post()
+            logging.debug(f"starting VM: {vmid}, waiting for it to be running...")
+            tasks.wait_for_task(pve, upid, tmo=tmo)
+        status = "running"
         if wait_for_ip:
             logging.debug(f"VM: {vmid}, waiting for it to have {expected_ip_addresses} IP addresses...")
-            ip_address = utils.get_vm_ip_address(pve, hostname, vmid,
-                                                 expected_ip_addresses,
-                                                 tmo=120, interval=interval)
+            with trace.span("wait for ip", node=hostname, vmid=vmid):
+                ip_address = utils.get_vm_ip_address(pve, hostname, vmid,
+                                                     expected_ip_addresses,
+                                                     tmo=120, interval=interval)
     except Exception as ex:
         logging.error(f"failed to start VM {hostname}:{vmid}: {str(ex)}")
         raise ex
     return {
         "vmid": vmid,
+        "node": hostname,
         "ip_address": ip_address,
         "status": status,
         "elapsed_time": time.time() - start,
@@ -510,7 +972,7 @@ def generate_vm_name(node_name, allocation_id, machine_name):
 def _create_vm_from_image(pve, hostname, storage_id,
                 start_vm, tags, wait_for_ip,
                 ssh_username, ssh_password,
-                machine_info):
+                machine_info, clone_mode="linked"):
     allocation_info = {
         "allocation_id": str(uuid.uuid4())[:4],
         "servers": []
@@ -536,7 +998,8 @@ def _create_vm_from_image(pve, hostname, storage_id,
     # Get the next VM ID
     vmid = _create_vm_on_proxmox(pve, hostname, custom_user_data,
                                  storage_id, vm_hostname,
-                                 machine_info["name"], machine_info, new_tags)
+                                 machine_info["name"], machine_info, new_tags,
+                                 clone_mode=clone_mode)
     if not vmid:
         logging.error(f"failed to allocate VM: {vm_hostname} named: {machine_info["name"]}")
         return None
@@ -546,7 +1009,8 @@ def _create_vm_from_image(pve, hostname, storage_id,
         expected_ip_addresses = 2
         args = [(pve, hostname, vmid, wait_for_ip, expected_ip_addresses) for vmid in vmids]
         vm_info = threadpool.run_with_threadpool(_start_vm, args,
-                                                 desc="starting VMs", max_workers=10)
+                                                 desc="starting VMs", max_workers=10,
+                                                 node_of=lambda job_args: job_args[1])
         allocation_info["servers"].extend(vm_info)
     else:
         for vmid in vmids:
@@ -556,101 +1020,274 @@ def _create_vm_from_image(pve, hostname, storage_id,
     return allocation_info
 
 
+def _plan_allocation(pve, hostname, storage_id, allocation_descriptor, types,
+                     nodes=None, placement_policy="spread", anti_affinity=True,
+                     cpu_overcommit=4.0, clone_mode="linked", preflight=True, pinned=None):
+    """returns ({machine name: node}, CapacityReport) of the descriptor's machines, placed on
+    HOSTNAME or scheduled across the nodes. pinned {machine name: node} are machines that
+    already exist (ex. handed out from the warm pool), they are only taken into account for
+    anti-affinity. the report is None when preflight is disabled or there is nothing to create.
+    """
+    pinned = pinned or {}
+    boot_disk_bytes = utils.convert_size_to_bytes(minimum_boot_disk_size)
+    all_demands = capacity.machine_demands(allocation_descriptor, types, boot_disk_bytes)
+    demands = [demand for demand in all_demands if demand.name not in pinned]
+    placement = dict(pinned)
+    if not demands:
+        return placement, None
+    if hostname:
+        placement.update({demand.name: hostname for demand in demands})
+        if not preflight:
+            return placement, None
+        capacities = capacity.demand_capacities(pve, storage_id, demands, [hostname], cpu_overcommit)
+    else:
+        with trace.span("schedule"):
+            capacities = capacity.demand_capacities(pve, storage_id, demands, nodes, cpu_overcommit)
+            # scheduling consumes the capacities, the preflight checks the placement against the snapshot
+            scheduling = {node: node_capacity.copy() for node, node_capacity in capacities.items()}
+            for demand in all_demands:
+                if pinned.get(demand.name) in scheduling:
+                    scheduling[pinned[demand.name]].pin(demand)
+            placement.update(scheduler.schedule(demands, scheduling, placement_policy, anti_affinity))
+        logging.info(f"machines placement ({placement_policy}): {placement}")
+        if not preflight:
+            return placement, None
+    with trace.span("preflight"):
+        report = capacity.preflight(pve, storage_id, demands, placement, capacities, clone_mode)
+    return placement, report
+
+
+def _machine_tags(node_name, vm_hostname, machine, allocation_id):
+    tags = VMTags().\
+        set_node(node_name).\
+        set_vm_name(vm_hostname).\
+        set_role(machine["role"]).\
+        set_allocation(allocation_id)
+    for annotation_key, annotation_value in machine.get('annotations', {}).items():
+        tags.set_tag(annotation_key, annotation_value)
+    return tags
+
+
+def _claim_pool_vms(pve, hostname, allocation_id, allocation_descriptor, anti_affinity=True):
+    """claim ready pool VMs for the descriptor's machines, on HOSTNAME only when given.
+    returns {machine name: (PoolVM, previous config)}, machines that are not in it are to be created.
+    """
+    pool_vms = [pool_vm for pool_vm in warm_pool.list_pool_vms(pve) if not hostname or pool_vm.node == hostname]
+    machines = {machine["name"]: machine for machine in allocation_descriptor["machines"]}
+    matches = warm_pool.match_machines(machines.values(), pool_vms, anti_affinity)
+    claims = {}
+    for machine_name, pool_vm in matches.items():
+        vm_hostname = generate_vm_name(pool_vm.node, allocation_id, machine_name)
+        claims[machine_name] = (pool_vm, _machine_tags(pool_vm.node, vm_hostname, machines[machine_name], allocation_id),
+                                vm_hostname)
+    claimed = warm_pool.claim_pool_vms(pve, claims)
+    logging.info(f"handing out {len(claimed)} of {len(machines)} machines from the warm pool")
+    return claimed
+
+
+def _hand_out_pool_vm(pve, node_name, vmid, custom_user_data, storage_id, vm_name,
+                      machine_name, machine_info, allocation_id):
+    """give a claimed pool VM the identity of the machine, both take effect on its next boot:
+    the cloud-init user data - PVE derives the instance-id from it, so cloud-init runs again
+    and sets the new hostname - and the serials of its emulated ssds.
+    """
+    ci: ci_snippets.CloudInit = machine_info["cloud_init"]
+    ci.upload_user_data(vmid, ci.create_user_data(vm_name, custom_user_data))
+    ssds = machine_info['properties'].get('ssds') or {}
+    if ssds.get('type') == "emulated":
+        pve.nodes(node_name).qemu(vmid).config.put(args=create_args_string(vmid, ssds["count"], storage_id,
+                                                                           allocation_id, machine_name,
+                                                                           flavors.get_ssd_profile(ssds)))
+
+
 def _create_vms(pve, hostname, storage_id,
                 start_vm, tags, wait_for_ip,
                 ssh_username, ssh_password,
-                allocation_descriptor_name):
+                allocation_descriptor_name, clone_mode="linked",
+                numa_placement=True, nodes=None,
+                placement_policy="spread", anti_affinity=True,
+                cpu_overcommit=4.0, preflight=True, use_pool=False):
     allocation_info = {
         "allocation_id": str(uuid.uuid4())[:4],
         "servers": []
     }
+    trace.current().metadata["allocation_id"] = allocation_info["allocation_id"]
 
     allocation_descriptor = allocation_descriptors.allocation_descriptor_by_name(allocation_descriptor_name)
     if not allocation_descriptor:
         logging.error(f"allocation descriptor not found: {allocation_descriptor_name}")
         return None
 
-    ssh_client = ssh.SSHClient(hostname, ssh_username, ssh_password)
-    vmids = []
     types = flavors.list_machine_types()
-    for machine in allocation_descriptor["machines"]:
-        machine_type = machine["machine_type"]
-        machine_info = types['machine_types'][machine_type]
-        machine_info["annotations"] = machine.get('annotations', {})
-
-        vm_hostname = generate_vm_name(hostname, allocation_info["allocation_id"], machine["name"])
-
-        ci = ci_snippets.CloudInit(ssh_client, storage_id)
-        machine_info["cloud_init"] = ci
-        custom_user_data = ci_snippets.generate_custom_photon_cloud_init() if machine_type == "photon" else None
-
-        new_tags = VMTags().\
-            set_node(hostname).\
-            set_vm_name(vm_hostname).\
-            set_role(machine["role"]).\
-            set_allocation(allocation_info["allocation_id"])
-
-        for annotation_key, annotation_value in machine_info["annotations"].items():
-            new_tags.set_tag(annotation_key, annotation_value)
-
-        # Get the next VM ID
-        vmid = _create_vm_on_proxmox(pve, hostname, custom_user_data,
-                                     storage_id, vm_hostname,
-                                     machine["name"], machine_info, new_tags)
-        if not vmid:
-            logging.error(f"failed to allocate VM: {vm_hostname}")
-            return None
-        vmids.append(vmid)
-
-    if start_vm or wait_for_ip:
-        expected_ip_addresses = 2
-        args = [(pve, hostname, vmid, wait_for_ip, expected_ip_addresses) for vmid in vmids]
-        vm_info = threadpool.run_with_threadpool(_start_vm, args,
-                                                 desc="starting VMs", max_workers=10)
-        allocation_info["servers"].extend(vm_info)
-    else:
-        for vmid in vmids:
-            allocation_info["servers"].append({"vmid": vmid})
-
-    ssh_client.close()
+    pooled = {}
+    ssh_clients = {}
+    vms = []
+    handed_out = False
+    try:
+        if use_pool:
+            with trace.span("claim pool vms"):
+                pooled = _claim_pool_vms(pve, hostname, allocation_info["allocation_id"],
+                                         allocation_descriptor, anti_affinity)
+        placement, report = _plan_allocation(pve, hostname, storage_id, allocation_descriptor, types,
+                                             nodes, placement_policy, anti_affinity, cpu_overcommit,
+                                             clone_mode, preflight,
+                                             pinned={name: pool_vm.node for name, (pool_vm, _) in pooled.items()})
+        if report is not None and not report.ok():
+            raise capacity.CapacityError(report)
+
+        for machine in allocation_descriptor["machines"]:
+            node_name = placement[machine["name"]]
+            if node_name not in ssh_clients:
+                ssh_clients[node_name] = ssh.SSHClient(node_name, ssh_username, ssh_password)
+
+            machine_type = machine["machine_type"]
+            machine_info = types['machine_types'][machine_type]
+            machine_info["annotations"] = machine.get('annotations', {})
+
+            vm_hostname = generate_vm_name(node_name, allocation_info["allocation_id"], machine["name"])
+
+            ci = ci_snippets.CloudInit(ssh_clients[node_name], storage_id)
+            machine_info["cloud_init"] = ci
+            custom_user_data = ci_snippets.generate_custom_photon_cloud_init() if machine_type == "photon" else None
+
+            if machine["name"] in pooled:
+                pool_vm, _ = pooled[machine["name"]]
+                with trace.span("hand out pool vm", node=node_name, machine=machine["name"]):
+                    _hand_out_pool_vm(pve, node_name, pool_vm.vmid, custom_user_data, storage_id,
+                                      vm_hostname, machine["name"], machine_info,
+                                      allocation_info["allocation_id"])
+                vms.append((node_name, pool_vm.vmid, pool_vm.running()))
+                continue
+
+            new_tags = _machine_tags(node_name, vm_hostname, machine, allocation_info["allocation_id"])
+
+            # Get the next VM ID
+            with trace.span("create vm", node=node_name, machine=machine["name"]):
+                vmid = _create_vm_on_proxmox(pve, node_name, custom_user_data,
+                                             storage_id, vm_hostname,
+                                             machine["name"], machine_info, new_tags,
+                                             clone_mode=clone_mode,
+                                             numa_placement=numa_placement)
+            if not vmid:
+                logging.error(f"failed to allocate VM: {vm_hostname}")
+                return None
+            vms.append((node_name, vmid, False))
+
+        if start_vm or wait_for_ip:
+            expected_ip_addresses = 2
+            args = [(pve, node_name, vmid, wait_for_ip, expected_ip_addresses, 60, 5, reboot)
+                    for node_name, vmid, reboot in vms]
+            executor = threadpool.JobExecutor("starting VMs", max_workers=32,
+                                              node_of=lambda job_args: job_args[1])
+            results = executor.run_all(_start_vm, args)
+            allocation_info["servers"].extend([result.result for result in results if result.ok()])
+            if not all(result.ok() for result in results):
+                raise threadpool.JobsFailed("starting VMs", results)
+        else:
+            for node_name, vmid, _ in vms:
+                allocation_info["servers"].append({"vmid": vmid, "node": node_name})
+        handed_out = True
+    finally:
+        if not handed_out:
+            # failed, or returned early: the claimed VMs go back to the pool
+            warm_pool.release_pool_vms(pve, pooled)
+        for ssh_client in ssh_clients.values():
+            ssh_client.close()
     return allocation_info
 
 
-def _delete_allocations(pve, storage_id, ssh_username, ssh_password, tags: VMTags):
-    vms = utils.list_cluster_vms(pve, tags)
-
-    def _del_allocation(vm):
-        vmid = vm.get('vmid')
-        hostname = vm.get('node')
-        ssh_client = ssh.SSHClient(hostname, ssh_username, ssh_password)
-        _delete_allocation(pve, ssh_client, hostname, storage_id, vmid)
-        ssh_client.close()
-
-    args = [(vm,) for vm in vms]
-    threadpool.run_with_threadpool(_del_allocation,
-                                   args,
-                                   desc="deleting VMs", max_workers=10)
-
-
-def create_args_string(vmid, disk_count, storage_id, allocation_id, vm_name):
+def _build_pool_vm(pve, ssh_pool: ssh.SSHPool, node_name, storage_id, flavor, types, state,
+                   clone_mode="linked", numa_placement=True):
+    """create a pool VM of the flavor and boot it once, so it is known to come up.
+    it is tagged as building until then, and destroyed if any step fails.
+    """
+    vm_hostname = generate_vm_name(node_name, "pool", f"{flavor}-{str(uuid.uuid4())[:4]}")
+    tags = VMTags().\
+        set_node(node_name).\
+        set_vm_name(vm_hostname).\
+        set_pool(flavor).\
+        set_tag(warm_pool.BUILDING_TAG, "1")
+    ci = ci_snippets.CloudInit(ssh_pool.get(node_name), storage_id)
+    machine_info = dict(types['machine_types'][flavor], annotations={}, cloud_init=ci)
+    custom_user_data = ci_snippets.generate_custom_photon_cloud_init() if flavor == "photon" else None
+    vmid = _create_vm_on_proxmox(pve, node_name, custom_user_data, storage_id, vm_hostname,
+                                 flavor, machine_info, tags, clone_mode=clone_mode,
+                                 numa_placement=numa_placement)
+    if not vmid:
+        raise RuntimeError(f"failed to create pool VM {vm_hostname}")
+    try:
+        _start_vm(pve, node_name, vmid, True, expected_ip_addresses=2)
+        if state == "stopped":
+            upid = pve.nodes(node_name).qemu(vmid).status.shutdown.post()
+            tasks.wait_for_task(pve, upid, tmo=120)
+        tags.get_tags().pop(warm_pool.BUILDING_TAG)
+        pve.nodes(node_name).qemu(vmid).config.put(tags=tags.str())
+    except Exception:
+        teardown.teardown_vms(pve, [{"node": node_name, "vmid": vmid, "name": vm_hostname}],
+                              storage_id, ssh_pool.username, ssh_pool.password)
+        raise
+    logging.info(f"pool VM {node_name}:{vmid} ({flavor}) is ready, {state}")
+    return {"vmid": vmid, "node": node_name, "flavor": flavor, "name": vm_hostname}
+
+
+def _fill_pool(pve, sizes: dict, storage_id, state, ssh_username, ssh_password,
+               nodes=None, clone_mode="linked", numa_placement=True,
+               placement_policy="spread", cpu_overcommit=4.0, parallelism=4):
+    """build the pool VMs missing to reach sizes {flavor: count}, returns a JobResult per VM built"""
+    types = flavors.list_machine_types()
+    unknown = [flavor for flavor in sizes if flavor not in types['machine_types']]
+    if unknown:
+        raise ValueError(f"unknown flavors: {unknown}, must be one of {list(types['machine_types'])}")
+    pool_vms = warm_pool.list_pool_vms(pve)
+    missing = warm_pool.deficits(pool_vms, sizes)
+    if not missing:
+        logging.debug("warm pool is full")
+        return []
+
+    # existing pool VMs are pinned, so new VMs of a flavor are spread away from them
+    existing = {f"{pool_vm.flavor}-{pool_vm.vmid}": pool_vm for pool_vm in pool_vms
+                if pool_vm.flavor in types['machine_types']}
+    machines = [{"name": name, "role": "pool", "machine_type": pool_vm.flavor, "failure_domain": pool_vm.flavor}
+                for name, pool_vm in existing.items()]
+    machines += [{"name": f"{flavor}-new{idx}", "role": "pool", "machine_type": flavor, "failure_domain": flavor}
+                 for flavor, count in missing.items() for idx in range(count)]
+    placement, report = _plan_allocation(pve, None, storage_id, {"machines": machines}, types,
+                                         nodes, placement_policy, True, cpu_overcommit, clone_mode,
+                                         pinned={name: pool_vm.node for name, pool_vm in existing.items()})
+    if report is not None and not report.ok():
+        raise capacity.CapacityError(report)
+
+    with ssh.SSHPool(ssh_username, ssh_password) as ssh_pool:
+        args = [(pve, ssh_pool, placement[machine["name"]], storage_id, machine["machine_type"], types,
+                 state, clone_mode, numa_placement)
+                for machine in machines if machine["name"] not in existing]
+        # a build does not hold a node slot, its API and ssh operations take them
+        executor = threadpool.JobExecutor(f"building {len(args)} pool VMs", max_workers=parallelism)
+        return executor.run_all(_build_pool_vm, args)
+
+
+def create_args_string(vmid, disk_count, storage_id, allocation_id, vm_name, profile: dict=None):
+    """QEMU args attaching the emulated ssds as NVMe devices, tuned by the flavor's ssd profile"""
+    profile = profile or {}
     images_path = utils.get_images_path(storage_id)
+    drive_options = ""
+    for key in ["aio", "cache", "discard", "detect_zeroes"]:
+        if key in profile:
+            drive_options += f",{key.replace('_', '-')}={profile[key]}"
+    device_options = ""
+    if profile.get("ioeventfd"):
+        # doorbell writes handled through eventfds instead of trapping into the vcpu thread
+        device_options += ",ioeventfd=on"
+    if "num_queues" in profile:
+        device_options += f",max_ioqpairs={profile['num_queues']}"
+    for key in ["logical_block_size", "physical_block_size"]:
+        if key in profile:
+            device_options += f",{key}={profile[key]}"
+
     args = ""
     for i in range(disk_count):
         idx = f"{i:02d}"
         serial_number = f"{allocation_id}-{vm_name}"
-        args += f" -drive file={images_path}/{vmid}/nvme{idx}.raw,if=none,id=nvme{idx} -device nvme,drive=nvme{idx},serial={serial_number}-nvme{idx}"
+        args += f" -drive file={images_path}/{vmid}/nvme{idx}.raw,if=none,id=nvme{idx}{drive_options}"\
+                f" -device nvme,drive=nvme{idx},serial={serial_number}-nvme{idx}{device_options}"
     return args
-
-
-def _delete_allocation(pve, ssh_client: ssh.SSHClient, hostname, storage_id, vmid):
-    # stop the VM if started
-    try:
-        pve.nodes(hostname).qemu(vmid).status.stop.post(timeout=60)
-        utils.wait_for_vm_status(pve, hostname, vmid, "stopped")
-        utils.delete_emulated_ssds(pve, hostname, vmid, storage_id)
-        pve.nodes(hostname).qemu(vmid).delete()
-
-        ci = ci_snippets.CloudInit(ssh_client, storage_id)
-        ci.delete_cloud_init_data_files(vmid)
-    except Exception as ex:
-        logging.error(f"failed to delete allocation {hostname}:{vmid}: {str(ex)}")
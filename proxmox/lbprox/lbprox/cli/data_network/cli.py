@@ -2,6 +2,9 @@ import logging
 import time
 import click
 
+from lbprox.common import sdn
+from lbprox.common import tasks
+
 
 @click.group("data-network")
 def data_network_group():
@@ -17,9 +20,17 @@ def data_network_group():
               help="dhcp range in start-address=IP,end-address=IP format (default: ['start-address=10.101.1.10,end-address=10.101.1.200']")
 @click.option('--nodes', multiple=True, default=None,
               help="list of nodes to add to the zone - (default: all nodes)")
+@click.option('--timeout', default=300, type=int, show_default=True,
+              help="seconds to wait for the zone to become available on all nodes")
 @click.pass_context
-def create_data_network(ctx, zone_name, subnet, gateway, dhcp_range, nodes):
-    print(_create_data_network(ctx.obj.pve, zone_name, subnet, gateway, dhcp_range, nodes))
+def create_data_network(ctx, zone_name, subnet, gateway, dhcp_range, nodes, timeout):
+    try:
+        statuses = _create_data_network(ctx.obj.pve, zone_name, subnet, gateway, dhcp_range, nodes, timeout)
+    except sdn.SDNNotReady as ex:
+        print(sdn.status_table(ex.statuses))
+        raise click.ClickException(str(ex))
+    if statuses:
+        print(sdn.status_table(statuses))
 
 
 @data_network_group.command("delete")
@@ -29,9 +40,17 @@ def delete_data_network(ctx, zone_name):
     _delete_data_network(ctx.obj.pve, zone_name)
 
 
-def _create_data_network(pve, zone_name, subnet: str, gateway: str, dhcp_range: list, nodes: list):
-    node_list = nodes if nodes else pve.nodes.get()
-    node_names = [node.get('node') for node in node_list]
+def _apply_sdn(pve, node_names, zone_name, vnets, timeout):
+    upid = pve.cluster.sdn.put()
+    start = time.time()
+    if upid:
+        tasks.wait_for_task(pve, upid, tmo=timeout)
+    return sdn.wait_for_zone(pve, node_names, zone_name, vnets,
+                             timeout=max(1, timeout - (time.time() - start)))
+
+
+def _create_data_network(pve, zone_name, subnet: str, gateway: str, dhcp_range: list, nodes: list, timeout=300):
+    node_names = list(nodes) if nodes else [node.get('node') for node in pve.nodes.get()]
     existing_zones = pve.cluster.sdn.zones.get()
     existing_zone = next(iter([zone for zone in existing_zones if zone.get('zone') == zone_name]), None)
     if existing_zone:
@@ -39,10 +58,10 @@ def _create_data_network(pve, zone_name, subnet: str, gateway: str, dhcp_range:
         existing_nodes_list = existing_zone.get('nodes').split(',') if existing_zone.get('nodes') else []
         if set(node_names) == set(existing_nodes_list):
             logging.debug(f"zone: {zone_name} already exists with the same nodes, nothing to do")
-            return
-        else:
-            logging.debug(f"zone: {zone_name} already exists with different nodes, updating it")
-            pve.cluster.sdn.zones.put(zone=zone_name, nodes=node_names)
+            return None
+        logging.debug(f"zone: {zone_name} already exists with different nodes, updating it")
+        pve.cluster.sdn.zones(zone_name).put(nodes=",".join(node_names))
+        vnets = [vnet.get('vnet') for vnet in pve.cluster.sdn.vnets.get() if vnet.get('zone') == zone_name]
     else:
         logging.debug(f"zone {zone_name} does not exist, creating it")
         pve.cluster.sdn.zones.post(zone=zone_name, type="simple", nodes=node_names, dhcp="dnsmasq", ipam="pve")
@@ -50,25 +69,9 @@ def _create_data_network(pve, zone_name, subnet: str, gateway: str, dhcp_range:
         pve.cluster.sdn.vnets(zone_name).subnets.post(**{"dhcp-range": dhcp_range},
                                                     subnet=subnet, type="subnet",
                                                     snat=1, gateway=gateway)
-        # apply the changes
-        pve.cluster.sdn.put()
-        while True:
-            active_node_zones = []
-            for node_name in node_names:
-                if node_name in active_node_zones:
-                    continue
-                node_zone = pve.nodes(node_name).sdn.zones(zone_name).content.get()
-                if node_zone[0].get('status') == "pending":
-                    time.sleep(3)
-                    break
-                elif node_zone[0].get('status') == "error":
-                    raise RuntimeError(f"failed to create zone: {zone_name} on node: {node_name}")
-                elif node_zone[0].get('status') == "available":
-                    active_node_zones.append(node_name)
-                    logging.debug(f"zone: {zone_name} created on node: {node_name}")
-            if len(active_node_zones) == len(node_names):
-                logging.debug(f"zones created and available on all nodes")
-                break
+        vnets = [zone_name]
+    # apply the changes and wait for the zone, its vnets and subnets on every node
+    return _apply_sdn(pve, node_names, zone_name, vnets, timeout)
 
 
 def _delete_data_network(pve, zone_name):
@@ -86,4 +89,6 @@ def _delete_data_network(pve, zone_name):
                 pve.cluster.sdn.vnets(vnet_name).delete()
         pve.cluster.sdn.zones(zone_name).delete()
         # apply the changes
-        pve.cluster.sdn.put()
+        upid = pve.cluster.sdn.put()
+        if upid:
+            tasks.wait_for_task(pve, upid)
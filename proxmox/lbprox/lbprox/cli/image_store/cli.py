@@ -1,28 +1,66 @@
 import click
+import concurrent.futures
 import re
 import logging
+
+from prettytable import PrettyTable
+
+from lbprox.common import tasks
+from lbprox.common import threadpool
 from lbprox.common import utils
 
 
+# filesystems the proxmox directory storage API can create
+FILESYSTEMS = ["ext4", "xfs"]
+
+
 @click.group('image-store')
 def image_store_group():
     pass
 
 
+def _parse_device_map(ctx, param, values):
+    device_map = {}
+    for value in values:
+        node, sep, device = value.partition("=")
+        if not sep or not node or not device:
+            raise click.BadParameter(f"expected node=/dev/device, got: {value}")
+        device_map[node] = device
+    return device_map
+
+
 @image_store_group.command("create", help="Create a directory storage on all nodes in the cluster")
-@click.argument('hostname', required=True)
+@click.argument('hostnames', nargs=-1, required=False)
 @click.option('-s', '--storage-id', required=False, default="lb-local-storage",
               help="storage name to create")
-@click.option('-d', '--block-device', required=True, type=str,
-              help="block device in the form of /dev/sdX")
+@click.option('-d', '--block-device', required=False, type=str, default=None,
+              help="block device in the form of /dev/sdX, used on every node without a --device-map entry")
+@click.option('-m', '--device-map', multiple=True, callback=_parse_device_map,
+              help="block device of a specific node, ex: -m rack16-server02=/dev/nvme1n1")
+@click.option('-f', '--filesystem', type=click.Choice(FILESYSTEMS), default="ext4", show_default=True,
+              help="filesystem to create, xfs suits large image files better")
+@click.option('--timeout', default=1800, type=int, show_default=True,
+              help="seconds to wait for the filesystems to be created")
 @click.pass_context
-def create_image_storage(ctx, hostname, storage_id, block_device):
-    """verify that the block device is valid and exists on all hosts in the cluster before creating the storage
-    for each node in the cluster, create a directory storage with the given block device
-    after successfully creating the storage on all nodes, add the storage to the cluster
+def create_image_storage(ctx, hostnames, storage_id, block_device, device_map, filesystem, timeout):
+    """verify that the block devices are valid and exist on all the nodes (default: all nodes in the cluster)
+    before creating the storage. the directory storages are created on all nodes in parallel,
+    after successfully creating them on all nodes the storage is added to the cluster
     """
-    assert re.match(r'^/dev/[a-zA-Z0-9\/]+$', block_device), f"invalid block device: {block_device}"
-    _create_image_storage(ctx.obj.pve, hostname, storage_id, block_device)
+    node_names = list(hostnames) if hostnames else [node['node'] for node in ctx.obj.pve.nodes.get()]
+    devices = {}
+    for node_name in node_names:
+        device = device_map.get(node_name, block_device)
+        if not device:
+            raise click.UsageError(f"no block device for node {node_name}, use --block-device or --device-map")
+        if not re.match(r'^/dev/[a-zA-Z0-9\/]+$', device):
+            raise click.BadParameter(f"invalid block device: {device}")
+        devices[node_name] = device
+    results = _create_image_storage(ctx.obj.pve, devices, storage_id, filesystem, timeout)
+    print(_results_table(results))
+    failures = [result for result in results if result.failed()]
+    if failures:
+        raise click.ClickException(f"failed to create storage {storage_id} on {len(failures)} of {len(results)} nodes")
 
 
 # @image_store_group.command("create")
@@ -40,8 +78,10 @@ def create_image_storage(ctx, hostname, storage_id, block_device):
 @image_store_group.command("delete")
 @click.option('-s', '--storage-id', required=False, default="lb-local-storage",
               help="storage name to delete")
+@click.option('--timeout', default=600, type=int, show_default=True,
+              help="seconds to wait for the directories to be removed")
 @click.pass_context
-def delete_image_storage(ctx, storage_id):
+def delete_image_storage(ctx, storage_id, timeout):
     """
     Deletes the image storage with the given storage_id.
 
@@ -49,36 +89,160 @@ def delete_image_storage(ctx, storage_id):
     - ctx: The context object.
     - storage_id: The ID of the image storage to delete.
     """
-    _delete_image_storage(ctx.obj.pve, storage_id)
+    results = _delete_image_storage(ctx.obj.pve, storage_id, timeout)
+    print(_results_table(results))
+    failures = [result for result in results if result.failed()]
+    if failures:
+        raise click.ClickException(f"failed to delete storage {storage_id} on {len(failures)} of {len(results)} nodes")
+
+
+class NodeStorageResult(object):
+    def __init__(self, node, device=None):
+        self.node = node
+        self.device = device
+        self.action = None
+        self.error = None
+        self.upid = None
+
+    def failed(self):
+        return self.error is not None
+
+
+def _results_table(results):
+    table = PrettyTable()
+    table.field_names = ["node", "device", "action", "error"]
+    table.align = "l"
+    for result in results:
+        table.add_row([result.node, result.device or "", result.action or "", result.error or ""])
+    return table
+
+
+def _wait_for_node_tasks(pve, results, tmo):
+    """wait for the upids of the results concurrently, recording failures per node"""
+    futures = {result.node: tasks.track(pve, result.upid) for result in results if result.upid}
+    concurrent.futures.wait(futures.values(), timeout=tmo)
+    for result in results:
+        future = futures.get(result.node)
+        if future is None:
+            continue
+        if not future.done():
+            future.cancel()
+            result.error = f"timed out ({tmo}s) waiting for task {future.upid}"
+        elif future.exception():
+            result.error = str(future.exception())
+
+
+def _validate_node(pve, node_name, device, storage_id):
+    result = NodeStorageResult(node_name, device)
+    if any(storage.get('storage') == storage_id and storage.get('active')
+           for storage in pve.nodes(node_name).storage.get()):
+        result.action = "exists"
+        return result
+    disks = {disk.get('devpath'): disk for disk in pve.nodes(node_name).disks().list().get()}
+    disk = disks.get(device)
+    if disk is None:
+        result.error = f"block device {device} does not exist, exists: {sorted(disks)}"
+    elif disk.get('used'):
+        result.error = f"block device {device} is in use: {disk.get('used')}"
+    else:
+        result.action = "create"
+    return result
 
 
 # look at POST https://pve.proxmox.com/pve-docs/api-viewer/index.html#/nodes/{node}/disks/directory
-def _create_image_storage(pve, nodename, storage_id, block_device):
-    if utils.get_storage_info(pve, nodename, storage_id): # storage already exists
+def _create_image_storage(pve, devices: dict, storage_id, filesystem="ext4", tmo=1800):
+    """devices maps every node to the block device of its directory storage.
+    nothing is created unless the devices are valid on all nodes.
+    """
+    executor = threadpool.JobExecutor(f"validating block devices of {len(devices)} nodes",
+                                      max_workers=len(devices), node_of=lambda args: args[1])
+    results = {}
+    for job_result in executor.run(_validate_node, [(pve, node, device, storage_id)
+                                                   for node, device in devices.items()]):
+        if job_result.ok():
+            results[job_result.result.node] = job_result.result
+        else:
+            node, device = job_result.args[1], job_result.args[2]
+            results[node] = NodeStorageResult(node, device)
+            results[node].error = str(job_result.exception)
+    results = [results[node] for node in devices]
+    if any(result.failed() for result in results):
+        return results
+
+    to_create = [result for result in results if result.action == "create"]
+    for result in to_create:
+        try:
+            result.upid = pve.nodes(result.node).disks().directory.post(name=storage_id,
+                                                                        device=result.device,
+                                                                        filesystem=filesystem)
+        except Exception as ex:
+            result.error = str(ex)
+    # the storage can only be registered once the filesystems are created and mounted
+    _wait_for_node_tasks(pve, to_create, tmo)
+    if any(result.failed() for result in results):
+        return results
+
+    _register_storage(pve, storage_id, devices)
+    return results
+
+
+def _register_storage(pve, storage_id, node_names):
+    """add the storage to the cluster config, restricted to node_names unless those are all
+    the nodes. a storage already restricted to some nodes is extended with node_names.
+    """
+    cluster_nodes = {node['node'] for node in pve.nodes.get()}
+    existing = next(iter([storage for storage in pve.storage.get() if storage.get('storage') == storage_id]), None)
+    if existing is None:
+        options = {} if set(node_names) == cluster_nodes else {"nodes": ",".join(node_names)}
+        pve.storage.create(storage=storage_id, path=utils.get_storage_path(storage_id),
+                           type="dir", content="iso,images,snippets", **options)
+        logging.info(f"storage {storage_id} registered on {len(node_names)} nodes")
+        return
+    if not existing.get('nodes'):
+        # already available on all nodes
+        return
+    nodes = {node.strip() for node in existing['nodes'].split(",") if node.strip()}
+    if set(node_names) <= nodes:
         return
-    disks = pve.nodes(nodename).disks().list().get()
-    devpaths = [disk.get('devpath') for disk in disks]
-    if block_device not in devpaths:
-        raise ValueError(f"block device {block_device} does not exist on node {nodename}, exists: {devpaths}")
+    nodes |= set(node_names)
+    if nodes >= cluster_nodes:
+        pve.storage(storage_id).put(delete="nodes")
+    else:
+        pve.storage(storage_id).put(nodes=",".join(sorted(nodes)))
+    logging.info(f"storage {storage_id} extended to {len(nodes)} nodes")
 
-    pve.nodes(nodename).disks().directory.post(name=storage_id,
-                                                    device=block_device,
-                                                    filesystem="ext4")
 
+def _find_directory(pve, node_name, storage_id):
     storage_path = utils.get_storage_path(storage_id)
-    pve.storage().create(storage=storage_id, path=storage_path,
-                         type="dir", content="iso,images,snippets")
+    directories = pve.nodes(node_name).disks().directory().get()
+    return next(iter([directory for directory in directories if directory['path'] == storage_path]), None)
 
 
 # look at DELETE https://pve.proxmox.com/pve-docs/api-viewer/index.html#/nodes/{node}/disks/directory/{name}
-def _delete_image_storage(pve, storage_id):
-    node_list = pve.nodes().get()
-    for node in node_list:
-        node_name = node['node']
-        directories = pve.nodes(node_name).disks().directory().get()
-        for directory in directories:
-            if storage_id in directory['path']:
-                pve.nodes(node_name).disks().directory(storage_id).delete(**{"cleanup-disks": 1, "cleanup-config": 1})
-                logging.debug(f"deleting storage {storage_id} on node {node_name}")
-                break
-    pve.storage(storage_id).delete()
+def _delete_image_storage(pve, storage_id, tmo=600):
+    node_names = [node['node'] for node in pve.nodes().get()]
+    executor = threadpool.JobExecutor(f"looking up storage {storage_id} on {len(node_names)} nodes",
+                                      max_workers=len(node_names), node_of=lambda args: args[1])
+    results = []
+    for job_result in executor.run(_find_directory, [(pve, node_name, storage_id) for node_name in node_names]):
+        result = NodeStorageResult(job_result.args[1])
+        if not job_result.ok():
+            result.error = str(job_result.exception)
+        elif job_result.result is None:
+            result.action = "absent"
+        else:
+            result.device = job_result.result.get('device')
+            result.action = "delete"
+            try:
+                logging.debug(f"deleting storage {storage_id} on node {result.node}")
+                result.upid = pve.nodes(result.node).disks().directory(storage_id).delete(
+                    **{"cleanup-disks": 1, "cleanup-config": 1})
+            except Exception as ex:
+                result.error = str(ex)
+        results.append(result)
+    _wait_for_node_tasks(pve, [result for result in results if result.action == "delete"], tmo)
+    results.sort(key=lambda result: node_names.index(result.node))
+    # cleanup-config drops storages configured for a single node, remove it if it is still there
+    if any(storage.get('storage') == storage_id for storage in pve.storage.get()):
+        pve.storage(storage_id).delete()
+    return results
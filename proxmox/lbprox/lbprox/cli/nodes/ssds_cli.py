@@ -2,6 +2,7 @@ import json
 import click
 
 from lbprox.common import utils
+from lbprox.ssh import ssh
 
 
 @click.group("ssds")
@@ -26,11 +27,22 @@ nodes_ssds_group.add_command(ssds_physical_group)
 @click.argument('hostname', required=True)
 @click.argument('vmid')
 @click.option('--storage-id', required=False, default="lb-local-storage")
-@click.option('--disk_count', required=True)
-@click.option('--size', required=True)
+@click.option('--disk_count', required=True, type=int)
+@click.option('--size', required=True, help="size of each ssd, ex: 20GB")
+@click.option('--provisioning', type=click.Choice(utils.EMULATED_SSD_PROVISIONING), default="sparse",
+              help="sparse files, or preallocated with fallocate (falloc) or zeroes (full)")
 @click.pass_context
-def create_emulated_ssds(ctx, hostname, vmid, storage_id, disk_count, size):
-    utils.create_emulated_ssds(ctx.obj.pve, hostname, vmid, storage_id, disk_count, size)
+def create_emulated_ssds(ctx, hostname, vmid, storage_id, disk_count, size, provisioning):
+    ssh_client = None
+    if provisioning != "sparse":
+        ssh_client = ssh.SSHClient(hostname, ctx.obj.config["username"], ctx.obj.config["password"])
+    try:
+        utils.create_emulated_ssds(ctx.obj.pve, hostname, vmid, storage_id, disk_count,
+                                   utils.convert_size_to_bytes(size),
+                                   provisioning=provisioning, ssh_client=ssh_client)
+    finally:
+        if ssh_client:
+            ssh_client.close()
 
 
 @emulated_group.command("delete")
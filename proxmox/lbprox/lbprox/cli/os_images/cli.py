@@ -1,8 +1,13 @@
 import json
+import logging
 import os
 import click
 from typing import List
 from lbprox.common import proxmox_rest_client
+from lbprox.common import tasks
+from lbprox.common import threadpool
+from lbprox.common import vm_templates
+from lbprox.common.vm_tags import VMTags
 import tempfile
 import tarfile
 import requests
@@ -64,8 +69,12 @@ def os_images_group():
               help="list of nodes to add to the zone - default is all nodes")
 @click.option('--force', default=False, is_flag=True,
               help="in case the image already exists, force update")
+@click.option('--wait/--no-wait', default=True,
+              help="wait for the downloads to finish on all nodes")
+@click.option('--timeout', default=1800, type=int, show_default=True,
+              help="seconds to wait for the downloads")
 @click.pass_context
-def create_os_image(ctx, storage_id, url, nodes, force):
+def create_os_image(ctx, storage_id, url, nodes, force, wait, timeout):
     # NOTE: we assume here that the imgfile.tar.gz file contains a single .qcow2 file
     # which has the name imgfile.qcow2. It will be uploaded as imgfile.img
     proxmox_img_name = _proxmox_img_name(url)
@@ -77,8 +86,14 @@ def create_os_image(ctx, storage_id, url, nodes, force):
         else:
             print("force update. first delete the image, then create it.")
             _delete_os_image(ctx.obj.pve, storage_id, volid, nodes)
-    _create_os_image(ctx, storage_id, url, nodes)
-
+    upids = _create_os_image(ctx, storage_id, url, nodes)
+    if wait and upids:
+        futures = tasks.wait_for_tasks(ctx.obj.pve, upids, tmo=timeout)
+        failed = [future for future in futures.values() if future.exception()]
+        for future in failed:
+            print(f"download failed on {future.node}: {future.exception()}")
+        if failed:
+            raise click.ClickException(f"failed to download '{proxmox_img_name}' on {len(failed)} nodes")
 
 
 @os_images_group.command("delete")
@@ -113,6 +128,42 @@ def list_os_images(ctx, storage_id, nodes=None, content=None):
     print(json.dumps(cluster_images, indent=2))
 
 
+@os_images_group.group("templates", help="manage VM templates built from os images")
+def os_images_templates_group():
+    pass
+
+
+@os_images_templates_group.command("list")
+@click.option('-s', '--storage-id', required=False, default=None,
+              help="list only templates of this storage")
+@click.option('-i', '--image-name', required=False, default=None,
+              help="list only templates of this os image")
+@click.pass_context
+def list_templates(ctx, storage_id, image_name):
+    templates = vm_templates.list_templates(ctx.obj.pve, storage_id=storage_id, os_image=image_name)
+    print(json.dumps(templates, indent=2))
+
+
+@os_images_templates_group.command("delete", help="delete templates, templates with linked clones are marked as stale")
+@click.option('-s', '--storage-id', required=False, default=None,
+              help="delete only templates of this storage")
+@click.option('-i', '--image-name', required=False, default=None,
+              help="delete only templates of this os image")
+@click.option('--stale-only/--all', default=True,
+              help="delete only templates that were already marked as stale")
+@click.pass_context
+def delete_templates(ctx, storage_id, image_name, stale_only):
+    pve = ctx.obj.pve
+    results = []
+    for template in vm_templates.list_templates(pve, storage_id=storage_id, os_image=image_name):
+        tags = VMTags.parse_tags(template.get("tags", ""))
+        if stale_only and not tags.get_tag(vm_templates.STALE_TAG):
+            continue
+        deleted = vm_templates.invalidate_template(pve, template["node"], template["vmid"], tags)
+        results.append({"node": template["node"], "vmid": template["vmid"], "deleted": deleted})
+    print(json.dumps(results, indent=2))
+
+
 def _proxmox_img_name(url):
     basename = extract_basename(url)
     if basename.endswith(".tar.gz"):
@@ -141,10 +192,14 @@ def _create_os_image(ctx, storage_id, url: str, nodes: List):
     else:
         # image_name is the name of the image under proxmox - usually the same as the file name with .img
         image_name = _proxmox_img_name(url)
+        upids = []
         for node_name in node_names:
-            pve.nodes(node_name).storage(storage_id).post("download-url",
-                                                        url=url, filename=image_name,
-                                                        content="iso")
+            # the downloads run as tasks on all nodes in parallel
+            upids.append(pve.nodes(node_name).storage(storage_id).post("download-url",
+                                                                       url=url, filename=image_name,
+                                                                       content="iso"))
+        return upids
+    return []
 
 
 def find_qcow2_file(directory):
@@ -191,7 +246,8 @@ def _handle_tar_gz_file(ctx, node_names, storage_id, url, basename):
 
         username = ctx.obj.config["username"]
         password = ctx.obj.config["password"]
-        for node_name in node_names:
+
+        def _upload(node_name):
             # we have a special case for the local file upload since
             # proxmoxer does not support it.
             client = proxmox_rest_client.ProxmoxClient(
@@ -208,6 +264,16 @@ def _handle_tar_gz_file(ctx, node_names, storage_id, url, basename):
                 file_path=filename  # Filename is extracted automatically
             )
 
+        executor = threadpool.JobExecutor(f"uploading {os.path.basename(filename)}",
+                                          max_workers=len(node_names),
+                                          node_of=lambda job_args: job_args[0])
+        results = executor.run_all(_upload, [(node_name,) for node_name in node_names])
+        for result in results:
+            if not result.ok():
+                logging.error(f"failed to upload {filename} to {result.args[0]}: {result.exception}")
+        if not all(result.ok() for result in results):
+            raise threadpool.JobsFailed("uploading os image", results)
+
 def _delete_os_image(pve, storage_id, volid: str, nodes: list):
     # volid is of type f"{storage_id}:iso/{name}.img"
     node_list = nodes if nodes else pve.nodes.get()
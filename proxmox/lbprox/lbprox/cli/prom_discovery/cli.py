@@ -4,9 +4,10 @@ import time
 import yaml
 import sys
 import subprocess
-from lbprox.common import utils
+from lbprox.common import metrics
 from lbprox.common.utils import run_cmd
 from lbprox.common.vm_tags import VMTags
+from lbprox.state import store
 
 
 @click.group("prom-discovery")
@@ -18,13 +19,19 @@ def prom_discovery_group():
 @click.option('-i', "--interval", required=False, default=60, help="how often to update the dashboard")
 @click.option('-t', "--targets-directory", required=True, type=click.Path(exists=True),
               help="directory containing the prometheus target files (ex: /etc/prometheus/targets)")
+@click.option('-m', "--metrics-port", required=False, default=0, type=int,
+              help="serve lbprox API metrics in prometheus format on this port (default: disabled)")
 @click.pass_context
-def serve_prom_ds(ctx, interval, targets_directory):
+def serve_prom_ds(ctx, interval, targets_directory, metrics_port):
     pve = ctx.obj.pve
+    if metrics_port:
+        metrics.serve_metrics(metrics_port)
+    state = store.open_store()
     while True:
-        all_cluster_vms = utils.list_cluster_vms(pve, VMTags().set_role("target"))
+        # reconciling is skipped when another service, ex. the dashboard, just did it
+        state.ensure_fresh(pve, interval)
         grouped_qemu_vms_by_allocation_id = {}
-        for vm in all_cluster_vms:
+        for vm in state.vms(role="target", include_pool=False):
             tags = VMTags.parse_tags(vm.get('tags', ""))
             allocation_id = tags.get_allocation()
             if allocation_id not in grouped_qemu_vms_by_allocation_id:
@@ -50,9 +57,7 @@ def serve_prom_ds(ctx, interval, targets_directory):
                 # tags = VMTags.parse_tags(vm.get('tags', ""))
                 # cluster_exporter_targets['labels']['cluster_id'] = tags.get_cluster_id()
                 # cluster_api_service_targets['labels']['cluster_id'] = tags.get_cluster_id()
-                vmid = vm['vmid']
-                node_name = vm['node']
-                ip_addresses = utils.get_vm_ip_address(pve, node_name, vmid, 0, 0) if vm['status'] == 'running' else []
+                ip_addresses = vm['ip_addresses']
                 access_ip = next(iter([ip_address['ipv4'] for ip_address in ip_addresses if ip_address['purpose'] == 'access']), None)
                 cluster_exporter_targets["targets"].append(f"{access_ip}:8090")
                 cluster_api_service_targets["targets"].append(f"{access_ip}:443")
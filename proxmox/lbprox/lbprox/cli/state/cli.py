@@ -0,0 +1,78 @@
+import click
+import json
+import time
+
+from prettytable import PrettyTable
+
+from lbprox.common import utils
+from lbprox.state import store
+
+
+@click.group("state")
+def state_group():
+    """the local state store, a record of the cluster VMs kept in sync with the cluster"""
+    pass
+
+
+@state_group.command("reconcile", help="sync the local state with the cluster")
+@click.option('-o', '--output-format', type=click.Choice(['json', 'table']), default='table')
+@click.pass_context
+def reconcile(ctx, output_format):
+    result = store.open_store().reconcile(ctx.obj.pve)
+    if output_format == 'table':
+        print(result)
+    else:
+        print(json.dumps(result.to_dict(), indent=2))
+
+
+@state_group.command("vms", help="list the VMs in the local state, without calling the cluster")
+@click.option('-a', '--allocation-id', required=False, default=None)
+@click.option('-r', '--role', required=False, default=None)
+@click.option('-o', '--output-format', type=click.Choice(['json', 'table']), default='table')
+def list_vms(allocation_id, role, output_format):
+    state = store.open_store()
+    vms = state.vms(allocation_id=allocation_id, role=role)
+    if output_format == 'json':
+        print(json.dumps(vms, indent=2))
+        return
+    table = PrettyTable(align="l")
+    table.field_names = ["vmid", "node", "name", "allocation-id", "role", "status", "ip addresses", "devices"]
+    for vm in vms:
+        table.add_row([vm['vmid'], vm['node'], vm['name'], vm['allocation_id'] or "", vm['role'] or "",
+                       vm['status'], ", ".join(f"{ip['ipv4']} ({ip['purpose']})" for ip in vm['ip_addresses']),
+                       len(vm['devices'])])
+    print(table)
+    print(f"reconciled {utils.seconds_to_human_readable(state.age())} ago" if state.last_reconcile()
+          else "never reconciled, run: lbprox state reconcile")
+
+
+@state_group.command("images", help="list the os image templates in the local state")
+@click.option('-o', '--output-format', type=click.Choice(['json', 'table']), default='table')
+def list_images(output_format):
+    images = store.open_store().images()
+    if output_format == 'json':
+        print(json.dumps(images, indent=2))
+        return
+    table = PrettyTable(align="l")
+    table.field_names = ["node", "storage", "os image", "signature", "template vmid", "stale"]
+    for image in images:
+        table.add_row([image['node'], image['storage'], image['os_image'], image['signature'],
+                       image['template_vmid'], "yes" if image['stale'] else ""])
+    print(table)
+
+
+@state_group.command("phases", help="list the recorded phase timings of allocation commands")
+@click.option('-a', '--allocation-id', required=False, default=None)
+@click.option('-o', '--output-format', type=click.Choice(['json', 'table']), default='table')
+def list_phases(allocation_id, output_format):
+    phases = store.open_store().phases(allocation_id)
+    if output_format == 'json':
+        print(json.dumps(phases, indent=2))
+        return
+    table = PrettyTable(align="l")
+    table.field_names = ["recorded", "allocation-id", "command", "phase", "count", "seconds"]
+    for phase in phases:
+        table.add_row([time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(phase['recorded'])),
+                       phase['allocation_id'], phase['command'], phase['phase'], phase['count'],
+                       f"{phase['seconds']:.2f}"])
+    print(table)
@@ -0,0 +1,160 @@
+import json
+import logging
+
+from prettytable import PrettyTable
+
+from lbprox.common import tasks
+from lbprox.common import threadpool
+from lbprox.ssh import ssh
+
+
+# plan actions
+NOOP = "none"
+CREATE = "create"
+INVALID = "invalid"
+
+# apply statuses
+PLANNED = "planned"
+APPLIED = "applied"
+FAILED = "failed"
+ROLLED_BACK = "rolled back"
+
+
+class BridgePlan(object):
+    """what provisioning the access bridge means on a single node"""
+    def __init__(self, node, bridge):
+        self.node = node
+        self.bridge = bridge
+        self.action = INVALID
+        self.port = None
+        self.cidr = None
+        self.gateway = None
+        self.reason = ""
+        self.status = PLANNED
+        self.error = None
+
+    def failed(self):
+        return self.action == INVALID or self.status in (FAILED, ROLLED_BACK)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def _plan_node(pve, pool: ssh.SSHPool, node, bridge):
+    plan = BridgePlan(node, bridge)
+    devices = {device['iface']: device for device in pve.nodes(node).network.get()}
+    existing = devices.get(bridge)
+    if existing:
+        plan.port, plan.cidr, plan.gateway = existing.get('bridge_ports'), existing.get('cidr'), existing.get('gateway')
+        if existing.get('cidr'):
+            plan.action, plan.reason = NOOP, "bridge exists"
+        else:
+            plan.reason = "bridge exists without an address, it is not the access network"
+        return plan
+
+    # the bridge takes over the address of the interface holding the default route
+    iface, cidr, gateway = pool.get(node).get_network_info_via_ssh()
+    plan.port, plan.cidr, plan.gateway = iface, cidr, gateway
+    if not iface:
+        plan.reason = "could not determine the default interface"
+    elif devices.get(iface, {}).get('type') == "bridge":
+        plan.reason = f"the default route is already on bridge {iface}"
+    elif not cidr:
+        plan.reason = f"default interface {iface} has no IPv4 address"
+    else:
+        plan.action = CREATE
+    return plan
+
+
+def plan_access_bridges(pve, nodes, bridge, pool: ssh.SSHPool):
+    """read every node's network state concurrently and return a BridgePlan per node"""
+    args = [(pve, pool, node, bridge) for node in nodes]
+    executor = threadpool.JobExecutor(f"planning bridge {bridge} on {len(args)} nodes",
+                                      max_workers=max(1, len(args)), node_of=lambda args: args[2])
+    plans = {}
+    for job_result in executor.run(_plan_node, args):
+        if job_result.ok():
+            plans[job_result.result.node] = job_result.result
+            continue
+        plan = BridgePlan(job_result.args[2], bridge)
+        plan.reason = f"failed to read the network state: {job_result.exception}"
+        plans[plan.node] = plan
+    return [plans[node] for node in nodes]
+
+
+def _reload_network(pve, node, task_timeout):
+    upid = pve.nodes(node).network.put()
+    if upid:
+        tasks.wait_for_task(pve, upid, tmo=task_timeout)
+
+
+def _verify_bridge(pool: ssh.SSHPool, plan: BridgePlan):
+    # the reload moves the address, the pooled connection reconnects if it dropped with it
+    _, output, _ = pool.get(plan.node).run_command(f"ip -j addr show {plan.bridge}")
+    addresses = [f"{info['local']}/{info['prefixlen']}"
+                 for entry in json.loads(output) for info in entry.get("addr_info", [])
+                 if info.get("family") == "inet"]
+    if plan.cidr not in addresses:
+        raise RuntimeError(f"{plan.bridge} does not hold {plan.cidr} after the reload, has: {addresses}")
+
+
+def _rollback(pve, plan: BridgePlan, reloaded, task_timeout):
+    network = pve.nodes(plan.node).network
+    try:
+        if reloaded:
+            network(plan.bridge).delete()
+            _reload_network(pve, plan.node, task_timeout)
+        else:
+            # drop the staged, not yet applied, changes
+            network.delete()
+        plan.status = ROLLED_BACK
+    except Exception as ex:
+        plan.error = f"{plan.error}, rollback failed: {ex}"
+    logging.error(f"{plan.node}: creating bridge {plan.bridge} failed: {plan.error} ({plan.status})")
+
+
+def _apply_node(pve, pool: ssh.SSHPool, plan: BridgePlan, task_timeout):
+    staged = reloaded = False
+    try:
+        pve.nodes(plan.node).network.post(iface=plan.bridge, type="bridge",
+                                          cidr=plan.cidr, autostart='1',
+                                          gateway=plan.gateway,
+                                          bridge_ports=plan.port)
+        staged = True
+        # a failed reload may have applied part of the configuration, undo it as if it ran
+        reloaded = True
+        _reload_network(pve, plan.node, task_timeout)
+        _verify_bridge(pool, plan)
+        plan.status = APPLIED
+        logging.info(f"{plan.node}: bridge {plan.bridge} created on {plan.port} with {plan.cidr}")
+    except Exception as ex:
+        plan.status = FAILED
+        plan.error = str(ex)
+        if staged:
+            _rollback(pve, plan, reloaded, task_timeout)
+    return plan
+
+
+def apply_access_bridges(pve, plans, pool: ssh.SSHPool, task_timeout=120):
+    """create the planned bridges on all nodes in parallel, rolling back a node whose change failed"""
+    to_create = [plan for plan in plans if plan.action == CREATE]
+    if not to_create:
+        return plans
+    args = [(pve, pool, plan, task_timeout) for plan in to_create]
+    executor = threadpool.JobExecutor(f"creating bridges on {len(args)} nodes",
+                                      max_workers=len(args), node_of=lambda args: args[2].node)
+    for job_result in executor.run(_apply_node, args):
+        if not job_result.ok():
+            plan = job_result.args[2]
+            plan.status, plan.error = FAILED, str(job_result.exception)
+    return plans
+
+
+def plan_table(plans):
+    table = PrettyTable()
+    table.field_names = ["node", "action", "port", "cidr", "gateway", "status", "details"]
+    table.align = "l"
+    for plan in plans:
+        table.add_row([plan.node, plan.action, plan.port or "", plan.cidr or "", plan.gateway or "",
+                       plan.status if plan.action == CREATE else "", plan.error or plan.reason])
+    return table
@@ -0,0 +1,184 @@
+import bisect
+import http.server
+import logging
+import threading
+import urllib.parse
+
+from prettytable import PrettyTable
+
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# path segments following these collections are ids, replaced by the parameter name
+_PATH_PARAMETERS = {
+    "nodes": "node",
+    "qemu": "vmid",
+    "lxc": "vmid",
+    "tasks": "upid",
+    "storage": "storage",
+    "content": "volume",
+    "zones": "zone",
+    "vnets": "vnet",
+    "subnets": "subnet",
+    "directory": "name",
+    "network": "iface",
+    "pci": "pci_id",
+}
+
+
+def endpoint_template(url):
+    """nodes/pve01/qemu/101/config -> nodes/{node}/qemu/{vmid}/config"""
+    path = urllib.parse.urlparse(url).path
+    segments = [segment for segment in path.split("/") if segment]
+    if len(segments) >= 2 and segments[0] == "api2":
+        segments = segments[2:]
+    template = []
+    parameter = None
+    for segment in segments:
+        if parameter:
+            template.append(f"{{{parameter}}}")
+            parameter = None
+            continue
+        template.append(segment)
+        parameter = _PATH_PARAMETERS.get(segment)
+    return "/".join(template)
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def copy(self):
+        stats = EndpointStats()
+        stats.count, stats.errors, stats.total, stats.max = self.count, self.errors, self.total, self.max
+        stats.buckets = list(self.buckets)
+        return stats
+
+    def observe(self, duration, error):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q quantile"""
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(LATENCY_BUCKETS[idx], self.max) if idx < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+
+class Metrics(object):
+    """request count, errors and latency histogram per (method, endpoint template)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def observe(self, method, url, status, duration, error=None):
+        """transport observer, called once per request attempt"""
+        key = (method.upper(), endpoint_template(url))
+        failed = error is not None or (status is not None and status >= 400)
+        with self._lock:
+            if key not in self._stats:
+                self._stats[key] = EndpointStats()
+            self._stats[key].observe(duration, failed)
+
+    def snapshot(self):
+        """copies of the stats, consistent while requests keep updating them"""
+        with self._lock:
+            return {key: stats.copy() for key, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def summary_table(self):
+        table = PrettyTable()
+        table.field_names = ["method", "endpoint", "count", "errors", "p50", "p95", "max", "total"]
+        table.align = "l"
+        rows = sorted(self.snapshot().items(), key=lambda item: item[1].total, reverse=True)
+        for (method, endpoint), stats in rows:
+            table.add_row([method, endpoint, stats.count, stats.errors,
+                           f"{stats.quantile(0.5):.3f}", f"{stats.quantile(0.95):.3f}",
+                           f"{stats.max:.3f}", f"{stats.total:.2f}"])
+        return table
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP lbprox_api_requests_total Proxmox API requests by endpoint.",
+            "# TYPE lbprox_api_requests_total counter",
+        ]
+        snapshot = sorted(self.snapshot().items())
+        for (method, endpoint), stats in snapshot:
+            lines.append(f'lbprox_api_requests_total{{method="{method}",endpoint="{endpoint}"}} {stats.count}')
+        lines += [
+            "# HELP lbprox_api_request_errors_total failed Proxmox API requests by endpoint.",
+            "# TYPE lbprox_api_request_errors_total counter",
+        ]
+        for (method, endpoint), stats in snapshot:
+            lines.append(f'lbprox_api_request_errors_total{{method="{method}",endpoint="{endpoint}"}} {stats.errors}')
+        lines += [
+            "# HELP lbprox_api_request_duration_seconds Proxmox API request latency.",
+            "# TYPE lbprox_api_request_duration_seconds histogram",
+        ]
+        for (method, endpoint), stats in snapshot:
+            labels = f'method="{method}",endpoint="{endpoint}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], stats.buckets):
+                cumulative += count
+                lines.append(f'lbprox_api_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"lbprox_api_request_duration_seconds_sum{{{labels}}} {stats.total}")
+            lines.append(f"lbprox_api_request_duration_seconds_count{{{labels}}} {stats.count}")
+        return "\n".join(lines) + "\n"
+
+
+# the process wide registry
+REGISTRY = Metrics()
+
+
+def instrument(pve, registry: Metrics=REGISTRY):
+    """record every request of the ProxmoxAPI object (requires the transport to be installed)"""
+    transport = getattr(pve._store["session"], "transport", None)
+    if transport is None:
+        raise RuntimeError("the proxmox api transport is not installed")
+    if registry.observe not in transport.observers:
+        transport.observers.append(registry.observe)
+
+
+def write_metrics_response(handler: http.server.BaseHTTPRequestHandler, registry: Metrics=REGISTRY):
+    body = registry.prometheus_text().encode()
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/plain; version=0.0.4")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        write_metrics_response(self)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def serve_metrics(port):
+    """serve /metrics in a background thread"""
+    httpd = http.server.ThreadingHTTPServer(("", port), MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logging.info(f"serving metrics at port {port}")
+    return httpd
@@ -0,0 +1,186 @@
+import collections
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+
+# lines of each stream kept in memory when the full output is not needed
+DEFAULT_TAIL_LINES = 200
+# longer lines are split, so a single line can not grow without bounds
+MAX_LINE_BYTES = 64 * 1024
+# grace period between SIGTERM and SIGKILL of a timed out process
+KILL_GRACE_SECONDS = 10
+
+WALL_TIMEOUT = "wall"
+IDLE_TIMEOUT = "idle"
+
+# lines echoed by concurrent processes are written whole
+_echo_lock = threading.Lock()
+
+
+class ProcessResult(object):
+    def __init__(self, command):
+        self.command = command
+        self.returncode = None
+        self.stdout = ""
+        self.stderr = ""
+        self.stdout_truncated = False
+        self.stderr_truncated = False
+        self.duration = 0.0
+        self.timed_out = None
+        self.timeout = None
+        self.log_path = None
+
+    def ok(self):
+        return self.timed_out is None and self.returncode == 0
+
+    def check(self):
+        """raise like subprocess.run(check=True) would"""
+        if self.timed_out is not None:
+            raise subprocess.TimeoutExpired(self.command, self.timeout,
+                                            output=self.stdout.encode(), stderr=self.stderr.encode())
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.command,
+                                                output=self.stdout.encode(), stderr=self.stderr.encode())
+        return self
+
+    def describe(self):
+        if self.timed_out == WALL_TIMEOUT:
+            return f"timed out after {self.timeout}s"
+        if self.timed_out == IDLE_TIMEOUT:
+            return f"no output for {self.timeout}s"
+        return f"exit code {self.returncode}"
+
+
+class _StreamReader(threading.Thread):
+    """drains one pipe: keeps the output (or its tail), tees it to the log and the console"""
+    def __init__(self, name, pipe, keep_all, tail_lines, log, log_lock, echo_to, prefix):
+        super().__init__(name=f"process-{name}", daemon=True)
+        self.pipe = pipe
+        self.lines = [] if keep_all else collections.deque(maxlen=tail_lines)
+        self.count = 0
+        self.log = log
+        self.log_lock = log_lock
+        self.echo_to = echo_to
+        self.prefix = prefix.encode()
+        self.last_activity = time.time()
+
+    def run(self):
+        for line in iter(lambda: self.pipe.readline(MAX_LINE_BYTES), b''):
+            self.last_activity = time.time()
+            self.count += 1
+            self.lines.append(line)
+            if self.log is not None:
+                with self.log_lock:
+                    self.log.write(line)
+            if self.echo_to is not None:
+                with _echo_lock:
+                    self.echo_to.write(self.prefix + line)
+                    self.echo_to.flush()
+        self.pipe.close()
+
+    def text(self):
+        return b"".join(self.lines).decode(errors="replace")
+
+    def truncated(self):
+        return self.count > len(self.lines)
+
+
+def _feed_input(pipe, data):
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def _kill(proc):
+    """terminate the process group, kill it if it does not exit in time"""
+    for sig, grace in ((signal.SIGTERM, KILL_GRACE_SECONDS), (signal.SIGKILL, None)):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(timeout=grace)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def run(command, cwd=None, input=None, env=None, log_path=None, echo=False, prefix="",
+        timeout=None, idle_timeout=None, keep_stdout=False, tail_lines=DEFAULT_TAIL_LINES):
+    """run a shell command, draining stdout and stderr concurrently.
+
+    only the last tail_lines of each stream are kept unless keep_stdout is set.
+    with log_path both streams are appended to that file, with echo they are
+    written to our stdout/stderr prefixed by prefix.
+    timeout bounds the total run time, idle_timeout the time without any output,
+    the process group is killed when either expires.
+    returns a ProcessResult, it does not raise on failures - see ProcessResult.check
+    """
+    logging.debug(f"running command: {command}")
+    result = ProcessResult(command)
+    result.log_path = log_path
+    if isinstance(input, str):
+        input = input.encode()
+    start = time.time()
+    log = open(log_path, "ab") if log_path else None
+    log_lock = threading.Lock()
+    try:
+        # a session of its own, so a timeout kills the whole pipeline and not only the shell
+        proc = subprocess.Popen(command, shell=True, cwd=cwd, env=env,
+                                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                start_new_session=True)
+        readers = [
+            _StreamReader("stdout", proc.stdout, keep_stdout, tail_lines, log, log_lock,
+                          sys.stdout.buffer if echo else None, prefix),
+            _StreamReader("stderr", proc.stderr, False, tail_lines, log, log_lock,
+                          sys.stderr.buffer if echo else None, prefix),
+        ]
+        for reader in readers:
+            reader.start()
+        if input is not None:
+            threading.Thread(target=_feed_input, args=(proc.stdin, input), daemon=True).start()
+
+        try:
+            while True:
+                try:
+                    proc.wait(timeout=0.5)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                now = time.time()
+                if timeout and now - start > timeout:
+                    result.timed_out, result.timeout = WALL_TIMEOUT, timeout
+                elif idle_timeout and now - max(reader.last_activity for reader in readers) > idle_timeout:
+                    result.timed_out, result.timeout = IDLE_TIMEOUT, idle_timeout
+                if result.timed_out:
+                    logging.error(f"{result.describe()}, killing: {command}")
+                    _kill(proc)
+                    break
+        except BaseException:
+            _kill(proc)
+            raise
+        finally:
+            for reader in readers:
+                # the pipes stay open while background children of the command live
+                reader.join(timeout=KILL_GRACE_SECONDS)
+        result.returncode = proc.returncode
+        stdout, stderr = readers
+        result.stdout, result.stdout_truncated = stdout.text(), stdout.truncated()
+        result.stderr, result.stderr_truncated = stderr.text(), stderr.truncated()
+    finally:
+        if log is not None:
+            log.close()
+        result.duration = time.time() - start
+    return result
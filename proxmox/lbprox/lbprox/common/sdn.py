@@ -0,0 +1,112 @@
+import logging
+import time
+
+from prettytable import PrettyTable
+
+from lbprox.common import threadpool
+
+
+AVAILABLE = "available"
+PENDING = "pending"
+ERROR = "error"
+
+
+class NodeSDNStatus(object):
+    """readiness of a zone and its vnets on a single node"""
+    def __init__(self, node):
+        self.node = node
+        self.status = PENDING
+        self.message = ""
+        self.checks = 0
+        self.elapsed = 0.0
+
+    def ready(self):
+        return self.status == AVAILABLE
+
+
+class SDNNotReady(RuntimeError):
+    def __init__(self, zone, statuses):
+        self.statuses = statuses
+        failed = [status for status in statuses.values() if not status.ready()]
+        details = ", ".join(f"{status.node}: {status.status} {status.message}".strip() for status in failed)
+        super().__init__(f"zone {zone} is not ready on {len(failed)} of {len(statuses)} nodes: {details}")
+
+
+def _check_node(pve, node, zone, vnets):
+    """(status, message) of the zone and its vnets on the node"""
+    node_zones = {entry.get('zone'): entry for entry in pve.nodes(node).sdn.zones.get()}
+    node_zone = node_zones.get(zone)
+    if node_zone is None:
+        return PENDING, "zone not applied yet"
+    if node_zone.get('status') != AVAILABLE:
+        return node_zone.get('status', PENDING), f"zone {zone}: {node_zone.get('statusmsg') or node_zone.get('status')}"
+    if not vnets:
+        return AVAILABLE, ""
+    content = {entry.get('vnet'): entry for entry in pve.nodes(node).sdn.zones(zone).content.get()}
+    for vnet in vnets:
+        entry = content.get(vnet)
+        if entry is None:
+            return PENDING, f"vnet {vnet} not applied yet"
+        if entry.get('status') != AVAILABLE:
+            return entry.get('status', PENDING), f"vnet {vnet}: {entry.get('statusmsg') or entry.get('status')}"
+    return AVAILABLE, ""
+
+
+def _wait_for_node(pve, node, zone, vnets, deadline, interval, max_interval):
+    status = NodeSDNStatus(node)
+    start = time.time()
+    while True:
+        status.checks += 1
+        try:
+            status.status, status.message = _check_node(pve, node, zone, vnets)
+        except Exception as ex:
+            # the node may still be reloading its network, retry until the deadline
+            status.status, status.message = PENDING, f"status query failed: {ex}"
+        status.elapsed = time.time() - start
+        if status.status in (AVAILABLE, ERROR):
+            break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            status.message = f"timed out, last: {status.message}".strip()
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+    logging.debug(f"zone {zone} on node {node}: {status.status} {status.message} "
+                  f"after {status.elapsed:.1f}s and {status.checks} checks")
+    return status
+
+
+def wait_for_zone(pve, nodes, zone, vnets=(), timeout=300, interval=0.5, max_interval=5):
+    """wait for an applied zone (and its vnets) to become available on all nodes.
+
+    nodes are polled concurrently, each with its own exponential backoff, all
+    under the same overall deadline. a node reporting an error is not polled
+    anymore. returns {node: NodeSDNStatus}, raises SDNNotReady unless the zone
+    is available everywhere.
+    """
+    deadline = time.time() + timeout
+    args = [(pve, node, zone, list(vnets), deadline, interval, max_interval) for node in nodes]
+    executor = threadpool.JobExecutor(f"waiting for zone {zone} on {len(args)} nodes",
+                                      max_workers=max(1, len(args)), node_of=lambda args: args[1])
+    statuses = {}
+    for job_result in executor.run(_wait_for_node, args):
+        if job_result.ok():
+            statuses[job_result.result.node] = job_result.result
+        else:
+            status = NodeSDNStatus(job_result.args[1])
+            status.status, status.message = ERROR, str(job_result.exception)
+            statuses[status.node] = status
+    statuses = {node: statuses[node] for node in nodes}
+    if not all(status.ready() for status in statuses.values()):
+        raise SDNNotReady(zone, statuses)
+    logging.info(f"zone {zone} is available on all {len(statuses)} nodes")
+    return statuses
+
+
+def status_table(statuses):
+    table = PrettyTable()
+    table.field_names = ["node", "status", "seconds", "checks", "message"]
+    table.align = "l"
+    for status in statuses.values():
+        table.add_row([status.node, status.status, f"{status.elapsed:.1f}", status.checks, status.message])
+    return table
@@ -0,0 +1,195 @@
+import re
+
+from lbprox.common.vm_tags import VMTags, _parse
+
+
+EQUALS = "="
+NOT_EQUALS = "!="
+IN = "in"
+NOT_IN = "notin"
+EXISTS = "exists"
+NOT_EXISTS = "!exists"
+
+# every VM lbprox creates (allocations, create-from-img, warm pool) is tagged with its name
+OWNED_KEY = "vm"
+
+_SET_TERM = re.compile(r"^([^\s=!(),;.]+)\s+(in|notin)\s*\((.*)\)$")
+
+
+class Term(object):
+    def __init__(self, key, op, values=()):
+        self.key = key
+        self.op = op
+        self.values = frozenset(values)
+
+    def negative(self):
+        return self.op in (NOT_EQUALS, NOT_IN, NOT_EXISTS)
+
+    def __repr__(self):
+        if self.op in (EXISTS, NOT_EXISTS):
+            return self.key if self.op == EXISTS else f"!{self.key}"
+        if self.op in (IN, NOT_IN):
+            return f"{self.key} {self.op} ({','.join(sorted(self.values))})"
+        return f"{self.key}{self.op}{next(iter(self.values))}"
+
+
+def _split_terms(selector):
+    """split on ',' and ';' outside of parentheses"""
+    terms = []
+    depth = 0
+    current = []
+    for char in selector:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                raise ValueError(f"unbalanced parentheses in selector: {selector}")
+        elif char in ",;" and depth == 0:
+            terms.append("".join(current))
+            current = []
+            continue
+        current.append(char)
+    if depth:
+        raise ValueError(f"unbalanced parentheses in selector: {selector}")
+    terms.append("".join(current))
+    return [term.strip() for term in terms if term.strip()]
+
+
+def _parse_term(term):
+    match = _SET_TERM.match(term)
+    if match:
+        key, op, values = match.groups()
+        values = [value.strip() for value in re.split(r"[,|]", values) if value.strip()]
+        if not values:
+            raise ValueError(f"empty value list in selector term: {term}")
+        return Term(key, op, values)
+    for op in (NOT_EQUALS, "==", EQUALS):
+        key, sep, value = term.partition(op)
+        if sep:
+            key = key.strip()
+            if not key:
+                raise ValueError(f"missing key in selector term: {term}")
+            return Term(key, NOT_EQUALS if op == NOT_EQUALS else EQUALS, [value.strip()])
+    if term.startswith("!"):
+        return Term(term[1:].strip(), NOT_EXISTS)
+    # the tag format itself: key.value
+    key, sep, value = term.partition(".")
+    if sep:
+        return Term(key, EQUALS, [value])
+    return Term(term, EXISTS)
+
+
+class Selector(object):
+    """a conjunction of tag terms, parsed from e.g.:
+
+        allocation=b178,role in (target,initiator),vm!=s00,!cid
+
+    terms are separated by ',' or ';', and 'key.value' (the tag format) is
+    the same as 'key=value'.
+    """
+    def __init__(self, terms):
+        self.terms = terms
+
+    @staticmethod
+    def parse(selector: str):
+        terms = [_parse_term(term) for term in _split_terms(selector or "")]
+        if not terms:
+            raise ValueError("empty selector")
+        return Selector(terms)
+
+    @staticmethod
+    def from_tags(tags: VMTags):
+        return Selector([Term(key, EQUALS, [value]) for key, value in tags.get_tags().items()])
+
+    def positive(self):
+        """True if a term requires a tag, a selector of negative terms only matches every VM lacking them"""
+        return any(not term.negative() for term in self.terms)
+
+    def owned(self):
+        """the selector restricted to VMs created by lbprox"""
+        if any(term.key == OWNED_KEY and term.op == EXISTS for term in self.terms):
+            return self
+        return Selector(self.terms + [Term(OWNED_KEY, EXISTS)])
+
+    def matches(self, tags: dict):
+        for term in self.terms:
+            value = tags.get(term.key)
+            if term.op in (EQUALS, IN):
+                ok = value in term.values
+            elif term.op in (NOT_EQUALS, NOT_IN):
+                ok = value not in term.values
+            elif term.op == EXISTS:
+                ok = value is not None
+            else:
+                ok = value is None
+            if not ok:
+                return False
+        return True
+
+    def __repr__(self):
+        return ",".join(repr(term) for term in self.terms)
+
+
+class TagIndex(object):
+    """inverted index (key, value) -> resource ids over one cluster/resources snapshot.
+
+    a query intersects the sets of its positive terms, smallest first, and
+    subtracts the sets of its negative ones, so it costs O(matches) rather
+    than a scan of the whole cluster.
+    """
+    def __init__(self, resources):
+        self.resources = {}
+        self._all = set()
+        self._by_tag = {}
+        self._by_key = {}
+        for resource in resources:
+            self.add(resource)
+
+    @staticmethod
+    def from_cluster(pve, resource_type="vm", include_templates=False):
+        resources = pve.cluster().resources.get(type=resource_type)
+        if not include_templates:
+            resources = [resource for resource in resources if not resource.get('template')]
+        return TagIndex(resources)
+
+    def add(self, resource):
+        rid = resource['id']
+        self.resources[rid] = resource
+        self._all.add(rid)
+        for key, value in _parse(resource.get('tags', "") or "").items():
+            self._by_tag.setdefault((key, value), set()).add(rid)
+            self._by_key.setdefault(key, set()).add(rid)
+
+    def _ids(self, term: Term):
+        if term.op in (EQUALS, NOT_EQUALS):
+            return self._by_tag.get((term.key, next(iter(term.values))), set())
+        if term.op in (IN, NOT_IN):
+            ids = set()
+            for value in term.values:
+                ids |= self._by_tag.get((term.key, value), set())
+            return ids
+        return self._by_key.get(term.key, set())
+
+    def ids(self, selector: Selector):
+        positive = [self._ids(term) for term in selector.terms if not term.negative()]
+        negative = [self._ids(term) for term in selector.terms if term.negative()]
+        if positive:
+            positive.sort(key=len)
+            ids = set(positive[0])
+            for other in positive[1:]:
+                if not ids:
+                    break
+                ids &= other
+        else:
+            ids = set(self._all)
+        for other in negative:
+            if not ids:
+                break
+            ids -= other
+        return ids
+
+    def select(self, selector: Selector):
+        """matching resources, ordered by vmid"""
+        resources = [self.resources[rid] for rid in self.ids(selector)]
+        return sorted(resources, key=lambda resource: (resource.get('vmid', 0), resource['id']))
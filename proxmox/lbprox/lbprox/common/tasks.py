@@ -0,0 +1,184 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+# UPID:{node}:{pid}:{pstart}:{starttime}:{type}:{id}:{user}:
+# see: https://pve.proxmox.com/pve-docs/api-viewer/index.html#/nodes/{node}/tasks
+def parse_upid(upid: str):
+    parts = upid.split(":")
+    if len(parts) < 8 or parts[0] != "UPID":
+        raise ValueError(f"invalid UPID: {upid}")
+    return {
+        "upid": upid,
+        "node": parts[1],
+        "pid": int(parts[2], 16),
+        "pstart": int(parts[3], 16),
+        "starttime": int(parts[4], 16),
+        "type": parts[5],
+        "id": parts[6],
+        "user": parts[7],
+    }
+
+
+class TaskError(RuntimeError):
+    def __init__(self, upid, node, exit_status, log_lines=None):
+        self.upid = upid
+        self.node = node
+        self.exit_status = exit_status
+        self.log_lines = log_lines or []
+        message = f"task {upid} failed on {node}: {exit_status}"
+        if self.log_lines:
+            message += "\n  " + "\n  ".join(self.log_lines)
+        super().__init__(message)
+
+
+class TaskFuture(concurrent.futures.Future):
+    """future of a PVE task, resolves to the task exit status ("OK") or
+    raises TaskError if the task failed.
+    """
+    def __init__(self, pve, upid):
+        super().__init__()
+        self.pve = pve
+        self.upid = upid
+        info = parse_upid(upid)
+        self.node = info["node"]
+        self.type = info["type"]
+        self.starttime = info["starttime"]
+        self.exit_status = None
+        self.endtime = None
+
+    def log(self, limit=50):
+        """the last lines of the task log"""
+        lines = self.pve.nodes(self.node).tasks(self.upid).log.get(start=0, limit=5000)
+        return [line.get("t", "") for line in lines][-limit:]
+
+    def duration(self):
+        if self.endtime is None:
+            return time.time() - self.starttime
+        return self.endtime - self.starttime
+
+    def _log_tail(self):
+        try:
+            return self.log(limit=10)
+        except Exception as ex:
+            return [f"failed to read task log: {ex}"]
+
+    def _finish(self, exit_status, endtime=None):
+        self.exit_status = exit_status
+        self.endtime = endtime or time.time()
+        try:
+            if exit_status == "OK":
+                self.set_result(exit_status)
+            else:
+                self.set_exception(TaskError(self.upid, self.node, exit_status, self._log_tail()))
+        except concurrent.futures.InvalidStateError:
+            # the waiter gave up and cancelled it meanwhile
+            logging.debug(f"task {self.upid} finished after it was cancelled")
+
+
+class TaskTracker(object):
+    """tracks PVE tasks by UPID and completes their futures.
+
+    a single background thread polls the task list of every node that has
+    pending tasks - one query per node per interval regardless of how many
+    tasks are tracked on it. a task missing from the list (pushed out of it
+    by newer tasks) is looked up by its UPID.
+    """
+    def __init__(self, pve, interval=1):
+        self.pve = pve
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._poller = None
+
+    def track(self, upid) -> TaskFuture:
+        future = TaskFuture(self.pve, upid)
+        with self._lock:
+            self._pending[upid] = future
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, name="pve-task-tracker", daemon=True)
+                self._poller.start()
+        return future
+
+    def _poll(self):
+        while True:
+            with self._lock:
+                for upid in [upid for upid, future in self._pending.items() if future.cancelled()]:
+                    del self._pending[upid]
+                if not self._pending:
+                    self._poller = None
+                    return
+                by_node = {}
+                for future in self._pending.values():
+                    by_node.setdefault(future.node, []).append(future)
+            for node, futures in by_node.items():
+                try:
+                    self._poll_node(node, futures)
+                except Exception as ex:
+                    logging.debug(f"failed to poll tasks on {node}: {ex}. will retry in {self.interval} seconds")
+            time.sleep(self.interval)
+
+    def _poll_node(self, node, futures):
+        since = min(future.starttime for future in futures) - 1
+        tasks = self.pve.nodes(node).tasks.get(source="all", since=since, limit=max(500, 4 * len(futures)))
+        listed = {task["upid"]: task for task in tasks}
+        for future in futures:
+            task = listed.get(future.upid)
+            if task is None:
+                status = self.pve.nodes(node).tasks(future.upid).status.get()
+                if status.get("status") != "stopped":
+                    continue
+                task = {"status": status.get("exitstatus"), "endtime": status.get("endtime")}
+            elif not task.get("endtime"):
+                continue
+            with self._lock:
+                self._pending.pop(future.upid, None)
+            if not future.done():
+                future._finish(task.get("status"), task.get("endtime"))
+
+
+_trackers_guard = threading.Lock()
+
+
+def get_tracker(pve) -> TaskTracker:
+    """the tracker shared by all callers of the pve api object, kept on its session
+    so it lives as long as the api object does
+    """
+    session = pve._store["session"]
+    with _trackers_guard:
+        if not isinstance(getattr(session, "task_tracker", None), TaskTracker):
+            session.task_tracker = TaskTracker(pve)
+        return session.task_tracker
+
+
+def track(pve, upid) -> TaskFuture:
+    return get_tracker(pve).track(upid)
+
+
+def wait_for_tasks(pve, upids, tmo=600):
+    """wait for many tasks at once, returns {upid: TaskFuture} once all of them
+    finished, failed tasks hold their TaskError. raise TimeoutError listing the
+    tasks still running after tmo seconds.
+    """
+    futures = {upid: track(pve, upid) for upid in upids if upid}
+    _, not_done = concurrent.futures.wait(futures.values(), timeout=tmo)
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        running = ", ".join(future.upid for future in not_done)
+        raise TimeoutError(f"timed out ({tmo}s) waiting for tasks: {running}")
+    return futures
+
+
+def wait_for_task(pve, upid, tmo=600):
+    """wait for a single task, returns its exit status.
+    raise TaskError if it failed and TimeoutError if it did not finish in time.
+    """
+    future = track(pve, upid)
+    try:
+        return future.result(timeout=tmo)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise TimeoutError(f"timed out ({tmo}s) waiting for task {upid} on {future.node}")
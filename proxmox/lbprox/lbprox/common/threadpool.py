@@ -1,19 +1,174 @@
 import concurrent.futures
+import contextlib
+import threading
 import time
 import logging
 
 
+# default number of concurrent jobs allowed against a single Proxmox node,
+# shared by all executors in the process
+DEFAULT_NODE_CONCURRENCY = 8
 
-def run_with_threadpool(func, args, desc, max_workers=10):
-    start = time.time()
-    logging.info("starting concurrent job: %s", desc)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(func, *arg): arg for arg in args}
+_node_limits_guard = threading.Lock()
+_node_concurrency = DEFAULT_NODE_CONCURRENCY
+_node_semaphores = {}
+# nodes whose slot the current thread holds, or inherited from the job that started it
+_held = threading.local()
+# end of a JobExecutor's pending jobs, None is a valid job args
+_NO_MORE_JOBS = object()
 
-        results = []
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            results.append(result)
-    elapsed = time.time() - start
-    logging.info("done concurrent job: %s - [took: %s]", desc, elapsed)
-    return results
+
+def set_node_concurrency(limit: int):
+    """set the global limit of concurrent jobs per node (applies to nodes not used yet)"""
+    global _node_concurrency
+    if limit < 1:
+        raise ValueError(f"node concurrency must be positive, got: {limit}")
+    with _node_limits_guard:
+        _node_concurrency = limit
+        _node_semaphores.clear()
+
+
+def held_nodes():
+    """nodes whose concurrency slot the current thread holds"""
+    return frozenset(getattr(_held, "nodes", frozenset()))
+
+
+@contextlib.contextmanager
+def _holding(nodes):
+    previous = held_nodes()
+    _held.nodes = previous | nodes
+    try:
+        yield
+    finally:
+        _held.nodes = previous
+
+
+@contextlib.contextmanager
+def node_slot(node):
+    """hold one of the node's concurrency slots for the duration of the block.
+    a thread already holding a slot of the node, or running a job started by one,
+    re-enters it instead of taking another (nested executors would deadlock).
+    """
+    if node in held_nodes():
+        yield
+        return
+    with _node_limits_guard:
+        if node not in _node_semaphores:
+            _node_semaphores[node] = threading.BoundedSemaphore(_node_concurrency)
+        semaphore = _node_semaphores[node]
+    with semaphore, _holding(frozenset([node])):
+        yield
+
+
+class JobResult(object):
+    def __init__(self, args, result=None, exception=None, duration=0.0):
+        self.args = args
+        self.result = result
+        self.exception = exception
+        self.duration = duration
+
+    def ok(self):
+        return self.exception is None
+
+
+class JobsFailed(RuntimeError):
+    def __init__(self, desc, results):
+        self.results = results
+        self.failed = [result for result in results if not result.ok()]
+        errors = "; ".join(f"{type(result.exception).__name__}: {result.exception}" for result in self.failed)
+        super().__init__(f"{len(self.failed)} of {len(results)} jobs failed: {desc} - {errors}")
+
+
+class JobExecutor(object):
+    """runs func over a list of args with at most max_workers jobs in flight.
+
+    results are yielded as JobResult in completion order. node_of maps the args
+    of a job to the Proxmox node it works against, such jobs also take one of
+    the node's global concurrency slots. jobs of a node whose slot the caller
+    already holds (an executor started from a job) re-enter that slot instead,
+    at most node concurrency of them at once per executor - so a node runs at
+    most node_concurrency top level jobs, each with up to that many nested ones.
+    with fail_fast no new jobs are started after the first failure.
+    Ctrl-C cancels the jobs that did not start yet.
+    """
+    def __init__(self, desc, max_workers=10, fail_fast=False, node_of=None):
+        self.desc = desc
+        self.max_workers = max(1, max_workers)
+        self.fail_fast = fail_fast
+        self.node_of = node_of
+
+    def _run_job(self, func, args, inherited, nested_slots):
+        start = time.time()
+        try:
+            with _holding(inherited):
+                if self.node_of is not None:
+                    node = self.node_of(args)
+                    with nested_slots[node] if node in nested_slots else node_slot(node):
+                        result = func(*args)
+                else:
+                    result = func(*args)
+            return JobResult(args, result=result, duration=time.time() - start)
+        except Exception as ex:
+            return JobResult(args, exception=ex, duration=time.time() - start)
+
+    def run(self, func, args):
+        args = list(args)
+        total = len(args)
+        start = time.time()
+        logging.info("starting concurrent job: %s (%d jobs)", self.desc, total)
+        done_count = 0
+        failed_count = 0
+        next_progress = 0.1
+        pending = iter(args)
+        in_flight = set()
+        stop_submitting = False
+        # jobs run in worker threads, they inherit the node slots held by the caller
+        inherited = held_nodes()
+        with _node_limits_guard:
+            nested_slots = {node: threading.BoundedSemaphore(_node_concurrency) for node in inherited}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while True:
+                while not stop_submitting and len(in_flight) < self.max_workers:
+                    job_args = next(pending, _NO_MORE_JOBS)
+                    if job_args is _NO_MORE_JOBS:
+                        stop_submitting = True
+                        break
+                    in_flight.add(executor.submit(self._run_job, func, job_args, inherited, nested_slots))
+                if not in_flight:
+                    break
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    job_result = future.result()
+                    done_count += 1
+                    if not job_result.ok():
+                        failed_count += 1
+                        logging.debug(f"{self.desc}: job {job_result.args} failed: {job_result.exception}")
+                        if self.fail_fast:
+                            stop_submitting = True
+                    if total and done_count / total >= next_progress:
+                        logging.info("%s: %d/%d done, %d failed", self.desc, done_count, total, failed_count)
+                        next_progress = (int(done_count * 10 / total) + 1) / 10
+                    yield job_result
+        except (KeyboardInterrupt, GeneratorExit):
+            logging.warning("%s: cancelling %d jobs that did not start", self.desc, total - done_count - len(in_flight))
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+        logging.info("done concurrent job: %s - [took: %s]", self.desc, time.time() - start)
+
+    def run_all(self, func, args):
+        """run all jobs and return their JobResults"""
+        return list(self.run(func, args))
+
+
+def run_with_threadpool(func, args, desc, max_workers=10, fail_fast=False, node_of=None):
+    """run func over args concurrently, returns the results in completion order.
+    raise JobsFailed with every failed job if any job failed.
+    """
+    results = JobExecutor(desc, max_workers, fail_fast=fail_fast, node_of=node_of).run_all(func, args)
+    failed = [job_result for job_result in results if not job_result.ok()]
+    if failed:
+        raise JobsFailed(desc, results) from failed[0].exception
+    return [job_result.result for job_result in results]
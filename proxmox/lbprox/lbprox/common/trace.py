@@ -0,0 +1,124 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from lbprox.common import constants
+
+
+class Tracer(object):
+    """collects timed spans of a command in Chrome trace format
+    (load the saved file in chrome://tracing or https://ui.perfetto.dev).
+
+    spans are recorded per thread, so concurrent work on several machines
+    shows up as parallel tracks.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.metadata = {}
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._epoch = time.time()
+
+    def _tid(self):
+        ident = threading.get_ident()
+        with self._lock:
+            if ident not in self._threads:
+                self._threads[ident] = (len(self._threads) + 1, threading.current_thread().name)
+            return self._threads[ident][0]
+
+    def add_span(self, name, start, end, **args):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": int((start - self._epoch) * 1e6),
+            "dur": int((end - start) * 1e6),
+            "pid": 1,
+            "tid": self._tid(),
+            "args": args,
+        }
+        with self._lock:
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = time.time()
+        try:
+            yield args
+        except BaseException as ex:
+            args["error"] = str(ex)
+            raise
+        finally:
+            self.add_span(name, start, time.time(), **args)
+
+    def phase_totals(self):
+        """{span name: (count, total seconds)}"""
+        totals = {}
+        with self._lock:
+            for event in self._events:
+                count, total = totals.get(event["name"], (0, 0.0))
+                totals[event["name"]] = (count + 1, total + event["dur"] / 1e6)
+        return totals
+
+    def to_chrome_trace(self):
+        with self._lock:
+            events = list(self._events)
+            threads = list(self._threads.values())
+        events += [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+                   for tid, name in threads]
+        events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"lbprox {self.name}"}})
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": dict(self.metadata, command=self.name, started=self._epoch),
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+        logging.info(f"trace saved to: {path}")
+        return path
+
+
+class NoopTracer(Tracer):
+    def add_span(self, name, start, end, **args):
+        pass
+
+
+_current = NoopTracer("noop")
+
+
+def start(name) -> Tracer:
+    """start tracing a command, spans recorded by span() go to the new tracer"""
+    global _current
+    _current = Tracer(name)
+    return _current
+
+
+def stop():
+    global _current
+    tracer, _current = _current, NoopTracer("noop")
+    return tracer
+
+
+def current() -> Tracer:
+    return _current
+
+
+def span(name, **args):
+    """time a block as a span of the current tracer, does nothing when not tracing"""
+    return _current.span(name, **args)
+
+
+def traces_directory(allocation_id):
+    return os.path.join(constants.INVENTORIES_DIR, allocation_id, "traces")
+
+
+def save_allocation_trace(tracer: Tracer, allocation_id):
+    """save the trace next to the allocation's inventory"""
+    filename = f"{tracer.name.replace(' ', '-')}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(tracer._epoch))}.json"
+    return tracer.save(os.path.join(traces_directory(allocation_id), filename))
@@ -0,0 +1,189 @@
+import contextlib
+import logging
+import random
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from lbprox.common import threadpool
+
+
+# statuses returned by pveproxy when it could not reach or proxy to the target node
+RETRYABLE_STATUSES = {502, 503, 504, 595, 596}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+_node_pattern = re.compile(r"/api2/\w+/nodes/([^/]+)")
+
+
+class NodeUnavailable(requests.exceptions.ConnectionError):
+    pass
+
+
+class TransportPolicy(object):
+    """tunables of the API transport, read from the `api` section of lbprox.yml"""
+    SETTINGS = ("pool_size", "retries", "backoff_base", "backoff_max", "breaker_threshold", "breaker_cooldown")
+
+    def __init__(self, pool_size=32, retries=4,
+                 backoff_base=0.5, backoff_max=10.0,
+                 breaker_threshold=5, breaker_cooldown=30.0):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+
+    @staticmethod
+    def from_config(config: dict):
+        config = config or {}
+        if not isinstance(config, dict):
+            raise ValueError(f"the api section of lbprox.yml must be a mapping, got: {config}")
+        if "node_concurrency" in config:
+            raise ValueError("api.node_concurrency is no longer supported, "
+                             "set node_concurrency at the top level of lbprox.yml instead")
+        unknown = sorted(set(config) - set(TransportPolicy.SETTINGS))
+        if unknown:
+            raise ValueError(f"unknown api settings in lbprox.yml: {', '.join(unknown)}, "
+                             f"expected: {', '.join(TransportPolicy.SETTINGS)}")
+        return TransportPolicy(**config)
+
+
+class CircuitBreaker(object):
+    """opens after `threshold` consecutive failures of a node and rejects its
+    requests until `cooldown` passed, then lets a single probe request through.
+    """
+    def __init__(self, node, threshold, cooldown):
+        self.node = node
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.cooldown or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f"node {self.node} is reachable again, closing circuit")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.warning(f"node {self.node} failed {self.failures} consecutive requests, "
+                                    f"rejecting its requests for {self.cooldown}s")
+                self.opened_at = time.time()
+
+
+class Transport(object):
+    """wraps the requests session shared by all resources of a ProxmoxAPI object.
+
+    requests addressing /nodes/{node}/... hold one of the node's slots (the
+    threadpool.node_slot limiter shared with the job executors, re-entered by a
+    job already holding it), so a node's pveproxy is never hit by more than
+    node_concurrency requests at once. idempotent requests are retried with exponential backoff and
+    jitter on connection errors and proxy errors.
+    """
+    def __init__(self, session: requests.Session, policy: TransportPolicy):
+        self.session = session
+        self.policy = policy
+        self._send = session.request
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self.observers = []
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=policy.pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def _breaker(self, node):
+        with self._lock:
+            if node not in self._breakers:
+                self._breakers[node] = CircuitBreaker(node, self.policy.breaker_threshold,
+                                                      self.policy.breaker_cooldown)
+            return self._breakers[node]
+
+    @staticmethod
+    def _slot(node):
+        # requests not addressing a node (cluster/..., access/...) are only bound by the pool.
+        # a job holding another node's slot already counts against that node and does not
+        # wait for a second slot - two nodes' jobs calling each other's node would deadlock
+        held = threadpool.held_nodes()
+        if node is None or (held and node not in held):
+            return contextlib.nullcontext()
+        return threadpool.node_slot(node)
+
+    def _backoff(self, attempt):
+        delay = min(self.policy.backoff_max, self.policy.backoff_base * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    def _notify(self, method, url, status, duration, error):
+        for observer in self.observers:
+            try:
+                observer(method, url, status, duration, error)
+            except Exception as ex:
+                logging.debug(f"transport observer failed: {ex}")
+
+    def request(self, method, url, *args, **kwargs):
+        match = _node_pattern.search(url)
+        node = match.group(1) if match else None
+        breaker = self._breaker(node) if node else None
+        retries = self.policy.retries if method.upper() in IDEMPOTENT_METHODS else 0
+
+        attempt = 0
+        while True:
+            # a request already being retried is not rejected by its own failures
+            if node and attempt == 0 and not breaker.allow():
+                raise NodeUnavailable(f"node {node} is unavailable (circuit open), rejecting: {method} {url}")
+            start = time.time()
+            response, error = None, None
+            with self._slot(node):
+                try:
+                    response = self._send(method, url, *args, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                    error = ex
+            status = response.status_code if response is not None else None
+            self._notify(method, url, status, time.time() - start, error)
+
+            failed = error is not None or status in RETRYABLE_STATUSES
+            if not failed:
+                if breaker:
+                    breaker.record_success()
+                return response
+            if breaker:
+                breaker.record_failure()
+            if attempt >= retries:
+                if error is not None:
+                    raise error
+                return response
+            delay = self._backoff(attempt)
+            logging.debug(f"{method} {url} failed ({error or status}), retry {attempt + 1}/{retries} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def install(pve, policy: TransportPolicy=None) -> Transport:
+    """route all requests of the ProxmoxAPI object through a Transport"""
+    session = pve._store["session"]
+    if isinstance(getattr(session, "transport", None), Transport):
+        return session.transport
+    transport = Transport(session, policy or TransportPolicy())
+    session.request = transport.request
+    session.transport = transport
+    return transport
@@ -1,13 +1,16 @@
 import os
 import re
 import ipaddress
-import subprocess
 import time
 import logging
+import threading
 import requests
-import sys
 import proxmoxer
 
+from lbprox.common import access_bridge
+from lbprox.common import process
+from lbprox.common import threadpool
+from lbprox.common.tag_index import Selector, TagIndex
 from lbprox.common.vm_tags import VMTags
 from lbprox.ssh import ssh
 
@@ -17,24 +20,22 @@ def basicConfig(debug=False):
     logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-# write a method that would run subprocess.run with the given command returning the output
-def run_cmd(command, input=None, check=True, cwd=None):
-    logging.debug(f"running command: {command}")
-    return subprocess.run(command,
-                          shell=True, input=input,
-                          check=check,
-                          cwd=cwd,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE).stdout.decode().strip()
+def run_cmd(command, input=None, check=True, cwd=None, timeout=None):
+    """run the command and return its stripped stdout"""
+    result = process.run(command, cwd=cwd, input=input, keep_stdout=True, timeout=timeout)
+    if check:
+        result.check()
+    return result.stdout.strip()
 
 
-def run_cmd_stream_output(command, input=None, check=True, cwd=None):
-    logging.debug(f"running command: {command}")
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=cwd)
-    for line in iter(proc.stdout.readline, b''):
-        sys.stdout.buffer.write(line)
-    proc.stdout.close()
-    return proc.returncode
+def run_cmd_stream_output(command, input=None, check=True, cwd=None,
+                          timeout=None, idle_timeout=None, log_path=None):
+    """stream the command's stdout and stderr to ours, returns the exit code"""
+    result = process.run(command, cwd=cwd, input=input, log_path=log_path, echo=True,
+                         timeout=timeout, idle_timeout=idle_timeout)
+    if check:
+        result.check()
+    return result.returncode
 
 
 def list_allocations_in_cluster(pve):
@@ -43,6 +44,9 @@ def list_allocations_in_cluster(pve):
     for vm in vms:
         vmid = vm.get('vmid')
         tags = VMTags.parse_tags(vm.get('tags', ""))
+        if tags.get_pool():
+            # warm pool VMs are not part of any allocation until handed out
+            continue
         allocation_id = tags.get_allocation()
         if allocation_id not in allocations:
             allocations[allocation_id] = []
@@ -59,10 +63,12 @@ def list_allocations_in_cluster(pve):
 def filter_tags(items, tags: VMTags=None):
     if tags is None:
         return items
-    return [item for item in items if tags.is_subset(VMTags.parse_tags(item.get('tags', "")))]
+    return [item for item in items if tags.matches(item.get('tags', ""))]
 
-def list_cluster_vms(pve, tags: VMTags=None):
+def list_cluster_vms(pve, tags: VMTags=None, include_templates=False):
     items = pve.cluster().resources.get(type="vm")
+    if not include_templates:
+        items = [item for item in items if not item.get('template')]
     return filter_tags(items, tags)
 
 
@@ -82,18 +88,20 @@ def list_cluster_storage(pve, tags: VMTags=None):
 
 
 def list_cluster_resources(pve, resource_type, tag=None):
+    """cluster resources, optionally of one type and matching a tag selector (ex: allocation.b178)"""
     resources = pve.cluster().resources.get()
     # resources = run_cmd(f"pvesh get /cluster/resources --output-format json")
     # resources = json.loads(resources)
-    if tag and resource_type:
-        filtered_resources = [res for res in resources if res.get('type') == resource_type and tag in res.get('tags', [])]
-    elif tag:
-        filtered_resources = [res for res in resources if tag in res.get('tags', [])]
-    elif resource_type:
-        filtered_resources = [res for res in resources if res.get('type') == resource_type]
-    else:
-        filtered_resources = resources
-    return filtered_resources
+    if resource_type:
+        resources = [res for res in resources if res.get('type') == resource_type]
+    if tag:
+        resources = TagIndex(resources).select(Selector.parse(tag))
+    return resources
+
+
+def select_cluster_vms(pve, selector: Selector, include_templates=False):
+    """VMs matching a tag selector, answered from an index of one cluster snapshot"""
+    return TagIndex.from_cluster(pve, "vm", include_templates).select(selector)
 
 
 def seconds_to_human_readable(seconds):
@@ -124,28 +132,14 @@ def zero_out_host_bits(cidr):
 
 def get_or_create_access_bridge(pve, hostname, bridge_name,
                                 ssh_username, ssh_password):
-    net_devices = pve.nodes(hostname).network.get()
-    access_bridge_network = (next(iter([dev for dev in net_devices if dev["iface"] == bridge_name]), None))
-
-    if access_bridge_network:
-        assert access_bridge_network["cidr"], "we assume we have this bridge network as our access network"
-        return access_bridge_network
-
-    ssh_client = ssh.SSHClient(hostname, ssh_username, ssh_password)
-    default_iface, cidr, gateway = ssh_client.get_network_info_via_ssh()
-    if not default_iface:
-        logging.error("could not determine default interface.")
+    with ssh.SSHPool(ssh_username, ssh_password) as pool:
+        plans = access_bridge.plan_access_bridges(pve, [hostname], bridge_name, pool)
+        access_bridge.apply_access_bridges(pve, plans, pool)
+    plan = plans[0]
+    if plan.failed():
+        logging.error(f"{hostname}: no usable bridge {bridge_name}: {plan.error or plan.reason}")
         return None
-
-    ssh_client.close()
-    pve.nodes(hostname).network.post(iface=bridge_name, type="bridge",
-                                     cidr=cidr, autostart='1',
-                                     gateway=gateway,
-                                     bridge_ports=default_iface)
-
-    pve.nodes(hostname).network().put()
-    access_bridge_network = pve.nodes(hostname).network.get(bridge_name)
-    return access_bridge_network
+    return pve.nodes(hostname).network.get(bridge_name)
 
 
 def get_vm_ip_address(pve, hostname, vmid, expected_ip_addresses=1, tmo=60, interval=10):
@@ -225,6 +219,32 @@ def wait_for_vm_status(pve, hostname, vmid, desired_status, tmo=60, interval=5):
     logging.warning(f"timed out ({tmo}s) waiting for status {desired_status} on {hostname}:{vmid}")
 
 
+_reserved_vmids = set()
+_reserved_vmids_lock = threading.Lock()
+
+
+def _vmid_is_free(pve, vmid):
+    try:
+        pve.cluster().nextid().get(vmid=vmid)
+        return True
+    except proxmoxer.core.ResourceException:
+        return False
+
+
+def next_vmid(pve):
+    """the cluster's next free VMID. nextid does not reserve it, so ids handed out
+    to concurrent creations of this process are skipped until the VM exists.
+    """
+    with _reserved_vmids_lock:
+        vmid = free_vmid = int(pve.cluster().nextid().get())
+        # ids below the next free one were created since, they need no reservation anymore
+        _reserved_vmids.difference_update([reserved for reserved in _reserved_vmids if reserved < vmid])
+        while vmid in _reserved_vmids or (vmid != free_vmid and not _vmid_is_free(pve, vmid)):
+            vmid += 1
+        _reserved_vmids.add(vmid)
+        return vmid
+
+
 def get_disk_size(pve, hostname, vmid, disk_name):
     vm_config = pve.nodes(hostname).qemu(vmid).config.get()
     disk_info_list = vm_config[disk_name].split(',')
@@ -357,29 +377,77 @@ def find_unattached_vfs(pve, hostname):
     return unattached_devices
 
 
-def create_emulated_ssds(pve, hostname, vmid, storage_id, disk_count, size_in_bytes: int):
+# sparse - files are allocated on first write
+# falloc - blocks are reserved up front with fallocate
+# full - blocks are reserved and zeroed, slowest to create but no first-write penalty
+EMULATED_SSD_PROVISIONING = ["sparse", "falloc", "full"]
+
+
+def emulated_ssd_drive_name(idx, format="raw"):
+    return f"nvme{idx:02d}.{format}"
+
+
+def create_emulated_ssds(pve, hostname, vmid, storage_id, disk_count, size_in_bytes: int,
+                         provisioning="sparse", ssh_client: ssh.SSHClient=None, max_workers=8):
     """Create emulated SSDs for a VM.
 
-    content create API expects size in kilobytes.
+    all backing files of the VM are created concurrently, see create_emulated_ssd_files.
     """
-    format = "raw"
-    drives_info = pve.nodes(hostname).storage(storage_id).content.get(vmid=vmid)
+    disks = [(vmid, emulated_ssd_drive_name(i), size_in_bytes) for i in range(disk_count)]
+    return create_emulated_ssd_files(pve, hostname, storage_id, disks,
+                                     provisioning, ssh_client, max_workers)
 
-    size_in_kb = size_in_bytes // 1024  # convert to kilobytes
-    for i in range(disk_count):
-        drive_idx = f"{i:02d}"
-        drive_name = f"nvme{drive_idx}.{format}"
+
+def create_emulated_ssd_files(pve, hostname, storage_id, disks, provisioning="sparse",
+                              ssh_client: ssh.SSHClient=None, max_workers=8):
+    """Create emulated SSD backing files, possibly of several VMs, concurrently.
+
+    disks is a list of (vmid, drive_name, size_in_bytes) tuples.
+    content create API expects size in kilobytes, it creates sparse files -
+    preallocated files are then reserved over ssh, hence ssh_client is required
+    for any provisioning other than sparse.
+    returns the list of volids that were created.
+    """
+    if provisioning not in EMULATED_SSD_PROVISIONING:
+        raise ValueError(f"invalid provisioning: {provisioning}, must be one of {EMULATED_SSD_PROVISIONING}")
+    if provisioning != "sparse" and ssh_client is None:
+        raise ValueError(f"ssh client is required for {provisioning} provisioning")
+
+    vmids = {vmid for vmid, _, _ in disks}
+    if len(vmids) == 1:
+        drives_info = pve.nodes(hostname).storage(storage_id).content.get(vmid=next(iter(vmids)))
+    else:
+        drives_info = pve.nodes(hostname).storage(storage_id).content.get(content="images")
+    existing_volids = {drive_info["volid"] for drive_info in drives_info}
+
+    def _create_disk(vmid, drive_name, size_in_bytes):
         volid = f"{storage_id}:{vmid}/{drive_name}"
         file_path = os.path.join(get_images_path(storage_id), f"{vmid}/{drive_name}")
-        exists = False
-        for drive_info in drives_info:
-            if drive_info["volid"] == volid:
-                logging.debug(f"emulated ssd file already exists at: {file_path}")
-                exists = True
-                break
-        if not exists:
-            pve.nodes(hostname).storage(storage_id).content.create(vmid=vmid, filename=drive_name, size=size_in_kb, format=format)
-            logging.debug(f"created emulated ssd file at: {file_path}")
+        size_in_kb = size_in_bytes // 1024  # convert to kilobytes
+        format = drive_name.rsplit('.', 1)[-1]
+        pve.nodes(hostname).storage(storage_id).content.create(vmid=vmid, filename=drive_name,
+                                                               size=size_in_kb, format=format)
+        if provisioning == "falloc":
+            ssh_client.run_command(f"fallocate -l {size_in_bytes} {file_path}")
+        elif provisioning == "full":
+            size_in_mb = size_in_bytes // 1024**2
+            ssh_client.run_command(f"dd if=/dev/zero of={file_path} bs=1M count={size_in_mb} "
+                                   "oflag=direct conv=notrunc status=none")
+        logging.debug(f"created emulated ssd file at: {file_path} ({provisioning})")
+        return volid
+
+    missing = []
+    for vmid, drive_name, size_in_bytes in disks:
+        if f"{storage_id}:{vmid}/{drive_name}" in existing_volids:
+            logging.debug(f"emulated ssd file already exists: {storage_id}:{vmid}/{drive_name}")
+            continue
+        missing.append((vmid, drive_name, size_in_bytes))
+    if not missing:
+        return []
+    return threadpool.run_with_threadpool(_create_disk, missing,
+                                          desc=f"creating {len(missing)} emulated ssds on {hostname}",
+                                          max_workers=max_workers,
+                                          node_of=lambda job_args: hostname)
 
 
 def delete_emulated_ssds(pve, hostname, vmid, storage_id):
@@ -1,5 +1,35 @@
+import sys
+import threading
+
+
+# parsed tag strings, keyed by the raw string as returned by the API.
+# the same strings are parsed again on every cluster listing, so this is bounded
+# only to protect long running services from unbounded growth
+_PARSE_CACHE_SIZE = 32768
+_parse_cache = {}
+_parse_cache_lock = threading.Lock()
+
+
+def _parse(raw):
+    """returns the {key: value} dict of a raw tags string, shared - must not be modified"""
+    parsed = _parse_cache.get(raw)
+    if parsed is not None:
+        return parsed
+    parsed = {}
+    for tag in raw.split(';'):
+        key, sep, value = tag.partition('.')
+        if sep:
+            parsed[sys.intern(key)] = value
+    with _parse_cache_lock:
+        if len(_parse_cache) >= _PARSE_CACHE_SIZE:
+            _parse_cache.clear()
+        _parse_cache[raw] = parsed
+    return parsed
+
 
 class VMTags():
+    __slots__ = ("tags",)
+
     def __init__(self, tags=None):
         self.tags = tags if tags else {}
 
@@ -30,6 +60,9 @@ class VMTags():
     def get_allocation(self):
         return self.tags.get('allocation')
 
+    def get_pool(self):
+        return self.tags.get('pool')
+
     def get_all_tags(self):
         return self.tags
 
@@ -69,6 +102,10 @@ class VMTags():
         self.tags['allocation'] = allocation
         return self
 
+    def set_pool(self, flavor):
+        self.tags['pool'] = flavor
+        return self
+
     def str(self):
         return ';'.join([f"{key}.{value}" for key, value in self.tags.items()])
 
@@ -85,7 +122,19 @@ class VMTags():
         return self.tags != other.get_tags()
 
     def is_subset(self, other):
-        return all([self.get_tag(key) == other.get_tag(key) for key in self.tags.keys()])
+        other_tags = other.tags
+        for key, value in self.tags.items():
+            if other_tags.get(key) != value:
+                return False
+        return True
+
+    def matches(self, raw_tags: str):
+        """is_subset against a raw tags string, without building a VMTags for it"""
+        other_tags = _parse(raw_tags or "")
+        for key, value in self.tags.items():
+            if other_tags.get(key) != value:
+                return False
+        return True
 
     # def construct_vm_tags(node, cluster_name, cluster_id, server_name, unique_id):
     #     return f"node.{node},cname.{cluster_name},sname.{server_name},cid.{cluster_id},allocation.{unique_id}"
@@ -93,15 +142,4 @@ class VMTags():
     @staticmethod
     def parse_tags(tags):
         """get representation of tags as string and return dict format"""
-        splitted = tags.split(';')
-        new_tags = VMTags()
-        for tag in splitted:
-            if len(tag.split('.')) == 2:
-                key, value = tag.split('.')
-                new_tags.set_tag(key, value)
-            if len(tag.split('.')) > 2:
-                splitted = tag.split('.')
-                new_tags.set_tag(splitted[0], ".".join(splitted[1:]))
-        return new_tags
-
-
+        return VMTags(dict(_parse(tags)))
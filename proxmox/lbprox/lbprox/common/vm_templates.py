@@ -0,0 +1,169 @@
+import logging
+import threading
+
+from lbprox.common import tasks
+from lbprox.common import utils
+from lbprox.common.vm_tags import VMTags
+
+
+# VMs created from a template are either linked clones (sharing the template's
+# base disk) or full clones. "import" keeps the legacy behavior of importing the
+# os image into every VM.
+CLONE_MODES = ["linked", "full", "import"]
+
+TEMPLATE_TAG = "template"
+IMAGE_SIGNATURE_TAG = "imgsig"
+STORAGE_TAG = "storage"
+STALE_TAG = "stale"
+
+_locks_guard = threading.Lock()
+_template_locks = {}
+
+
+def _template_lock(hostname, storage_id, os_image):
+    key = (hostname, storage_id, os_image)
+    with _locks_guard:
+        if key not in _template_locks:
+            _template_locks[key] = threading.Lock()
+        return _template_locks[key]
+
+
+def os_image_volid(storage_id, os_image):
+    return f"{storage_id}:iso/{os_image}.img"
+
+
+def os_image_volumes(pve, hostname, storage_id):
+    """{os image: volume} of the os images stored on the node"""
+    prefix, suffix = f"{storage_id}:iso/", ".img"
+    return {volume["volid"][len(prefix):-len(suffix)]: volume
+            for volume in pve.nodes(hostname).storage(storage_id).content.get(content="iso")
+            if volume.get("volid", "").startswith(prefix) and volume["volid"].endswith(suffix)}
+
+
+def volume_signature(volume):
+    return f"{volume.get('size', 0)}-{volume.get('ctime', 0)}"
+
+
+def os_image_signature(pve, hostname, storage_id, os_image):
+    """returns a signature of the os image stored on the node, or None if the
+    image does not exist. the signature changes whenever the image is re-uploaded.
+    """
+    volume = os_image_volumes(pve, hostname, storage_id).get(os_image)
+    return volume_signature(volume) if volume else None
+
+
+def list_templates(pve, hostname=None, storage_id=None, os_image=None):
+    """list lbprox templates in the cluster, optionally filtered by node, storage and image"""
+    tags = VMTags()
+    if hostname:
+        tags.set_node(hostname)
+    if storage_id:
+        tags.set_tag(STORAGE_TAG, storage_id)
+    if os_image:
+        tags.set_tag(TEMPLATE_TAG, os_image)
+    templates = utils.list_cluster_vms(pve, tags, include_templates=True)
+    return [vm for vm in templates
+            if vm.get("template") and VMTags.parse_tags(vm.get("tags", "")).get_tag(TEMPLATE_TAG)]
+
+
+def _find_template(pve, hostname, storage_id, os_image, signature):
+    """returns the vmid of a valid template. templates built from an older
+    version of the image are marked as stale, and removed if no clone uses them.
+    """
+    valid_vmid = None
+    for template in list_templates(pve, hostname, storage_id, os_image):
+        tags = VMTags.parse_tags(template.get("tags", ""))
+        if tags.get_tag(STALE_TAG):
+            continue
+        if tags.get_tag(IMAGE_SIGNATURE_TAG) == signature and valid_vmid is None:
+            valid_vmid = template["vmid"]
+            continue
+        invalidate_template(pve, hostname, template["vmid"], tags)
+    return valid_vmid
+
+
+def invalidate_template(pve, hostname, vmid, tags: VMTags=None):
+    """delete the template, linked clones still referencing its base disk
+    prevent the deletion - in that case we only mark it as stale.
+    """
+    try:
+        upid = pve.nodes(hostname).qemu(vmid).delete(purge=1)
+        tasks.wait_for_task(pve, upid)
+        logging.info(f"deleted template {hostname}:{vmid}")
+        return True
+    except Exception as ex:
+        logging.warning(f"failed to delete template {hostname}:{vmid}, marking as stale: {ex}")
+        if tags is None:
+            config = pve.nodes(hostname).qemu(vmid).config.get()
+            tags = VMTags.parse_tags(config.get("tags", ""))
+        tags.set_tag(STALE_TAG, "1")
+        pve.nodes(hostname).qemu(vmid).config.put(tags=tags.str())
+        return False
+
+
+def _create_template(pve, hostname, storage_id, os_image, signature, boot_disk_size):
+    vmid = utils.next_vmid(pve)
+    os_image_path = f"{utils.get_storage_path(storage_id)}/template/iso/{os_image}.img"
+    tags = VMTags().\
+        set_node(hostname).\
+        set_tag(TEMPLATE_TAG, os_image).\
+        set_tag(STORAGE_TAG, storage_id).\
+        set_tag(IMAGE_SIGNATURE_TAG, signature)
+
+    logging.info(f"creating template for image {os_image} on {hostname}:{storage_id} with vmid: {vmid}")
+    # linked clones on directory storage require a qcow2 base disk
+    upid = pve.nodes(hostname).qemu.create(
+        vmid=vmid,
+        name=f"tmpl-{os_image}",
+        memory=1024,
+        cores=1,
+        sockets=1,
+        cpu="host",
+        agent=1,
+        tags=tags.str(),
+        scsihw="virtio-scsi-pci",
+        virtio0=f"{storage_id}:0,import-from={os_image_path},format=qcow2,discard=on",
+        boot="order=virtio0;ide2;net0",
+        citype="nocloud",
+        ciuser="root",
+        ide2=f"{storage_id}:cloudinit",
+    )
+    tasks.wait_for_task(pve, upid)
+
+    current_size = utils.get_disk_size(pve, hostname, vmid, "virtio0")
+    if current_size is not None and current_size < utils.convert_size_to_bytes(boot_disk_size):
+        pve.nodes(hostname).qemu(vmid).resize.put(disk="virtio0", size=boot_disk_size)
+
+    pve.nodes(hostname).qemu(vmid).template.post()
+    return vmid
+
+
+def get_or_create_template(pve, hostname, storage_id, os_image, boot_disk_size):
+    """returns the vmid of the template for the (node, storage, os image)
+    building it lazily on first use, or when the os image changed.
+
+    templates are per node since directory storage is local to the node.
+    """
+    with _template_lock(hostname, storage_id, os_image):
+        signature = os_image_signature(pve, hostname, storage_id, os_image)
+        if signature is None:
+            raise RuntimeError(f"os image '{os_image_volid(storage_id, os_image)}' not found on node: {hostname}")
+        vmid = _find_template(pve, hostname, storage_id, os_image, signature)
+        if vmid is None:
+            vmid = _create_template(pve, hostname, storage_id, os_image, signature, boot_disk_size)
+        return vmid
+
+
+def clone_vm(pve, hostname, template_vmid, vmid, vm_name, storage_id, full=False):
+    """create VM vmid as a clone of the template"""
+    clone_args = {
+        "newid": vmid,
+        "name": vm_name,
+        "full": 1 if full else 0,
+    }
+    if full:
+        clone_args["storage"] = storage_id
+        clone_args["format"] = "raw"
+    logging.debug(f"cloning VM {vm_name} ({vmid}) from template {template_vmid} (full: {full})")
+    upid = pve.nodes(hostname).qemu(template_vmid).clone.post(**clone_args)
+    tasks.wait_for_task(pve, upid)
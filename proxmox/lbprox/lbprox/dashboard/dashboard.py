@@ -5,6 +5,7 @@ import socketserver
 import logging
 import os
 import sys
+import time
 import functools
 
 from jinja2 import Template
@@ -12,8 +13,10 @@ from jinja2 import Template
 from threading import Thread
 from threading import Event
 from lbprox.common import constants
+from lbprox.common import metrics
 from lbprox.common import utils
 from lbprox.common.vm_tags import VMTags
+from lbprox.state import store
 
 
 DASHBOARD_BASE_DIR = os.path.join(constants.BASE_DIR, "dashboard")
@@ -169,9 +172,9 @@ th {
 """
 
 
-def update_ui(pve, observability_hostname):
+def update_ui(pve, observability_hostname, max_age=0):
     try:
-        grouped_vms_by_cluster = fetch_vms(pve, observability_hostname)
+        grouped_vms_by_cluster = fetch_vms(pve, observability_hostname, max_age)
         data = {
             'hostname': observability_hostname,
             'grouped_vms_by_cluster': grouped_vms_by_cluster,
@@ -191,58 +194,67 @@ def render_template(data):
     logging.info(f"HTML file created: {DASHBOARD_INDEX_HTML}")
 
 
-def fetch_vms(pve, observability_hostname):
-    qemu_vms = utils.list_cluster_vms(pve)
-
-    grouped_qemu_vms = {}
-    for qemu_vm in qemu_vms:
-        node_name = qemu_vm['node']
-        if node_name not in grouped_qemu_vms:
-            grouped_qemu_vms[node_name] = []
-        grouped_qemu_vms[node_name].append(qemu_vm)
+def fetch_vms(pve, observability_hostname, max_age=0):
+    """the dashboard rows, answered from the local state store. the store is reconciled
+    first unless it was, by this or another lbprox process, in the last max_age seconds
+    """
+    state = store.open_store()
+    state.ensure_fresh(pve, max_age)
+    now = time.time()
 
     grouped_vms_by_cluster = {}
-    for node_name, vms in grouped_qemu_vms.items():
-        for vm in vms:
-            tags = VMTags.parse_tags(vm.get('tags', ""))
-            if node_name not in grouped_vms_by_cluster:
-                grouped_vms_by_cluster[node_name] = {}
-            allocation_id = tags.get_allocation()
-            if allocation_id not in grouped_vms_by_cluster[node_name]:
-                grouped_vms_by_cluster[node_name][allocation_id] = []
-
-            vmid = vm['vmid']
-            ip_addresses = utils.get_vm_ip_address(pve, node_name, vmid, 0, 0) if vm['status'] == 'running' else []
-            access_ip = next(iter([ip_address['ipv4'] for ip_address in ip_addresses if ip_address['purpose'] == 'access']), None)
-            ip_addresses_str = [f"{ip_address['ipv4']} ({ip_address['purpose']})" for ip_address in ip_addresses if ip_address != '']
-            vm_metadata = {
-                'id': vmid,
-                'name': vm['name'],
-                'status': vm['status'],
-                'tags': vm['tags'],
-                'allocation_id': tags.get_allocation(),
-                'role': tags.get_role(),
-                'uptime': utils.seconds_to_human_readable(vm['uptime']),
-                'ip_addresses': ", ".join(ip_addresses_str),
-                'cluster_id': tags.get_cluster_id(),
-                'cluster_name': tags.get_cluster_name(),
-                'access_ip': access_ip,
-                'lightbits_version': tags.get_version() if tags.get_role() == 'target' else "",
-                'ssh_access': f"ssh root@{access_ip}",
-                'grafana_server_dashboard': f"http://{observability_hostname}:3000/d/Wb5yjAcGk/lightbits-server-performance-tab?orgId=1&refresh=5s&var-allocation_descriptor=instance%3D%22{access_ip}:8090%22,job%3D%228bb1%22&var-job=8bb1&var-Prometheus=P1809F7CD0C75ACF3&var-exporter_port=8090&var-instance={access_ip}:8090",
-                'grafana_volumes_dashboard': f"http://{observability_hostname}:3000/d/TVDUM714z/lightbits-volumes-performance-tab?orgId=1&refresh=1m&var-allocation_descriptor=instance%3D%22{access_ip}:8090%22,job%3D%22346b%22&var-job=346b&var-instance={access_ip}:8090&var-Prometheus=P1809F7CD0C75ACF3&var-exporter_port=8090",
-            }
-
-            grouped_vms_by_cluster[node_name][allocation_id].append(vm_metadata)
+    for vm in state.vms():
+        node_name = vm['node']
+        tags = VMTags.parse_tags(vm.get('tags', ""))
+        if node_name not in grouped_vms_by_cluster:
+            grouped_vms_by_cluster[node_name] = {}
+        allocation_id = tags.get_allocation()
+        if allocation_id not in grouped_vms_by_cluster[node_name]:
+            grouped_vms_by_cluster[node_name][allocation_id] = []
+
+        vmid = vm['vmid']
+        ip_addresses = vm['ip_addresses']
+        # the uptime was recorded at the last reconcile
+        uptime = vm['uptime'] + (now - vm['updated'] if vm['status'] == 'running' else 0)
+        access_ip = next(iter([ip_address['ipv4'] for ip_address in ip_addresses if ip_address['purpose'] == 'access']), None)
+        ip_addresses_str = [f"{ip_address['ipv4']} ({ip_address['purpose']})" for ip_address in ip_addresses if ip_address != '']
+        vm_metadata = {
+            'id': vmid,
+            'name': vm['name'],
+            'status': vm['status'],
+            'tags': vm['tags'],
+            'allocation_id': tags.get_allocation(),
+            'role': tags.get_role(),
+            'uptime': utils.seconds_to_human_readable(uptime),
+            'ip_addresses': ", ".join(ip_addresses_str),
+            'cluster_id': tags.get_cluster_id(),
+            'cluster_name': tags.get_cluster_name(),
+            'access_ip': access_ip,
+            'lightbits_version': tags.get_version() if tags.get_role() == 'target' else "",
+            'ssh_access': f"ssh root@{access_ip}",
+            'grafana_server_dashboard': f"http://{observability_hostname}:3000/d/Wb5yjAcGk/lightbits-server-performance-tab?orgId=1&refresh=5s&var-allocation_descriptor=instance%3D%22{access_ip}:8090%22,job%3D%228bb1%22&var-job=8bb1&var-Prometheus=P1809F7CD0C75ACF3&var-exporter_port=8090&var-instance={access_ip}:8090",
+            'grafana_volumes_dashboard': f"http://{observability_hostname}:3000/d/TVDUM714z/lightbits-volumes-performance-tab?orgId=1&refresh=1m&var-allocation_descriptor=instance%3D%22{access_ip}:8090%22,job%3D%22346b%22&var-job=346b&var-instance={access_ip}:8090&var-Prometheus=P1809F7CD0C75ACF3&var-exporter_port=8090",
+        }
+
+        grouped_vms_by_cluster[node_name][allocation_id].append(vm_metadata)
 
     return grouped_vms_by_cluster
 
 
+class DashboardHandler(http.server.SimpleHTTPRequestHandler):
+    """serves the rendered dashboard, and the lbprox API metrics at /metrics"""
+    def do_GET(self):
+        if self.path == "/metrics":
+            metrics.write_metrics_response(self)
+            return
+        super().do_GET()
+
+
 def run_web_server(port):
     web_dir = DASHBOARD_BASE_DIR
     os.chdir(web_dir)
 
-    Handler = http.server.SimpleHTTPRequestHandler
+    Handler = DashboardHandler
     httpd = socketserver.TCPServer(("", port), Handler)
     print("serving at port", port)
     httpd.serve_forever()
@@ -260,7 +272,8 @@ def serve(pve, port, refresh_interval, observability_hostname):
     os.makedirs(DASHBOARD_BASE_DIR, exist_ok=True)
     # UPDATE_UI_INTERVAL = 10
     global update_ui_thread
-    partial_update_ui = functools.partial(update_ui, pve, observability_hostname)
+    # reconciling is skipped when another service, ex. prom-discovery, just did it
+    partial_update_ui = functools.partial(update_ui, pve, observability_hostname, refresh_interval)
     update_ui_thread = RepeatingTimer(refresh_interval, partial_update_ui)
     update_ui_thread.start()
     run_web_server(port)
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 import getpass
+import hashlib
+import json
 import os
+import tempfile
 from jinja2 import Template
-import subprocess
 import logging
-from lbprox.common import utils
 from lbprox.common.constants import INVENTORIES_DIR
 from lbprox.common.vm_tags import VMTags
 
@@ -84,6 +85,9 @@ services:
     - UNAME={{ data.uname }}  # (4) username retrieved by `id -un`
     - ANSIBLE_LOG_PATH=/inventory/logs/ansible.log
     - ANSIBLE_FORCE_COLOR=True
+{%- for variable in data.ansible_env %}
+    - {{ variable }}
+{%- endfor %}
     working_dir: /ansible
     volumes:
     - {{ data.light_app_path }}:/ansible # (5) contains ansible-playbook and roles
@@ -100,7 +104,7 @@ services:
           -e lightos_default_admin_jwt=/inventory/lightos-certificates/lightos_default_admin_jwt \\
           -e certificates_directory=/inventory/lightos-certificates \\
           -e inject_jwt_to_nodes=true \\
-          playbooks/deploy-lightos.yml -vvv'
+          playbooks/deploy-lightos.yml'
 
   cleanup:
     <<: *lb-ansible-base
@@ -109,7 +113,7 @@ services:
       sh -c 'mkdir -p /inventory/logs && \\
           ansible-playbook \\
           -i /inventory/hosts \\
-          playbooks/cleanup-lightos-playbook.yml --tags=cleanup -vvv'
+          playbooks/cleanup-lightos-playbook.yml --tags=cleanup'
 
   deploy-initiator:
     <<: *lb-ansible-base
@@ -118,10 +122,44 @@ services:
       sh -c 'mkdir -p /inventory/logs && \\
           ansible-playbook \\
           -i /inventory/hosts \\
-          playbooks/deploy-nvme-tcp-initiator.yml --tags=install-client -vvv'
+          playbooks/deploy-nvme-tcp-initiator.yml --tags=install-client'
 
 """
 
+# how ansible runs the deployment, as ANSIBLE_* variables layered on the playbook repo's own ansible.cfg:
+# tuned - forks for all hosts at once, pipelining and facts cached in the inventory directory
+# debug - tuned, with the verbose output of -vvv
+# baseline - only -vvv, as deployments ran before the profiles
+ANSIBLE_PROFILES = {
+    "tuned": {"verbosity": 1, "forks": True, "fact_caching": True, "pipelining": True},
+    "debug": {"verbosity": 3, "forks": True, "fact_caching": True, "pipelining": True},
+    "baseline": {"verbosity": 3, "forks": False, "fact_caching": False, "pipelining": False},
+}
+DEFAULT_ANSIBLE_PROFILE = "tuned"
+# ansible's own default, used as the lower bound
+MIN_FORKS = 5
+MAX_FORKS = 50
+
+
+def ansible_environment(profile: str, host_count: int):
+    """the ANSIBLE_* variables of an ansible profile, as [name=value]"""
+    if profile not in ANSIBLE_PROFILES:
+        raise ValueError(f"unknown ansible profile: {profile}, expected one of: {', '.join(ANSIBLE_PROFILES)}")
+    settings = ANSIBLE_PROFILES[profile]
+    env = [f"ANSIBLE_VERBOSITY={settings['verbosity']}"]
+    if settings["forks"]:
+        # every host gets its own fork, so no host waits for another's task
+        env.append(f"ANSIBLE_FORKS={min(max(host_count, MIN_FORKS), MAX_FORKS)}")
+    if settings["pipelining"]:
+        env.append("ANSIBLE_PIPELINING=True")
+    if settings["fact_caching"]:
+        env += ["ANSIBLE_GATHERING=smart",
+                "ANSIBLE_CACHE_PLUGIN=jsonfile",
+                "ANSIBLE_CACHE_PLUGIN_CONNECTION=/inventory/.ansible-facts",
+                "ANSIBLE_CACHE_PLUGIN_TIMEOUT=7200"]
+    return env
+
+
 # write a function that would render the template and save it to a file
 def render_template(template, data, output_file):
     rendered_template = Template(template).render(data=data)
@@ -137,34 +175,117 @@ def inventory_directory_exists(allocation_id: str):
     return os.path.exists(inventory_directory(allocation_id))
 
 
-def generate_inventory(allocation_id: str,
-                       cluster_info, initiators,
-                       repo_base_url: str,
-                       profile_name: str=None,
-                       ec_enabled: bool=False,
-                       initial_device_count: int=4,
-                       light_app_path: str=None):
-    cluster_inventory_dir = inventory_directory(allocation_id)
-    os.makedirs(cluster_inventory_dir, exist_ok=True)
+# records the hash of every generated file, only files listed here are ever
+# replaced or removed - logs, certificates and traces are left alone
+MANIFEST_FILE = ".inventory-manifest.json"
+
+
+class InventoryDiff(object):
+    def __init__(self):
+        self.added = []
+        self.changed = []
+        self.removed = []
+        self.unchanged = []
+
+    def modified(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def summary(self):
+        if not self.modified():
+            return f"inventory unchanged ({len(self.unchanged)} files)"
+        parts = []
+        for title, files in (("added", self.added), ("changed", self.changed), ("removed", self.removed)):
+            if files:
+                parts.append(f"{title}: {', '.join(sorted(files))}")
+        return "; ".join(parts)
+
+
+def _digest(content: str):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _write_atomic(path, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
+
+def _read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            return json.load(f).get("files", {})
+    except FileNotFoundError:
+        return {}
+    except (ValueError, AttributeError) as ex:
+        logging.warning(f"ignoring corrupted inventory manifest in {directory}: {ex}")
+        return {}
+
+
+def sync_inventory(directory, files: dict):
+    """write {relative path: content} into directory, only the files that differ.
+
+    a file is unchanged when its hash matches the manifest of the previous run
+    and it still exists. changed files are replaced atomically, files of the
+    previous run that are no longer generated are removed.
+    """
+    previous = _read_manifest(directory)
+    diff = InventoryDiff()
+    manifest = {}
+    for relpath, content in sorted(files.items()):
+        digest = _digest(content)
+        manifest[relpath] = digest
+        path = os.path.join(directory, relpath)
+        if previous.get(relpath) == digest and os.path.exists(path):
+            diff.unchanged.append(relpath)
+            continue
+        (diff.changed if os.path.exists(path) else diff.added).append(relpath)
+        _write_atomic(path, content)
+    for relpath in previous:
+        if relpath in manifest:
+            continue
+        try:
+            os.unlink(os.path.join(directory, relpath))
+            diff.removed.append(relpath)
+        except FileNotFoundError:
+            pass
+    if diff.modified() or previous != manifest:
+        _write_atomic(os.path.join(directory, MANIFEST_FILE),
+                      json.dumps({"files": manifest}, indent=2, sort_keys=True))
+    return diff
+
+
+def render_inventory(cluster_info, initiators,
+                     repo_base_url: str,
+                     profile_name: str=None,
+                     ec_enabled: bool=False,
+                     initial_device_count: int=4,
+                     light_app_path: str=None,
+                     ansible_profile: str=DEFAULT_ANSIBLE_PROFILE):
+    """the inventory files as {relative path: content}"""
+    files = {}
     compose_render_context = {
         'lb_ansible_img': 'docker.lightbitslabs.com/lbprox/lb-ansible:v9.13.0',
         'uid': os.getuid(),
         'gid': os.getgid(),
         'uname': getpass.getuser(),
         'light_app_path': light_app_path,
+        'ansible_env': ansible_environment(ansible_profile,
+                                           len(cluster_info['servers']) + len(initiators)),
     }
-    docker_compose_path = os.path.join(cluster_inventory_dir, 'docker-compose.yml')
-    render_template(docker_compose_template,
-                    compose_render_context,
-                    docker_compose_path)
+    files['docker-compose.yml'] = Template(docker_compose_template).render(data=compose_render_context)
 
-    hosts_path = os.path.join(cluster_inventory_dir, 'hosts')
     data = {
         'targets': cluster_info['servers'],
         'initiators': initiators,
     }
-    render_template(hosts_template, data, hosts_path)
+    files['hosts'] = Template(hosts_template).render(data=data)
 
     group_vars_info = {
         "cluster_info": {
@@ -172,66 +293,43 @@ def generate_inventory(allocation_id: str,
         },
         "repo_base_url": repo_base_url
     }
-    group_vars_dir = os.path.join(cluster_inventory_dir, "group_vars")
-    group_vars_all_path = os.path.join(group_vars_dir, 'all.yml')
-    os.makedirs(group_vars_dir, exist_ok=True)
-    render_template(group_vars_template,
-                    group_vars_info,
-                    group_vars_all_path)
-
-    host_vars_dir = os.path.join(cluster_inventory_dir, "host_vars")
-    os.makedirs(host_vars_dir, exist_ok=True)
+    files[os.path.join("group_vars", "all.yml")] = Template(group_vars_template).render(data=group_vars_info)
+
+    host_vars = Template(host_vars_template)
     for server_name, server_info in cluster_info['servers'].items():
         # take profile_name from tags, unless it is provided from the CLI
         # if none provided use 'virtual-datapath-templates' as default
         tags: VMTags = server_info["tags"]
         if profile_name is None:
-            profile_name = 'virtual-datapath-templates'
-            if tags.get_tag('datapath_profile'):
-                profile_name = tags.get_tag('datapath_profile')
+            server_profile_name = tags.get_tag('datapath_profile') or 'virtual-datapath-templates'
         else:
-            profile_name = profile_name.strip()
+            server_profile_name = profile_name.strip()
 
         data = {
-            'profile_name': profile_name,
+            'profile_name': server_profile_name,
             'server': server_info,
-	        'ec_enabled': str(ec_enabled).lower(),
+            'ec_enabled': str(ec_enabled).lower(),
             'initial_device_count': initial_device_count
         }
-        host_file_path = os.path.join(host_vars_dir, f'{server_name}.yml')
-        render_template(host_vars_template,
-                        data, host_file_path)
-    return cluster_inventory_dir
-
-
-def deploy_cluster(inventory_dir: str, stream_output: bool=True):
-    cmd = "docker compose run --rm -i deploy"
-    try:
-        if os.environ.get('WORKSPACE_TOP', None) is None:
-            raise Exception("WORKSPACE_TOP environment variable is not set")
-        if stream_output:
-            utils.run_cmd_stream_output(cmd, cwd=inventory_dir)
-        else:
-            utils.run_cmd(cmd, cwd=inventory_dir)
-    except subprocess.CalledProcessError as e:
-        logging.error(e.stderr.decode().strip())
-    except Exception as e:
-        logging.error(e)
+        files[os.path.join("host_vars", f"{server_name}.yml")] = host_vars.render(data=data)
+    return files
 
 
-def deploy_nvme_initiator(inventory_dir: str, stream_output: bool=True):
-    cmd = "docker compose run --rm -i deploy-initiator"
-    try:
-        if os.environ.get('WORKSPACE_TOP', None) is None:
-            raise Exception("WORKSPACE_TOP environment variable is not set")
-        if stream_output:
-            utils.run_cmd_stream_output(cmd, cwd=inventory_dir)
-        else:
-            utils.run_cmd(cmd, cwd=inventory_dir)
-    except subprocess.CalledProcessError as e:
-        logging.error(e.stderr.decode().strip())
-    except Exception as e:
-        logging.error(e)
+def generate_inventory(allocation_id: str,
+                       cluster_info, initiators,
+                       repo_base_url: str,
+                       profile_name: str=None,
+                       ec_enabled: bool=False,
+                       initial_device_count: int=4,
+                       light_app_path: str=None,
+                       ansible_profile: str=DEFAULT_ANSIBLE_PROFILE):
+    cluster_inventory_dir = inventory_directory(allocation_id)
+    os.makedirs(cluster_inventory_dir, exist_ok=True)
+    files = render_inventory(cluster_info, initiators, repo_base_url, profile_name,
+                             ec_enabled, initial_device_count, light_app_path, ansible_profile)
+    diff = sync_inventory(cluster_inventory_dir, files)
+    logging.info(f"inventory {allocation_id}: {diff.summary()}")
+    return cluster_inventory_dir
 
 
 # def main():
@@ -0,0 +1,102 @@
+import logging
+import os
+import time
+
+from prettytable import PrettyTable
+
+from lbprox.common import process
+from lbprox.common import threadpool
+from lbprox.common import trace
+from lbprox.common import utils
+
+
+LIGHTBITS_SERVICE = "deploy"
+INITIATOR_SERVICE = "deploy-initiator"
+
+
+class DeployRun(object):
+    """a single `docker compose run <service>` of an allocation's inventory"""
+    def __init__(self, allocation_id, inventory_dir, service=LIGHTBITS_SERVICE):
+        self.allocation_id = allocation_id
+        self.inventory_dir = inventory_dir
+        self.service = service
+        self.log_path = None
+        self.returncode = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    def ok(self):
+        return self.error is None and self.returncode == 0
+
+    def status(self):
+        if self.error is not None:
+            return "error"
+        if self.returncode is None:
+            return "not started"
+        return "ok" if self.returncode == 0 else "failed"
+
+    def duration(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+
+    def command(self):
+        # runs of different allocations must not share a container name
+        return f"docker compose run --rm -T --name lb-ansible-{self.service}-{self.allocation_id} {self.service}"
+
+
+def _deploy(run: DeployRun, stream_output, timeout, idle_timeout):
+    if os.environ.get('WORKSPACE_TOP', None) is None:
+        raise RuntimeError("WORKSPACE_TOP environment variable is not set")
+    log_dir = os.path.join(run.inventory_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    run.log_path = os.path.join(log_dir, f"lbprox-{run.service}-{time.strftime('%Y%m%d-%H%M%S')}.log")
+    command = run.command()
+    logging.info(f"deploying {run.allocation_id}: {command}, log: {run.log_path}")
+    run.start = time.time()
+    try:
+        with trace.span("ansible deploy", allocation=run.allocation_id, service=run.service):
+            result = process.run(command, cwd=run.inventory_dir, log_path=run.log_path,
+                                 echo=stream_output, prefix=f"[{run.allocation_id}] ",
+                                 timeout=timeout, idle_timeout=idle_timeout)
+        run.returncode = result.returncode
+        if result.timed_out:
+            run.error = result.describe()
+    finally:
+        run.end = time.time()
+    return run
+
+
+def deploy_allocations(runs, parallelism=2, stream_output=True, timeout=None, idle_timeout=None):
+    """run the deployments with at most `parallelism` of them at once.
+
+    every run's stdout/stderr goes to logs/ of its inventory, and is streamed
+    with an [allocation] prefix when stream_output is set. a run is killed after
+    timeout seconds, or idle_timeout seconds without output.
+    runs that already have an error (ex. inventory generation failed) are skipped.
+    """
+    pending = [run for run in runs if run.error is None]
+    if pending:
+        executor = threadpool.JobExecutor(f"deploying {len(pending)} allocations",
+                                          max_workers=parallelism)
+        for job_result in executor.run(_deploy, [(run, stream_output, timeout, idle_timeout) for run in pending]):
+            if not job_result.ok():
+                job_result.args[0].error = str(job_result.exception)
+    for run in runs:
+        if not run.ok():
+            logging.error(f"deployment of {run.allocation_id} {run.status()}: "
+                          f"exit code: {run.returncode}, error: {run.error}, log: {run.log_path}")
+    return runs
+
+
+def summary_table(runs):
+    table = PrettyTable()
+    table.field_names = ["allocation", "service", "status", "exit code", "duration", "log / error"]
+    table.align = "l"
+    for run in runs:
+        table.add_row([run.allocation_id, run.service, run.status(),
+                       "" if run.returncode is None else run.returncode,
+                       utils.seconds_to_human_readable(run.duration()),
+                       run.error or run.log_path or ""])
+    return table
@@ -1,10 +1,66 @@
-
 import os
 import yaml
 
 CONFIG_DIRECTORY = "lbprox/config"
 
+# options an emulated ssd profile may set, with the values QEMU accepts for them
+SSD_PROFILE_OPTIONS = {
+    "aio": ["threads", "native", "io_uring"],
+    "cache": ["none", "writeback", "writethrough", "directsync", "unsafe"],
+    "discard": ["ignore", "unmap"],
+    "detect_zeroes": ["off", "on", "unmap"],
+    "ioeventfd": bool,
+    "num_queues": int,
+    "logical_block_size": int,
+    "physical_block_size": int,
+}
+
+
 def list_machine_types():
     machines_file = os.path.join(CONFIG_DIRECTORY, "flavors/flavors.yml")
     with open(machines_file, 'r') as f:
         return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def list_ssd_profiles():
+    return list_machine_types().get("ssd_profiles", {}) or {}
+
+
+def validate_ssd_profile(profile: dict):
+    """returns the validated profile. YAML 1.1 loads an unquoted on/off as a boolean,
+    those are turned back into "on"/"off" for the options taking a value from a list.
+    """
+    profile = dict(profile)
+    for key, value in profile.items():
+        allowed = SSD_PROFILE_OPTIONS.get(key)
+        if allowed is None:
+            raise ValueError(f"unknown ssd profile option: {key}, must be one of {list(SSD_PROFILE_OPTIONS)}")
+        if isinstance(allowed, list):
+            if isinstance(value, bool):
+                value = profile[key] = "on" if value else "off"
+            if value not in allowed:
+                raise ValueError(f"invalid value for ssd profile option {key}: {value}, must be one of {allowed}")
+        elif not isinstance(value, allowed) or (allowed is int and isinstance(value, bool)):
+            raise ValueError(f"invalid value for ssd profile option {key}: {value}, must be {allowed.__name__}")
+    if profile.get("aio") == "native" and profile.get("cache") not in ("none", "directsync"):
+        raise ValueError("aio=native requires cache=none or cache=directsync")
+    if profile.get("detect_zeroes") == "unmap" and profile.get("discard") != "unmap":
+        # QEMU refuses to start the VM otherwise
+        raise ValueError("detect_zeroes=unmap requires discard=unmap")
+    return profile
+
+
+def get_ssd_profile(ssds: dict):
+    """returns the emulated ssd profile of a flavor's ssds section.
+    ssds.profile is either the name of an entry in ssd_profiles or an inline profile.
+    no profile means QEMU defaults.
+    """
+    profile = ssds.get("profile") if ssds else None
+    if profile is None:
+        return {}
+    if isinstance(profile, str):
+        profiles = list_ssd_profiles()
+        if profile not in profiles:
+            raise ValueError(f"ssd profile '{profile}' not found, must be one of {list(profiles)}")
+        profile = profiles[profile] or {}
+    return validate_ssd_profile(profile)
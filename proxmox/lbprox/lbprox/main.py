@@ -7,20 +7,24 @@ import os
 import yaml
 
 import http.client
-import urllib3
 http.client.HTTPConnection.debuglevel = 0
 
-from lbprox.common.vm_tags import VMTags
+from lbprox.common.tag_index import Selector
 import proxmoxer as proxmox
+from lbprox.common import metrics
+from lbprox.common import threadpool
+from lbprox.common import transport
 from lbprox.common import utils
 
 from lbprox.cli.image_store.cli import image_store_group
 from lbprox.cli.data_network.cli import data_network_group
+from lbprox.cli.access_network.cli import access_network_group
 from lbprox.cli.nodes.cli import nodes_group
 from lbprox.cli.os_images.cli import os_images_group
 from lbprox.cli.allocations.cli import allocations_group
 from lbprox.cli.dashboard.cli import dashboard_group
 from lbprox.cli.prom_discovery.cli import prom_discovery_group
+from lbprox.cli.state.cli import state_group
 from lbprox.common import constants
 
 
@@ -50,9 +54,11 @@ class AppContext(object):
             "password not provided, please provide it in the config file or as a command line argument"
 
         self.config = config_from_file
+        threadpool.set_node_concurrency(self.config.get("node_concurrency", threadpool.DEFAULT_NODE_CONCURRENCY))
         logging.debug(f"loaded config from: {config_file} merged config: {self.config}")
         self.pve, last_active_hostname = self.get_proxmox_api(self.config)
         assert self.pve, f"failed to create Proxmox API object: {self.config}"
+        metrics.instrument(self.pve)
         # update last know active node
         last_active = self.config.get("last_active", None)
         if last_active is None or last_active != last_active_hostname:
@@ -71,16 +77,17 @@ class AppContext(object):
             yaml.dump(config, f)
 
     def get_proxmox_api(self, config, timeout=15):
-        # Create a Proxmox API object
+        # Create a Proxmox API object, all its requests go through the transport
+        policy = transport.TransportPolicy.from_config(config.get("api"))
         last_active = config.get("last_active", None)
         if last_active:
             try:
-                urllib3.HTTPConnectionPool(last_active, maxsize=10, block=True)
                 pve = proxmox.ProxmoxAPI(host=last_active,
                                          user=f"{config['username']}@pam",
                                          password=config['password'],
                                          verify_ssl=False,
                                          timeout=timeout)
+                transport.install(pve, policy)
                 return pve, last_active
             except Exception as ex:
                 logging.warning(f"failed to connect to last active: {last_active}. will look for new active: {ex}")
@@ -88,12 +95,12 @@ class AppContext(object):
         for node in config["nodes"]:
             hostname = node.get('hostname')
             try:
-                urllib3.HTTPConnectionPool(hostname, maxsize=10, block=True)
                 pve = proxmox.ProxmoxAPI(host=hostname,
                                          user=f"{config['username']}@pam",
                                          password=config['password'],
                                          verify_ssl=False,
                                          timeout=timeout)
+                transport.install(pve, policy)
                 return pve, hostname
             except Exception as ex:
                 logging.warning(f"failed to connect to {hostname}: {ex}. keep looking...")
@@ -107,13 +114,15 @@ class AppContext(object):
               hide_input=True,
               envvar='LBPROX_PASSWORD')
 @click.option('--debug/--no-debug', default=False, envvar='LBPROX_DEBUG')
+@click.option('--profile', is_flag=True, default=False, envvar='LBPROX_PROFILE',
+              help="print a summary of the Proxmox API calls made by the command when it ends")
 @click.option('-c', '--config-file',
               type=click.Path(exists=True, dir_okay=False),
               default=constants.DEFAULT_CONFIG_FILE,
               envvar='LBPROX_CONFIG',
               help=f"config file to use (default: {constants.DEFAULT_CONFIG_FILE})")
 @click.pass_context
-def cli(ctx, username, password, debug, config_file):
+def cli(ctx, username, password, debug, profile, config_file):
     """
     Command-line interface function for the lbprox application.
 
@@ -122,6 +131,7 @@ def cli(ctx, username, password, debug, config_file):
         username (str): The username for authentication.
         password (str): The password for authentication.
         debug (bool): Flag indicating whether to enable debug mode.
+        profile (bool): Flag indicating whether to print API call statistics at exit.
         config_file (str): The path to the configuration file.
 
     Raises:
@@ -137,27 +147,36 @@ def cli(ctx, username, password, debug, config_file):
     if ctx.params['password'] is None:
         logging.debug("password not provided.")
     ctx.obj = AppContext(username, password, config_file, debug)
+    if profile:
+        ctx.call_on_close(lambda: click.echo(metrics.REGISTRY.summary_table(), err=True))
 
 
 @cli.command()
 @click.option('-t', '--tags', required=False, default=None, multiple=True,
-              help="tags to filter the VMs by. ex: --tags=allocation.b178 --tags=vm.s00")
+              help="tag selectors to filter the VMs by, all must match. "
+                   "ex: --tags=allocation.b178 --tags='role in (target,initiator)' --tags=vm!=s00")
 @click.pass_context
 def list_cluster_vms(ctx, tags):
-    if tags is not None:
-        tags = ";".join(tags)
-        tags = VMTags.parse_tags(tags)
-    print(json.dumps(utils.list_cluster_vms(ctx.obj.pve, tags), indent=2))
+    if not tags:
+        print(json.dumps(utils.list_cluster_vms(ctx.obj.pve), indent=2))
+        return
+    try:
+        selector = Selector.parse(",".join(tags))
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint="--tags")
+    print(json.dumps(utils.select_cluster_vms(ctx.obj.pve, selector), indent=2))
 
 
 def main():
     cli.add_command(nodes_group)
     cli.add_command(allocations_group)
     cli.add_command(data_network_group)
+    cli.add_command(access_network_group)
     cli.add_command(image_store_group)
     cli.add_command(os_images_group)
     cli.add_command(dashboard_group)
     cli.add_command(prom_discovery_group)
+    cli.add_command(state_group)
     cli() # [no-value-for-parameter]
 
 
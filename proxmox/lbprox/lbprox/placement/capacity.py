@@ -0,0 +1,328 @@
+import logging
+
+from prettytable import PrettyTable
+
+from lbprox.common import threadpool
+from lbprox.common import utils
+from lbprox.common import vm_templates
+from lbprox.common.vm_tags import VMTags
+
+
+class MachineDemand(object):
+    def __init__(self, name, role, cores, memory_bytes, boot_disk_bytes, ssd_bytes=0,
+                 vfs=0, passthrough_ssds=0, failure_domain=None, os_image=None):
+        self.name = name
+        self.role = role
+        self.cores = cores
+        self.memory_bytes = memory_bytes
+        self.boot_disk_bytes = boot_disk_bytes
+        self.ssd_bytes = ssd_bytes
+        self.vfs = vfs
+        self.passthrough_ssds = passthrough_ssds
+        self.failure_domain = failure_domain
+        self.os_image = os_image
+
+    @property
+    def storage_bytes(self):
+        return self.boot_disk_bytes + self.ssd_bytes
+
+    @staticmethod
+    def from_machine(machine, machine_info, boot_disk_bytes):
+        """demand of a descriptor machine of the given flavor"""
+        properties = machine_info['properties']
+        ssd_bytes = 0
+        passthrough_ssds = 0
+        ssds = properties.get('ssds') or {}
+        if ssds.get('type') == "emulated":
+            ssd_bytes = ssds['count'] * utils.convert_size_to_bytes(ssds['size'])
+        elif ssds.get('type') == "passthrough":
+            passthrough_ssds = ssds['count']
+        vfs = len([network for network in properties.get('networks', []) if network["type"] == "passthrough"])
+        return MachineDemand(machine["name"], machine["role"],
+                             properties['cores'],
+                             utils.convert_size_to_bytes(properties['base_memory']),
+                             boot_disk_bytes, ssd_bytes, vfs, passthrough_ssds,
+                             machine.get("failure_domain", machine["role"]),
+                             machine_info.get('os_image'))
+
+    def anti_affinity_group(self):
+        return (self.role, self.failure_domain)
+
+
+def machine_demands(allocation_descriptor, machine_types, boot_disk_bytes):
+    """MachineDemand of every machine of the descriptor, machine_types as loaded from flavors.yml"""
+    return [MachineDemand.from_machine(machine, machine_types['machine_types'][machine["machine_type"]],
+                                       boot_disk_bytes)
+            for machine in allocation_descriptor["machines"]]
+
+
+class NodeCapacity(object):
+    def __init__(self, node, free_cores, free_memory_bytes, free_storage_bytes,
+                 free_vfs=0, free_passthrough_ssds=0):
+        self.node = node
+        self.free_cores = free_cores
+        self.free_memory_bytes = free_memory_bytes
+        self.free_storage_bytes = free_storage_bytes
+        self.free_vfs = free_vfs
+        self.free_passthrough_ssds = free_passthrough_ssds
+        self.placed = []
+
+    def shortage(self, demand: MachineDemand):
+        """returns a list of resources the node lacks for the demand"""
+        missing = []
+        if self.free_storage_bytes is None:
+            missing.append("storage (not configured on node)")
+        elif self.free_storage_bytes < demand.storage_bytes:
+            missing.append("storage")
+        if self.free_cores < demand.cores:
+            missing.append("cores")
+        if self.free_memory_bytes < demand.memory_bytes:
+            missing.append("memory")
+        if self.free_vfs < demand.vfs:
+            missing.append("vfs")
+        if self.free_passthrough_ssds < demand.passthrough_ssds:
+            missing.append("ssds")
+        return missing
+
+    def place(self, demand: MachineDemand):
+        self.free_cores -= demand.cores
+        self.free_memory_bytes -= demand.memory_bytes
+        self.free_storage_bytes -= demand.storage_bytes
+        self.free_vfs -= demand.vfs
+        self.free_passthrough_ssds -= demand.passthrough_ssds
+        self.placed.append(demand)
+
+    def pin(self, demand: MachineDemand):
+        """count an existing machine of the node for anti-affinity, its resources are already in use"""
+        self.placed.append(demand)
+
+    def copy(self):
+        capacity = NodeCapacity(self.node, self.free_cores, self.free_memory_bytes, self.free_storage_bytes,
+                                self.free_vfs, self.free_passthrough_ssds)
+        capacity.placed = list(self.placed)
+        return capacity
+
+    def group_count(self, group):
+        return len([placed for placed in self.placed if placed.anti_affinity_group() == group])
+
+
+def node_capacities(pve, storage_id, nodes=None, cpu_overcommit=1.0,
+                    count_vfs=False, count_ssds=False):
+    """live free resources of online nodes, from one cluster resources snapshot.
+    committed vcpus of existing VMs are deducted from the node's cpus, VFs and
+    passthrough SSDs are only counted if needed since it requires per-node queries.
+    """
+    resources = pve.cluster().resources.get()
+    committed_cores = {}
+    for res in resources:
+        if res.get('type') == "qemu" and not res.get('template'):
+            committed_cores[res['node']] = committed_cores.get(res['node'], 0) + res.get('maxcpu', 0)
+    free_storage = {res['node']: res.get('maxdisk', 0) - res.get('disk', 0) for res in resources
+                    if res.get('type') == "storage" and res.get('storage') == storage_id}
+
+    capacities = {}
+    for res in resources:
+        if res.get('type') != "node" or res.get('status') != "online":
+            continue
+        node = res['node']
+        if nodes and node not in nodes:
+            continue
+        capacities[node] = NodeCapacity(node,
+                                        int(res.get('maxcpu', 0) * cpu_overcommit) - committed_cores.get(node, 0),
+                                        res.get('maxmem', 0) - res.get('mem', 0),
+                                        free_storage.get(node))
+
+    def _count_devices(node):
+        vfs = len(utils.find_unattached_vfs(pve, node)) if count_vfs else 0
+        ssds = len(utils.find_unattached_nvme_ssds(pve, node)) if count_ssds else 0
+        return node, vfs, ssds
+
+    if capacities and (count_vfs or count_ssds):
+        counts = threadpool.run_with_threadpool(_count_devices, [(node,) for node in capacities],
+                                                desc="counting free pci devices",
+                                                node_of=lambda job_args: job_args[0])
+        for node, vfs, ssds in counts:
+            capacities[node].free_vfs = vfs
+            capacities[node].free_passthrough_ssds = ssds
+    return capacities
+
+
+def demand_capacities(pve, storage_id, demands, nodes=None, cpu_overcommit=1.0):
+    """node_capacities counting only the pci devices the demands need"""
+    return node_capacities(pve, storage_id, nodes, cpu_overcommit,
+                           count_vfs=any(demand.vfs for demand in demands),
+                           count_ssds=any(demand.passthrough_ssds for demand in demands))
+
+
+def _size(size_bytes):
+    if size_bytes is None:
+        return "n/a"
+    return f"{size_bytes / 1024**3:.1f}G"
+
+
+# resources checked by preflight, with the formatter of their amounts
+RESOURCES = {
+    "cores": str,
+    "memory": _size,
+    "storage": _size,
+    "vfs": str,
+    "ssds": str,
+}
+
+
+class NodeUsage(object):
+    """what the machines placed on a node need, against what the node has free"""
+    def __init__(self, node, machines):
+        self.node = node
+        self.machines = machines
+        self.needed = {}
+        self.free = {}
+        self.problems = []
+
+    def ok(self):
+        return not self.problems
+
+    def check(self, resource, needed, free):
+        self.needed[resource] = needed
+        self.free[resource] = free
+        if free is not None and needed > free:
+            fmt = RESOURCES[resource]
+            self.problems.append(f"{resource}: need {fmt(needed)}, free {fmt(free)}")
+
+    def describe(self, resource):
+        if resource not in self.needed:
+            return ""
+        fmt = RESOURCES[resource]
+        return f"{fmt(self.needed[resource])} / {fmt(self.free[resource])}"
+
+    def to_dict(self):
+        return {
+            "node": self.node,
+            "machines": self.machines,
+            "needed": self.needed,
+            "free": self.free,
+            "problems": self.problems,
+        }
+
+
+class CapacityReport(object):
+    def __init__(self, storage_id, clone_mode):
+        self.storage_id = storage_id
+        self.clone_mode = clone_mode
+        self.nodes = []
+
+    def ok(self):
+        return all(usage.ok() for usage in self.nodes)
+
+    def problems(self):
+        return [f"{usage.node}: {problem}" for usage in self.nodes for problem in usage.problems]
+
+    def table(self):
+        table = PrettyTable()
+        table.field_names = ["node", "machines"] + [f"{resource} need / free" for resource in RESOURCES] + ["status"]
+        table.align = "l"
+        for usage in self.nodes:
+            table.add_row([usage.node, ", ".join(usage.machines)] +
+                          [usage.describe(resource) for resource in RESOURCES] +
+                          ["ok" if usage.ok() else "; ".join(usage.problems)])
+        return table
+
+    def to_dict(self):
+        return {
+            "storage_id": self.storage_id,
+            "clone_mode": self.clone_mode,
+            "ok": self.ok(),
+            "nodes": [usage.to_dict() for usage in self.nodes],
+        }
+
+
+class CapacityError(Exception):
+    def __init__(self, report: CapacityReport):
+        self.report = report
+        super().__init__("allocation does not fit the cluster:\n  " + "\n  ".join(report.problems()))
+
+
+def _existing_templates(pve, storage_id):
+    """{(node, os image, image signature)} of the usable templates on the storage"""
+    templates = set()
+    for template in vm_templates.list_templates(pve, storage_id=storage_id):
+        tags = VMTags.parse_tags(template.get("tags", ""))
+        if not tags.get_tag(vm_templates.STALE_TAG):
+            templates.add((template["node"], tags.get_tag(vm_templates.TEMPLATE_TAG),
+                           tags.get_tag(vm_templates.IMAGE_SIGNATURE_TAG)))
+    return templates
+
+
+def _check_node(usage: NodeUsage, demands, capacity: NodeCapacity, images, templates, clone_mode):
+    if capacity is None:
+        usage.problems.append("not an online cluster node")
+        return usage
+    usage.check("cores", sum(demand.cores for demand in demands), capacity.free_cores)
+    usage.check("memory", sum(demand.memory_bytes for demand in demands), capacity.free_memory_bytes)
+
+    storage = 0
+    for demand in demands:
+        image = images.get(demand.os_image) if images is not None else None
+        if images is not None and image is None:
+            usage.problems.append(f"os image {demand.os_image} not found on the storage")
+        image_bytes = image.get("size", 0) if image else 0
+        # the boot disk is the imported image grown to the minimum boot disk size
+        storage += max(demand.boot_disk_bytes, image_bytes) + demand.ssd_bytes
+    if clone_mode != "import" and images is not None:
+        for os_image in {demand.os_image for demand in demands}:
+            image = images.get(os_image)
+            if image and (usage.node, os_image, vm_templates.volume_signature(image)) not in templates:
+                boot_disk_bytes = max(demand.boot_disk_bytes for demand in demands if demand.os_image == os_image)
+                storage += max(boot_disk_bytes, image.get("size", 0))
+    if capacity.free_storage_bytes is None:
+        usage.problems.append("storage is not configured on the node")
+    usage.check("storage", storage, capacity.free_storage_bytes)
+
+    vfs = sum(demand.vfs for demand in demands)
+    if vfs:
+        usage.check("vfs", vfs, capacity.free_vfs)
+    ssds = sum(demand.passthrough_ssds for demand in demands)
+    if ssds:
+        usage.check("ssds", ssds, capacity.free_passthrough_ssds)
+    return usage
+
+
+def preflight(pve, storage_id, demands, placement: dict, capacities: dict, clone_mode="linked"):
+    """check the demands, placed on nodes by placement {machine name: node},
+    fit the free resources of capacities (as returned by node_capacities).
+
+    storage counts each machine's boot disk (its os image, at least the minimum
+    boot disk size) and emulated ssds at their full size, plus the template a
+    linked or full clone needs on a node that has no template of the image yet.
+    returns a CapacityReport, check its ok().
+    """
+    by_node = {}
+    for demand in demands:
+        by_node.setdefault(placement[demand.name], []).append(demand)
+
+    # os images are listed per node, all nodes are queried at once
+    nodes = [node for node in by_node if node in capacities and capacities[node].free_storage_bytes is not None]
+    images = {}
+    failures = {}
+    if nodes:
+        executor = threadpool.JobExecutor(f"listing os images on {len(nodes)} nodes",
+                                          max_workers=len(nodes), node_of=lambda args: args[1])
+        for job_result in executor.run(vm_templates.os_image_volumes, [(pve, node, storage_id) for node in nodes]):
+            if job_result.ok():
+                images[job_result.args[1]] = job_result.result
+            else:
+                failures[job_result.args[1]] = str(job_result.exception)
+    templates = _existing_templates(pve, storage_id) if clone_mode != "import" else set()
+
+    report = CapacityReport(storage_id, clone_mode)
+    for node, node_demands in by_node.items():
+        usage = NodeUsage(node, [demand.name for demand in node_demands])
+        if node in failures:
+            usage.problems.append(f"failed to list os images: {failures[node]}")
+        report.nodes.append(_check_node(usage, node_demands, capacities.get(node),
+                                        images.get(node), templates, clone_mode))
+    if report.ok():
+        logging.info(f"preflight: allocation fits on {', '.join(by_node)}")
+    else:
+        logging.error("preflight: " + "; ".join(report.problems()))
+    return report
@@ -0,0 +1,251 @@
+import logging
+import threading
+
+from lbprox.ssh import ssh
+
+
+# one line per host NUMA node: "node <id> <cpulist> <MemFree kB> <free 2M pages> <free 1G pages>"
+# and one line per PCI device: "pci <address> <numa node>"
+TOPOLOGY_SCRIPT = r"""
+for n in /sys/devices/system/node/node[0-9]*; do
+  echo "node ${n##*node} $(cat $n/cpulist) $(awk '$3 == "MemFree:" {print $4}' $n/meminfo)" \
+       "$(cat $n/hugepages/hugepages-2048kB/free_hugepages 2>/dev/null || echo 0)" \
+       "$(cat $n/hugepages/hugepages-1048576kB/free_hugepages 2>/dev/null || echo 0)"
+done
+for d in /sys/bus/pci/devices/*; do
+  echo "pci ${d##*/} $(cat $d/numa_node)"
+done
+"""
+
+# hugepages sizes (MB) supported by PVE's hugepages VM option
+HUGEPAGE_SIZES_MB = [2, 1024]
+
+# host cpus this process reserved for VMs whose configs are not written yet {hostname: {vmid: cpus}},
+# so concurrent placements on a node don't pick the same cpus. the cpus pinned by all other VMs
+# are read from their configs on each reservation
+_reserved_cpus = {}
+_node_locks = {}
+_node_locks_guard = threading.Lock()
+
+
+class PlacementError(Exception):
+    pass
+
+
+def parse_cpulist(cpulist: str):
+    """parse a cpulist like '0-3,8,10-11' into a sorted list of cpu ids"""
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpulist(cpus):
+    """format cpu ids as a compact cpulist, e.g. [0, 1, 2, 5] -> '0-2,5'"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{start}-{end}" if start != end else f"{start}" for start, end in ranges)
+
+
+class NumaNode(object):
+    def __init__(self, node_id: int, cpus, mem_free_kb: int, free_hugepages: dict):
+        self.node_id = node_id
+        self.cpus = cpus
+        self.mem_free_kb = mem_free_kb
+        # hugepage size in MB -> free pages count
+        self.free_hugepages = free_hugepages
+
+
+class HostTopology(object):
+    def __init__(self, nodes: dict, pci_numa: dict):
+        self.nodes = nodes
+        self.pci_numa = pci_numa
+
+    @staticmethod
+    def parse(output: str):
+        nodes = {}
+        pci_numa = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 6 and fields[0] == "node":
+                node_id = int(fields[1])
+                nodes[node_id] = NumaNode(node_id, parse_cpulist(fields[2]), int(fields[3]),
+                                          {2: int(fields[4]), 1024: int(fields[5])})
+            elif len(fields) == 3 and fields[0] == "pci":
+                pci_numa[fields[1]] = int(fields[2])
+        return HostTopology(nodes, pci_numa)
+
+    @staticmethod
+    def read(ssh_client: ssh.SSHClient):
+        _, output, _ = ssh_client.run_command(TOPOLOGY_SCRIPT)
+        return HostTopology.parse(output)
+
+    def device_node(self, pci_id: str):
+        """NUMA node of a PCI device, None if unknown (-1 in sysfs)"""
+        if pci_id not in self.pci_numa and not pci_id.startswith("0000:"):
+            pci_id = f"0000:{pci_id}"
+        node = self.pci_numa.get(pci_id, -1)
+        return node if node >= 0 else None
+
+
+class NumaPlacement(object):
+    def __init__(self, numa_count, cores, guest_nodes, hugepages=None, bind_memory=True):
+        self.numa_count = numa_count
+        self.cores = cores
+        # list of (host node id, host cpus, memory MB) per guest NUMA node
+        self.guest_nodes = guest_nodes
+        self.hugepages = hugepages
+        # without it only the cpus are pinned and the host kernel places the memory
+        self.bind_memory = bind_memory
+
+    def host_nodes(self):
+        return [host_node for host_node, _, _ in self.guest_nodes]
+
+    def cpus(self):
+        return sorted([cpu for _, cpus, _ in self.guest_nodes for cpu in cpus])
+
+    def vm_config(self):
+        """PVE VM config options implementing this placement"""
+        config = basic_numa_config(self.cores, self.numa_count)
+        config["numa"] = 1
+        vcpu = 0
+        for idx, (host_node, cpus, memory_mb) in enumerate(self.guest_nodes):
+            config[f"numa{idx}"] = f"cpus={vcpu}-{vcpu + len(cpus) - 1},memory={memory_mb}"
+            if self.bind_memory:
+                config[f"numa{idx}"] += f",hostnodes={host_node},policy=bind"
+            vcpu += len(cpus)
+        config["affinity"] = format_cpulist(self.cpus())
+        if self.hugepages:
+            config["hugepages"] = str(self.hugepages)
+        return config
+
+    def sort_by_locality(self, devices, topology: HostTopology):
+        """order PCI devices so the ones local to the placement's host nodes come first"""
+        host_nodes = self.host_nodes()
+        return sorted(devices, key=lambda device: topology.device_node(device.get('id')) not in host_nodes)
+
+    def __str__(self):
+        return ", ".join(f"guest node {idx} -> host node {host_node} cpus {format_cpulist(cpus)} memory {memory_mb}MB"
+                         f"{'' if self.bind_memory else ' (unbound)'}"
+                         for idx, (host_node, cpus, memory_mb) in enumerate(self.guest_nodes))
+
+
+def basic_numa_config(cores, numa_count):
+    """VM topology without pinning: one socket per NUMA node when cores split evenly"""
+    numa_count = max(int(numa_count or 1), 1)
+    if numa_count > 1 and cores % numa_count == 0:
+        return {"numa": 1, "sockets": numa_count, "cores": cores // numa_count}
+    return {"numa": 1 if numa_count > 1 else 0, "sockets": 1, "cores": cores}
+
+
+def _split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def _node_lock(hostname):
+    with _node_locks_guard:
+        return _node_locks.setdefault(hostname, threading.Lock())
+
+
+def _pinned_cpus(pve, hostname):
+    """the node's {vmid: pinned cpus}, read from the configs of all its VMs. reservations
+    of VMs that were deleted or have their affinity written by now are dropped.
+    """
+    reserved = _reserved_cpus.setdefault(hostname, {})
+    pinned = {}
+    for vm in pve.nodes(hostname).qemu.get():
+        vmid = int(vm['vmid'])
+        affinity = pve.nodes(hostname).qemu(vmid).config.get().get('affinity')
+        if affinity:
+            pinned[vmid] = set(parse_cpulist(affinity))
+            reserved.pop(vmid, None)
+        elif vmid in reserved:
+            pinned[vmid] = reserved[vmid]
+    for vmid in set(reserved) - set(pinned):
+        del reserved[vmid]
+    return pinned
+
+
+def reserve_numa_placement(pve, hostname, vmid, plan):
+    """plan(used host cpus) -> NumaPlacement for the VM, under the node's placement lock.
+    the cpus of the placement are reserved for the VM before it returns, the caller
+    writes them to the VM config, or calls release_numa_placement if it could not.
+    """
+    vmid = int(vmid)
+    with _node_lock(hostname):
+        used = set()
+        for other, cpus in _pinned_cpus(pve, hostname).items():
+            if other != vmid:
+                used.update(cpus)
+        placement = plan(used)
+        _reserved_cpus.setdefault(hostname, {})[vmid] = set(placement.cpus())
+    return placement
+
+
+def release_numa_placement(hostname, vmid):
+    """drop the VM's reservation, its placement was not applied"""
+    with _node_lock(hostname):
+        _reserved_cpus.get(hostname, {}).pop(int(vmid), None)
+
+
+def plan_numa_placement(topology: HostTopology, cores: int, memory_mb: int, numa_count: int,
+                        pci_ids=(), used_cpus=(), hugepages=None):
+    """choose host NUMA nodes, cpus and memory for a VM.
+
+    host nodes are ranked by free hugepages (when requested), the number of candidate
+    PCI devices local to them, then by free cpus - so passthrough NICs/SSDs end up on the VM's nodes.
+    raise PlacementError when the host can't satisfy the request.
+    """
+    numa_count = max(int(numa_count or 1), 1)
+    if hugepages and hugepages not in HUGEPAGE_SIZES_MB:
+        raise PlacementError(f"invalid hugepages size: {hugepages}, must be one of {HUGEPAGE_SIZES_MB}")
+    if len(topology.nodes) < numa_count:
+        raise PlacementError(f"host has {len(topology.nodes)} NUMA nodes, flavor requires {numa_count}")
+
+    used_cpus = set(used_cpus)
+    free_cpus = {node_id: [cpu for cpu in node.cpus if cpu not in used_cpus]
+                 for node_id, node in topology.nodes.items()}
+    local_devices = {node_id: 0 for node_id in topology.nodes}
+    for pci_id in pci_ids:
+        node_id = topology.device_node(pci_id)
+        if node_id in local_devices:
+            local_devices[node_id] += 1
+
+    def _hugepages_fit(node_id):
+        if not hugepages:
+            return True
+        return topology.nodes[node_id].free_hugepages.get(hugepages, 0) * hugepages >= memory_mb // numa_count
+
+    ranked = sorted(topology.nodes, key=lambda node_id: (not _hugepages_fit(node_id), -local_devices[node_id],
+                                                         -len(free_cpus[node_id]), node_id))
+    chosen = sorted(ranked[:numa_count])
+
+    guest_nodes = []
+    bind_memory = True
+    for node_id, node_cores, node_memory_mb in zip(chosen, _split(cores, numa_count), _split(memory_mb, numa_count)):
+        if len(free_cpus[node_id]) < node_cores:
+            raise PlacementError(f"host node {node_id} has {len(free_cpus[node_id])} free cpus, need {node_cores}")
+        node = topology.nodes[node_id]
+        if hugepages:
+            if node_memory_mb % hugepages:
+                raise PlacementError(f"memory {node_memory_mb}MB is not a multiple of {hugepages}MB hugepages")
+            if node.free_hugepages.get(hugepages, 0) * hugepages < node_memory_mb:
+                raise PlacementError(f"host node {node_id} has {node.free_hugepages.get(hugepages, 0)} free "
+                                     f"{hugepages}MB hugepages, need {node_memory_mb // hugepages}")
+        elif bind_memory and node.mem_free_kb // 1024 < node_memory_mb:
+            # a VM bound to a node without the memory is OOM killed or swaps, let the kernel place it
+            logging.warning(f"host node {node_id} has {node.mem_free_kb // 1024}MB free memory, "
+                            f"need {node_memory_mb}MB, not binding the VM's memory to its NUMA nodes")
+            bind_memory = False
+        guest_nodes.append((node_id, free_cpus[node_id][:node_cores], node_memory_mb))
+    return NumaPlacement(numa_count, cores, guest_nodes, hugepages, bind_memory)
@@ -0,0 +1,54 @@
+import logging
+
+from lbprox.placement.capacity import MachineDemand, NodeCapacity
+
+
+# spread - place each machine on the node with the most free resources
+# pack - fill nodes one at a time, keeping other nodes free for large allocations
+PLACEMENT_POLICIES = ["spread", "pack"]
+
+
+class SchedulingError(Exception):
+    pass
+
+
+def _node_score(capacity: NodeCapacity, demand: MachineDemand, policy, anti_affinity):
+    """lower is better"""
+    same_group = capacity.group_count(demand.anti_affinity_group()) if anti_affinity else 0
+    if policy == "pack":
+        return (same_group, capacity.free_memory_bytes, capacity.free_cores, capacity.node)
+    return (same_group, -capacity.free_memory_bytes, -capacity.free_cores, capacity.node)
+
+
+def schedule(demands, capacities: dict, policy="spread", anti_affinity=True):
+    """assign a node to every machine demand, returns {machine name: node}.
+
+    machines are placed largest first. with anti_affinity, machines sharing a
+    role and failure domain (e.g. the targets of a cluster) are kept on
+    different nodes as long as there are feasible nodes left.
+    raise SchedulingError listing what could not be placed and why.
+    """
+    if policy not in PLACEMENT_POLICIES:
+        raise ValueError(f"invalid placement policy: {policy}, must be one of {PLACEMENT_POLICIES}")
+    if not capacities:
+        raise SchedulingError("no online nodes to schedule on")
+
+    assignment = {}
+    failures = []
+    ordered = sorted(demands, key=lambda demand: (demand.passthrough_ssds + demand.vfs,
+                                                  demand.cores, demand.memory_bytes), reverse=True)
+    for demand in ordered:
+        feasible = [capacity for capacity in capacities.values() if not capacity.shortage(demand)]
+        if not feasible:
+            reasons = "; ".join(f"{capacity.node}: {', '.join(capacity.shortage(demand))}"
+                                for capacity in capacities.values())
+            failures.append(f"{demand.name} ({demand.cores} cores, {demand.memory_bytes // 1024**2}MB) - {reasons}")
+            continue
+        best = min(feasible, key=lambda capacity: _node_score(capacity, demand, policy, anti_affinity))
+        best.place(demand)
+        assignment[demand.name] = best.node
+        logging.debug(f"scheduled {demand.name} on {best.node} ({policy})")
+
+    if failures:
+        raise SchedulingError("can't place machines:\n  " + "\n  ".join(failures))
+    return assignment
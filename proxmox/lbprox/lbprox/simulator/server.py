@@ -0,0 +1,605 @@
+#!/usr/bin/env python3
+"""a fake Proxmox VE API server for benchmarking lbprox without a cluster.
+
+models nodes, storage content, PCI devices, VMs, templates/clones, the guest
+agent and asynchronous tasks. all latencies are configurable through
+SimulatorDelays, and can be scaled down together with `scale`.
+"""
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import re
+import threading
+import time
+import urllib.parse
+
+import proxmoxer
+
+from lbprox.common import metrics
+from lbprox.common import transport
+
+
+class SimulatorDelays(object):
+    """simulated durations in seconds"""
+    def __init__(self, api=0.005, agent=0.02, boot=5.0,
+                 tasks=None, scale=1.0):
+        self.api = api
+        self.agent = agent
+        self.boot = boot
+        self.tasks = {
+            "qmcreate": 4.0,
+            "qmclone": 2.0,
+            "qmstart": 1.5,
+            "qmstop": 1.0,
+            "qmshutdown": 2.0,
+            "qmreboot": 3.0,
+            "qmdestroy": 1.0,
+            "qmtemplate": 1.0,
+            "download": 10.0,
+            "dircreate": 5.0,
+            "reloadnetworkall": 2.0,
+        }
+        self.tasks.update(tasks or {})
+        self.scale = scale
+
+    def task(self, task_type):
+        return self.tasks.get(task_type, 1.0) * self.scale
+
+    def sleep(self, seconds):
+        if seconds * self.scale > 0:
+            time.sleep(seconds * self.scale)
+
+
+class SimulatorError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _parse_size(size):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    match = re.match(r"(\d+)([KMGT]?)", str(size))
+    value, unit = match.groups()
+    return int(value) * units.get(unit, 1)
+
+
+class FakeCluster(object):
+    """in-memory state of the simulated cluster"""
+    def __init__(self, node_count=3, delays: SimulatorDelays=None, storage_id="lb-local-storage",
+                 os_images=("rocky-9-target", "ubuntu-24.04-initiator", "ubuntu-24.04-photon"), vfs_per_node=16, ssds_per_node=8,
+                 node_cpus=128, node_memory=512 * 1024**3, storage_size=8 * 1024**4):
+        self.delays = delays or SimulatorDelays()
+        self.lock = threading.RLock()
+        self.storage_id = storage_id
+        self.nodes = {}
+        self.vms = {}
+        self.tasks = {}
+        self.pending = set()
+        self.volumes = {}
+        self.task_counter = 0
+        for idx in range(node_count):
+            name = f"pve{idx + 1:02d}"
+            self.nodes[name] = {
+                "maxcpu": node_cpus,
+                "maxmem": node_memory,
+                "storage_size": storage_size,
+                "pci": self._pci_devices(vfs_per_node, ssds_per_node),
+                "access_cidr": f"192.168.16.{idx + 1}/20",
+            }
+            self.volumes[name] = {}
+            for image in os_images:
+                self._add_volume(name, f"{storage_id}:iso/{image}.img", 2 * 1024**3, "iso", None, "raw")
+
+    @staticmethod
+    def _pci_devices(vfs, ssds):
+        devices = []
+        for idx in range(vfs):
+            devices.append({"id": f"0000:3b:{idx // 8 + 2:02x}.{idx % 8}", "class": "0x020000",
+                            "device_name": "Ethernet Adaptive Virtual Function", "numa_node": 0})
+        for idx in range(ssds):
+            devices.append({"id": f"0000:{0x81 + idx:02x}:00.0", "class": "0x010802",
+                            "device_name": "NVMe SSD Controller", "numa_node": 1})
+        return devices
+
+    def _add_volume(self, node, volid, size, content, vmid, format):
+        self.volumes[node][volid] = {
+            "volid": volid,
+            "size": size,
+            "content": content,
+            "format": format,
+            "ctime": int(time.time()),
+            "vmid": vmid,
+        }
+
+    # tasks
+
+    def _start_task(self, node, task_type, task_id, on_done=None, exit_status="OK"):
+        with self.lock:
+            self.task_counter += 1
+            starttime = int(time.time())
+            upid = f"UPID:{node}:{self.task_counter:08X}:{0:08X}:{starttime:08X}:{task_type}:{task_id}:root@pam:"
+            self.tasks[upid] = {
+                "upid": upid,
+                "node": node,
+                "type": task_type,
+                "id": task_id,
+                "starttime": starttime,
+                "started": time.time(),
+                "duration": self.delays.task(task_type),
+                "exitstatus": exit_status,
+                "on_done": on_done,
+                "done": False,
+            }
+            self.pending.add(upid)
+            return upid
+
+    def _refresh_task(self, task):
+        if not task["done"] and time.time() - task["started"] >= task["duration"]:
+            task["done"] = True
+            task["endtime"] = int(task["started"] + task["duration"]) + 1
+            self.pending.discard(task["upid"])
+            if task["on_done"]:
+                task["on_done"]()
+
+    def refresh(self):
+        """apply the effects of tasks that finished"""
+        with self.lock:
+            for upid in list(self.pending):
+                self._refresh_task(self.tasks[upid])
+
+    def task_list(self, node, params):
+        since = int(params.get("since", 0))
+        limit = int(params.get("limit", 50))
+        with self.lock:
+            tasks = [task for task in self.tasks.values() if task["node"] == node and task["starttime"] >= since]
+            for task in tasks:
+                self._refresh_task(task)
+            tasks = sorted(tasks, key=lambda task: task["starttime"], reverse=True)[:limit]
+            results = []
+            for task in tasks:
+                entry = {key: task[key] for key in ["upid", "node", "type", "id", "starttime"]}
+                if task["done"]:
+                    entry["endtime"] = task["endtime"]
+                    entry["status"] = task["exitstatus"]
+                results.append(entry)
+            return results
+
+    def task_status(self, upid):
+        with self.lock:
+            task = self._task(upid)
+            self._refresh_task(task)
+            if task["done"]:
+                return {"upid": upid, "status": "stopped", "exitstatus": task["exitstatus"]}
+            return {"upid": upid, "status": "running"}
+
+    def task_log(self, upid):
+        with self.lock:
+            task = self._task(upid)
+            return [{"n": 1, "t": f"{task['type']} {task['id']}"},
+                    {"n": 2, "t": f"TASK {task['exitstatus'] if task['done'] else 'running'}"}]
+
+    def _task(self, upid):
+        if upid not in self.tasks:
+            raise SimulatorError(500, f"no such task '{upid}'")
+        return self.tasks[upid]
+
+    # vms
+
+    def _vm(self, node, vmid):
+        vm = self.vms.get(int(vmid))
+        if vm is None or vm["node"] != node:
+            raise SimulatorError(500, f"Configuration file 'nodes/{node}/qemu-server/{vmid}.conf' does not exist")
+        return vm
+
+    def _cluster_vm_entry(self, vm):
+        uptime = int(time.time() - vm["started_at"]) if vm["status"] == "running" else 0
+        return {
+            "id": f"qemu/{vm['vmid']}",
+            "type": "qemu",
+            "vmid": vm["vmid"],
+            "node": vm["node"],
+            "name": vm["config"].get("name", f"VM {vm['vmid']}"),
+            "status": vm["status"],
+            "tags": vm["config"].get("tags", ""),
+            "template": vm["template"],
+            "maxcpu": int(vm["config"].get("cores", 1)) * int(vm["config"].get("sockets", 1)),
+            "maxmem": int(vm["config"].get("memory", 512)) * 1024**2,
+            "uptime": uptime,
+        }
+
+    def add_vm(self, node, vmid, config, status="stopped", template=0):
+        """add a VM directly, used to seed the cluster"""
+        with self.lock:
+            config = dict(config)
+            config.setdefault("virtio0", f"{self.storage_id}:{vmid}/vm-{vmid}-disk-0.qcow2,size=2G")
+            self.vms[int(vmid)] = {
+                "vmid": int(vmid),
+                "node": node,
+                "config": config,
+                "status": status,
+                "template": template,
+                "started_at": time.time() - self.delays.boot if status == "running" else 0,
+            }
+
+    def create_vm(self, node, params):
+        vmid = int(params["vmid"])
+        with self.lock:
+            if vmid in self.vms:
+                raise SimulatorError(500, f"VM {vmid} already exists")
+            config = {key: value for key, value in params.items() if key != "vmid"}
+            import_from = re.search(r"import-from=([^,]+)", config.get("virtio0", ""))
+            if import_from:
+                disk_format = re.search(r"format=(\w+)", config["virtio0"])
+                disk_format = disk_format.group(1) if disk_format else "raw"
+                volid = f"{self.storage_id}:{vmid}/vm-{vmid}-disk-0.{disk_format}"
+                self._add_volume(node, volid, 2 * 1024**3, "images", vmid, disk_format)
+                config["virtio0"] = f"{volid},discard=on,size=2G"
+            config["lock"] = "create"
+            self.add_vm(node, vmid, config)
+
+        def _done():
+            self.vms[vmid]["config"].pop("lock", None)
+        return self._start_task(node, "qmcreate", vmid, _done)
+
+    def clone_vm(self, node, vmid, params):
+        with self.lock:
+            source = self._vm(node, vmid)
+            newid = int(params["newid"])
+            if newid in self.vms:
+                raise SimulatorError(500, f"VM {newid} already exists")
+            config = dict(source["config"])
+            config["name"] = params.get("name", config.get("name"))
+            size = re.search(r"size=(\w+)", config.get("virtio0", ""))
+            full = params.get("full") in ("1", 1) or not source["template"]
+            disk_format = "raw" if full else "qcow2"
+            volid = f"{self.storage_id}:{newid}/vm-{newid}-disk-0.{disk_format}"
+            if not full:
+                # linked clones reference the template's base volume
+                volid = f"{self.storage_id}:{vmid}/base-{vmid}-disk-0.qcow2/{newid}/vm-{newid}-disk-0.qcow2"
+            self._add_volume(node, volid, 2 * 1024**3, "images", newid, disk_format)
+            config["virtio0"] = f"{volid},discard=on,size={size.group(1) if size else '2G'}"
+            config["lock"] = "clone"
+            self.add_vm(node, newid, config)
+
+        def _done():
+            self.vms[newid]["config"].pop("lock", None)
+        return self._start_task(node, "qmclone", vmid, _done)
+
+    @staticmethod
+    def config_digest(config):
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def update_config(self, node, vmid, params):
+        with self.lock:
+            vm = self._vm(node, vmid)
+            digest = params.pop("digest", None)
+            if digest is not None and digest != self.config_digest(vm["config"]):
+                raise SimulatorError(500, f"VM {vmid} config file has been modified (digest mismatch)")
+            for key in params.get("delete", "").split(","):
+                vm["config"].pop(key.strip(), None)
+            vm["config"].update({key: value for key, value in params.items() if key != "delete"})
+
+    def resize(self, node, vmid, params):
+        with self.lock:
+            vm = self._vm(node, vmid)
+            disk = params["disk"]
+            vm["config"][disk] = re.sub(r"size=\w+", f"size={params['size']}", vm["config"][disk])
+
+    def set_status(self, node, vmid, action, params):
+        with self.lock:
+            vm = self._vm(node, vmid)
+            if vm["template"]:
+                raise SimulatorError(500, f"VM {vmid} is a template")
+            if action == "start":
+                if vm["status"] == "running":
+                    raise SimulatorError(500, f"VM {vmid} already running")
+            elif action == "reboot" and vm["status"] != "running":
+                raise SimulatorError(500, f"VM {vmid} not running")
+            task_type = f"qm{action}"
+            running = action in ("start", "reboot")
+
+        def _done():
+            with self.lock:
+                if int(vmid) not in self.vms:
+                    return
+                vm["status"] = "running" if running else "stopped"
+                vm["started_at"] = time.time() if running else 0
+        return self._start_task(node, task_type, vmid, _done)
+
+    def delete_vm(self, node, vmid, params):
+        with self.lock:
+            vm = self._vm(node, vmid)
+            if vm["status"] == "running":
+                raise SimulatorError(500, f"VM {vmid} is running - destroy failed")
+            if vm["template"]:
+                base = f"{self.storage_id}:{vmid}/base-"
+                clones = [other for other in self.vms.values()
+                          if other is not vm and other["config"].get("virtio0", "").startswith(base)]
+                if clones:
+                    raise SimulatorError(500, "base volume is used by linked clones")
+            vm["config"]["lock"] = "destroyed"
+
+        def _done():
+            with self.lock:
+                self.vms.pop(int(vmid), None)
+                for volid in [volid for volid, volume in self.volumes[node].items()
+                              if volume["vmid"] == int(vmid)]:
+                    del self.volumes[node][volid]
+        return self._start_task(node, "qmdestroy", vmid, _done)
+
+    def agent_interfaces(self, node, vmid):
+        self.delays.sleep(self.delays.agent)
+        with self.lock:
+            vm = self._vm(node, vmid)
+            if vm["status"] != "running":
+                raise SimulatorError(500, f"VM {vmid} is not running")
+            if time.time() - vm["started_at"] < self.delays.boot * self.delays.scale:
+                raise SimulatorError(500, "QEMU guest agent is not running")
+        vmid = int(vmid)
+        access_ip = f"192.168.{16 + (vmid // 254) % 16}.{vmid % 254 + 1}"
+        data_ip = f"10.101.{(vmid // 254) % 256}.{vmid % 254 + 1}"
+        return {"result": [
+            {"name": "lo", "ip-addresses": [{"ip-address-type": "ipv4", "ip-address": "127.0.0.1"}]},
+            {"name": "eth0", "ip-addresses": [{"ip-address-type": "ipv4", "ip-address": access_ip}]},
+            {"name": "eth1", "ip-addresses": [{"ip-address-type": "ipv4", "ip-address": data_ip}]},
+        ]}
+
+    # storage
+
+    def storage_content(self, node, storage_id, params):
+        with self.lock:
+            volumes = [dict(volume) for volume in self.volumes[node].values()
+                       if volume["volid"].startswith(f"{storage_id}:")]
+        if params.get("content"):
+            volumes = [volume for volume in volumes if volume["content"] == params["content"]]
+        if params.get("vmid"):
+            volumes = [volume for volume in volumes if volume["vmid"] == int(params["vmid"])]
+        return volumes
+
+    def create_volume(self, node, storage_id, params):
+        vmid = int(params["vmid"])
+        volid = f"{storage_id}:{vmid}/{params['filename']}"
+        with self.lock:
+            if volid in self.volumes[node]:
+                raise SimulatorError(500, f"volume {volid} already exists")
+            self._add_volume(node, volid, _parse_size(params["size"]) * 1024
+                             if str(params["size"]).isdigit() else _parse_size(params["size"]),
+                             "images", vmid, params.get("format", "raw"))
+        return volid
+
+    def delete_volume(self, node, volid):
+        with self.lock:
+            self.volumes[node].pop(volid, None)
+
+    def download_url(self, node, storage_id, params):
+        volid = f"{storage_id}:iso/{params['filename']}"
+
+        def _done():
+            with self.lock:
+                self._add_volume(node, volid, 2 * 1024**3, "iso", None, "raw")
+        return self._start_task(node, "download", params["filename"], _done)
+
+    def resources(self, resource_type=None):
+        with self.lock:
+            items = []
+            if resource_type in (None, "vm"):
+                items += [self._cluster_vm_entry(vm) for vm in self.vms.values()]
+            if resource_type in (None, "node"):
+                for name, node in self.nodes.items():
+                    items.append({"id": f"node/{name}", "type": "node", "node": name, "status": "online",
+                                  "maxcpu": node["maxcpu"], "maxmem": node["maxmem"],
+                                  "mem": sum(int(vm["config"].get("memory", 0)) * 1024**2
+                                             for vm in self.vms.values()
+                                             if vm["node"] == name and vm["status"] == "running")})
+            if resource_type in (None, "storage"):
+                for name, node in self.nodes.items():
+                    used = sum(volume["size"] for volume in self.volumes[name].values())
+                    items.append({"id": f"storage/{name}/{self.storage_id}", "type": "storage", "node": name,
+                                  "storage": self.storage_id, "maxdisk": node["storage_size"], "disk": used})
+            return items
+
+    def next_id(self, vmid=None):
+        with self.lock:
+            if vmid is not None:
+                if int(vmid) in self.vms:
+                    raise SimulatorError(400, f"VM {vmid} already exists")
+                return int(vmid)
+            vmid = 100
+            while vmid in self.vms:
+                vmid += 1
+            return vmid
+
+
+class FakeProxmoxHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cluster: FakeCluster = None
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _params(self):
+        parsed = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update(dict(urllib.parse.parse_qsl(body)))
+        return parsed.path, params
+
+    def _respond(self, status, payload, reason=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status, reason)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        path, params = self._params()
+        self.cluster.delays.sleep(self.cluster.delays.api)
+        segments = [urllib.parse.unquote(segment) for segment in path.split("/") if segment][2:]
+        try:
+            self.cluster.refresh()
+            data = route(self.cluster, method, segments, params)
+            self._respond(200, {"data": data})
+        except SimulatorError as ex:
+            self._respond(ex.status, {"data": None, "errors": {"message": ex.message}}, ex.message)
+        except (KeyError, ValueError, IndexError) as ex:
+            self._respond(400, {"data": None, "errors": {"message": str(ex)}}, f"bad request: {ex}")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def route(cluster: FakeCluster, method, segments, params):
+    """dispatch an API call, segments are the path below /api2/json"""
+    path = "/".join(segments)
+    if path == "nodes" and method == "GET":
+        return [{"node": name, "status": "online", "maxcpu": node["maxcpu"], "maxmem": node["maxmem"]}
+                for name, node in cluster.nodes.items()]
+    if path == "cluster/resources":
+        return cluster.resources(params.get("type"))
+    if path == "cluster/nextid":
+        return cluster.next_id(params.get("vmid"))
+    if path == "cluster/sdn" and method == "PUT":
+        return cluster._start_task(next(iter(cluster.nodes)), "reloadnetworkall", "")
+    if len(segments) < 3 or segments[0] != "nodes" or segments[1] not in cluster.nodes:
+        raise SimulatorError(501, f"Method '{method} /{path}' not implemented")
+
+    node, rest = segments[1], segments[2:]
+    resource = rest[0]
+    if resource == "tasks":
+        if len(rest) == 1:
+            return cluster.task_list(node, params)
+        if rest[2:] == ["status"]:
+            return cluster.task_status(rest[1])
+        if rest[2:] == ["log"]:
+            return cluster.task_log(rest[1])
+    elif resource == "qemu":
+        if len(rest) == 1:
+            if method == "POST":
+                return cluster.create_vm(node, params)
+            with cluster.lock:
+                return [{"vmid": vm["vmid"], "name": vm["config"].get("name"), "status": vm["status"],
+                         "tags": vm["config"].get("tags", ""), "template": vm["template"]}
+                        for vm in cluster.vms.values() if vm["node"] == node]
+        vmid = rest[1]
+        action = rest[2:]
+        if not action:
+            if method == "DELETE":
+                return cluster.delete_vm(node, vmid, params)
+        elif action == ["config"]:
+            if method == "GET":
+                with cluster.lock:
+                    config = dict(cluster._vm(node, vmid)["config"])
+                return dict(config, digest=cluster.config_digest(config))
+            cluster.update_config(node, vmid, params)
+            return None
+        elif action == ["resize"]:
+            cluster.resize(node, vmid, params)
+            return None
+        elif action == ["template"]:
+            with cluster.lock:
+                vm = cluster._vm(node, vmid)
+                vm["template"] = 1
+                disk = vm["config"]["virtio0"]
+                vm["config"]["virtio0"] = disk.replace(f":{vmid}/vm-", f":{vmid}/base-")
+            return None
+        elif action == ["clone"]:
+            return cluster.clone_vm(node, vmid, params)
+        elif action == ["status", "current"]:
+            with cluster.lock:
+                vm = cluster._vm(node, vmid)
+                return {"vmid": int(vmid), "status": vm["status"]}
+        elif action[:1] == ["status"] and action[1:] in (["start"], ["stop"], ["shutdown"], ["reboot"]):
+            return cluster.set_status(node, vmid, action[1], params)
+        elif action == ["agent", "network-get-interfaces"]:
+            return cluster.agent_interfaces(node, vmid)
+    elif resource == "network":
+        bridge = {"iface": "vmbr0", "type": "bridge", "cidr": cluster.nodes[node]["access_cidr"], "active": 1}
+        return bridge if len(rest) > 1 else [bridge]
+    elif resource == "storage":
+        if len(rest) == 1:
+            return [{"storage": cluster.storage_id, "type": "dir", "content": "iso,images,snippets", "active": 1}]
+        storage_id = rest[1]
+        if rest[2:] == ["content"]:
+            if method == "POST":
+                return cluster.create_volume(node, storage_id, params)
+            return cluster.storage_content(node, storage_id, params)
+        if rest[2:3] == ["content"] and method == "DELETE":
+            cluster.delete_volume(node, "/".join(rest[3:]))
+            return None
+        if rest[2:] == ["download-url"]:
+            return cluster.download_url(node, storage_id, params)
+    elif resource == "hardware" and rest[1:] == ["pci"]:
+        return list(cluster.nodes[node]["pci"])
+    raise SimulatorError(501, f"Method '{method} /{path}' not implemented")
+
+
+class FakeProxmoxServer(object):
+    """runs the fake API in a background thread"""
+    def __init__(self, cluster: FakeCluster, host="127.0.0.1", port=0):
+        handler = type("BoundFakeProxmoxHandler", (FakeProxmoxHandler,), {"cluster": cluster})
+        self.cluster = cluster
+        self.httpd = http.server.ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-proxmox", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def connect(host, port, policy: transport.TransportPolicy=None):
+    """a ProxmoxAPI object talking to the fake server over plain http,
+    with the lbprox transport and metrics installed like AppContext does.
+    """
+    pve = proxmoxer.ProxmoxAPI(host, port=port, user="root@pam",
+                               token_name="simulator", token_value="simulator",
+                               verify_ssl=False)
+    pve._store["base_url"] = f"http://{host}:{port}/api2/json"
+    transport.install(pve, policy)
+    metrics.instrument(pve)
+    return pve
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake Proxmox VE API server")
+    parser.add_argument("--port", type=int, default=8006)
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--delay-scale", type=float, default=1.0,
+                        help="multiply all simulated delays by this factor")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    cluster = FakeCluster(args.nodes, SimulatorDelays(scale=args.delay_scale))
+    server = FakeProxmoxServer(cluster, host="0.0.0.0", port=args.port)
+    logging.info(f"serving a fake Proxmox API with {args.nodes} nodes on port {args.port}")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from lbprox.ssh import ssh
+
+
+class FakeSSHClient(object):
+    """stands in for lbprox.ssh.ssh.SSHClient against the simulator.
+
+    records uploaded files and executed commands instead of touching a host,
+    every operation takes `latency` seconds.
+    """
+    latency = 0.01
+    lock = threading.Lock()
+    files = {}
+    commands = []
+
+    def __init__(self, hostname: str, username: str, password: str):
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.client = self.connect()
+
+    def connect(self):
+        time.sleep(self.latency)
+        return object()
+
+    def reconnect(self):
+        self.close()
+        self.client = self.connect()
+
+    def close(self):
+        self.client = None
+
+    def is_active(self):
+        return self.client is not None
+
+    def upload_file(self, local_path: str, remote_path: str):
+        time.sleep(self.latency)
+        with open(local_path, "r") as f:
+            content = f.read()
+        with self.lock:
+            FakeSSHClient.files[(self.hostname, remote_path)] = content
+
+    def download_file(self, remote_path: str, local_path: str):
+        time.sleep(self.latency)
+        with self.lock:
+            content = FakeSSHClient.files.get((self.hostname, remote_path), "")
+        with open(local_path, "w") as f:
+            f.write(content)
+
+    def remove_file(self, remote_path: str):
+        time.sleep(self.latency)
+        with self.lock:
+            if FakeSSHClient.files.pop((self.hostname, remote_path), None) is None:
+                raise FileNotFoundError(f"No such file: {remote_path}")
+
+    def run_command(self, command, check=True):
+        time.sleep(self.latency)
+        with self.lock:
+            FakeSSHClient.commands.append((self.hostname, command))
+            if command.startswith("rm -f "):
+                for path in command[len("rm -f "):].split():
+                    FakeSSHClient.files.pop((self.hostname, path), None)
+        return 0, "", ""
+
+    # parses the output of run_command, as on a real host
+    get_network_info_via_ssh = ssh.SSHClient.get_network_info_via_ssh
@@ -100,6 +100,19 @@ class CloudInit(object):
             if "No such file" not in str(e):
                 logging.error(f"Failed to delete user data file: {e}")
 
+    def delete_cloud_init_data_files_bulk(self, vmids):
+        """remove the snippets of many VMs with a single remote command"""
+        if not vmids:
+            return
+        snippets_dir = f"/mnt/pve/{self.storage_id}/snippets"
+        paths = []
+        for vmid in vmids:
+            paths += [f"{snippets_dir}/{self.user_data_filename(vmid)}",
+                      f"{snippets_dir}/{self.meta_data_filename(vmid)}",
+                      f"{snippets_dir}/{self.network_data_filename(vmid)}",
+                      f"{snippets_dir}/{self.vendor_data_filename(vmid)}"]
+        self.ssh_client.run_command(f"rm -f {' '.join(paths)}")
+
     def user_data_filename(self, vmid):
         return f"user-vm-{vmid}.cfg"
 
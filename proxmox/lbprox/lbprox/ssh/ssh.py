@@ -1,7 +1,9 @@
+import json
 import logging
 import os
 import paramiko
 import re
+import threading
 
 
 class SSHClient(object):
@@ -13,7 +15,11 @@ class SSHClient(object):
 
     def reconnect(self):
         self.close()
-        self.connect()
+        self.client = self.connect()
+
+    def is_active(self):
+        transport = self.client.get_transport() if self.client else None
+        return transport is not None and transport.is_active()
 
     def connect(self):
         client = paramiko.SSHClient()
@@ -90,6 +96,19 @@ class SSHClient(object):
         sftp.remove(remote_path)
         sftp.close()
 
+    def run_command(self, command: str, check=True):
+        """run command on the remote host, returns (exit_status, stdout, stderr)
+        raise RuntimeError if check is set and the command failed
+        """
+        logging.debug(f"{self.hostname}: running command: {command}")
+        stdin, stdout, stderr = self.client.exec_command(command)
+        out = stdout.read().decode().strip()
+        err = stderr.read().decode().strip()
+        exit_status = stdout.channel.recv_exit_status()
+        if check and exit_status != 0:
+            raise RuntimeError(f"{self.hostname}: command '{command}' failed ({exit_status}): {err}")
+        return exit_status, out, err
+
     def run_python_script_remotely(self, local_script_path, remote_script_path="/tmp/remote_script.py"):
         # Use SFTP to transfer the script
         sftp = self.client.open_sftp()
@@ -110,9 +129,8 @@ class SSHClient(object):
         # ssh.exec_command(f"rm {remote_script_path}")
 
     def get_network_info_via_ssh(self):
-        # Get default interface and gateway
-        stdin, stdout, stderr = self.client.exec_command("ip route show default")
-        route_output = stdout.read().decode()
+        """(default interface, its cidr, default gateway), (None, None, None) without a default route"""
+        _, route_output, _ = self.run_command("ip route show default", check=False)
         default_iface = gateway = None
 
         for line in route_output.splitlines():
@@ -121,11 +139,12 @@ class SSHClient(object):
                 gateway = parts[2]
                 default_iface = parts[4]
                 break
+        if default_iface is None:
+            return None, None, None
 
         # Get CIDR of that interface
-        stdin, stdout, stderr = self.client.exec_command(f"ip -j addr show {default_iface}")
-        import json
-        addr_data = json.loads(stdout.read().decode())
+        _, addr_output, _ = self.run_command(f"ip -j addr show {default_iface}")
+        addr_data = json.loads(addr_output)
 
         cidr = None
         for addr_info in addr_data[0].get("addr_info", []):
@@ -137,3 +156,40 @@ class SSHClient(object):
 
         return default_iface, cidr, gateway
 
+
+class SSHPool(object):
+    """one SSH connection per host, shared between threads and reconnected when it dropped.
+    use as a context manager, or close() it when done.
+    """
+    def __init__(self, username: str, password: str):
+        self.username = username
+        self.password = password
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._clients = {}
+
+    def get(self, hostname) -> SSHClient:
+        with self._lock:
+            host_lock = self._host_locks.setdefault(hostname, threading.Lock())
+        with host_lock:
+            client = self._clients.get(hostname)
+            if client is not None and not client.is_active():
+                logging.debug(f"{hostname}: ssh connection dropped, reconnecting")
+                client.close()
+                client = None
+            if client is None:
+                client = SSHClient(hostname, self.username, self.password)
+                self._clients[hostname] = client
+            return client
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
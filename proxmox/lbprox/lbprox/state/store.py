@@ -0,0 +1,373 @@
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from contextlib import closing
+
+from lbprox.common import constants
+from lbprox.common import threadpool
+from lbprox.common import utils
+from lbprox.common import vm_templates
+from lbprox.common.vm_tags import VMTags
+
+
+STATE_DB = os.path.join(constants.BASE_DIR, "state.db")
+
+# bumped on schema changes. the tables mirroring the cluster are rebuilt by the next
+# reconcile, the allocation history and phase timings are kept
+SCHEMA_VERSION = 2
+_MIRROR_TABLES = ["vms", "ips", "devices", "images"]
+
+# running VMs without addresses (no guest agent, or not up yet) are asked again after
+# ADDRESS_RETRY_BASE seconds, doubling on every miss up to ADDRESS_RETRY_MAX
+ADDRESS_RETRY_BASE = 30
+ADDRESS_RETRY_MAX = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vms (
+    vmid INTEGER PRIMARY KEY,
+    node TEXT NOT NULL,
+    name TEXT,
+    status TEXT,
+    tags TEXT NOT NULL DEFAULT '',
+    allocation_id TEXT,
+    role TEXT,
+    pool TEXT,
+    template INTEGER NOT NULL DEFAULT 0,
+    maxcpu INTEGER,
+    maxmem INTEGER,
+    uptime INTEGER,
+    fingerprint TEXT NOT NULL,
+    updated REAL NOT NULL,
+    address_checked REAL,
+    address_misses INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS vms_allocation ON vms (allocation_id);
+CREATE TABLE IF NOT EXISTS ips (
+    vmid INTEGER NOT NULL,
+    interface TEXT NOT NULL,
+    ipv4 TEXT NOT NULL,
+    purpose TEXT NOT NULL,
+    PRIMARY KEY (vmid, interface, ipv4)
+);
+CREATE TABLE IF NOT EXISTS devices (
+    vmid INTEGER NOT NULL,
+    slot TEXT NOT NULL,
+    device TEXT NOT NULL,
+    PRIMARY KEY (vmid, slot)
+);
+CREATE TABLE IF NOT EXISTS images (
+    template_vmid INTEGER PRIMARY KEY,
+    node TEXT NOT NULL,
+    storage TEXT,
+    os_image TEXT NOT NULL,
+    signature TEXT,
+    stale INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS allocations (
+    allocation_id TEXT PRIMARY KEY,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    deleted REAL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    allocation_id TEXT NOT NULL,
+    command TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_allocation ON phases (allocation_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_HOSTPCI = re.compile(r"^hostpci\d+$")
+
+
+def _address_backoff(misses):
+    return min(ADDRESS_RETRY_MAX, ADDRESS_RETRY_BASE * 2 ** max(0, misses - 1))
+
+
+def _fingerprint(vm):
+    # uptime is left out, it changes on every scan - a restart is detected by it going down
+    return "|".join(str(vm.get(key, "")) for key in ("node", "name", "status", "tags", "template", "maxcpu", "maxmem"))
+
+
+class ReconcileResult(object):
+    """what a reconcile changed in the local state"""
+    def __init__(self):
+        self.added = []
+        self.changed = []
+        self.removed = []
+        self.unchanged = 0
+        self.ip_refreshes = 0
+        self.config_refreshes = 0
+        self.duration = 0.0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __str__(self):
+        return (f"{len(self.added)} added, {len(self.changed)} changed, {len(self.removed)} removed, "
+                f"{self.unchanged} unchanged ({self.config_refreshes} configs, {self.ip_refreshes} guest agent "
+                f"queries) in {self.duration:.2f}s")
+
+
+def _fetch_ips(pve, node, vmid):
+    # a single query, without sleeping on a guest agent that is not up
+    return utils.get_vm_ip_address(pve, node, vmid, 0, 0, interval=0)
+
+
+def _fetch_devices(pve, node, vmid):
+    config = pve.nodes(node).qemu(vmid).config.get()
+    return {key: value for key, value in config.items() if _HOSTPCI.match(key)}
+
+
+def _fetch_all(desc, fetch, pve, vms, max_workers):
+    """{vmid: fetch result} of the VMs fetched successfully, concurrently and bounded per node"""
+    if not vms:
+        return {}
+    args = [(pve, vm['node'], vm['vmid']) for vm in vms]
+    executor = threadpool.JobExecutor(f"{desc} of {len(args)} VMs", max_workers=max_workers,
+                                      node_of=lambda args: args[1])
+    results = {}
+    for job_result in executor.run(fetch, args):
+        if job_result.ok():
+            results[job_result.args[2]] = job_result.result
+        else:
+            logging.warning(f"failed to fetch {desc} of {job_result.args[1]}:{job_result.args[2]}: "
+                            f"{job_result.exception}")
+    return results
+
+
+class StateStore(object):
+    """local record of the cluster's lbprox VMs, their addresses, passthrough devices,
+    os image templates and the phase timings of allocation commands.
+
+    the store is kept in sync with reconcile(), which reads the cluster resources once
+    and only asks PVE (config) and the guest agents (addresses) about VMs that are new,
+    changed or restarted since the previous reconcile. running VMs without addresses
+    are asked again with a backoff. a connection is opened per
+    operation, so a store can be shared between threads and processes.
+    """
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                for table in _MIRROR_TABLES:
+                    db.execute(f"DROP TABLE IF EXISTS {table}")
+                db.execute("DROP TABLE IF EXISTS meta")
+            db.executescript(_SCHEMA)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _query(self, sql, params=()):
+        with closing(self._connect()) as db:
+            return [dict(row) for row in db.execute(sql, params)]
+
+    def last_reconcile(self):
+        """time of the last reconcile, 0 if the store was never reconciled"""
+        rows = self._query("SELECT value FROM meta WHERE key = 'last_reconcile'")
+        return float(rows[0]['value']) if rows else 0.0
+
+    def age(self):
+        return time.time() - self.last_reconcile()
+
+    def invalidate(self):
+        """have the next ensure_fresh reconcile, whatever its max_age"""
+        with closing(self._connect()) as db, db:
+            db.execute("DELETE FROM meta WHERE key = 'last_reconcile'")
+
+    def reconcile(self, pve, max_workers=16):
+        start = time.time()
+        result = ReconcileResult()
+        resources = pve.cluster().resources.get(type="vm")
+        stored = {row['vmid']: row for row in self._query(
+            "SELECT vmid, fingerprint, uptime, address_checked, address_misses, "
+            "EXISTS (SELECT 1 FROM ips WHERE ips.vmid = vms.vmid) AS addressed FROM vms")}
+
+        changed_vms = []
+        readdress = []
+        for vm in resources:
+            previous = stored.get(vm['vmid'])
+            if previous is None:
+                result.added.append(vm['vmid'])
+                changed_vms.append(vm)
+                continue
+            if previous['fingerprint'] != _fingerprint(vm):
+                result.changed.append(vm['vmid'])
+                changed_vms.append(vm)
+                continue
+            result.unchanged += 1
+            if vm.get('uptime', 0) < (previous['uptime'] or 0):
+                # restarted between two scans, its addresses may have changed
+                readdress.append(vm)
+            elif not previous['addressed'] and \
+                    start - (previous['address_checked'] or 0) >= _address_backoff(previous['address_misses']):
+                # no guest agent, or it was not up yet, ask again with backoff
+                readdress.append(vm)
+        result.removed = sorted(set(stored) - set(vm['vmid'] for vm in resources))
+
+        # the slow part, talking to PVE and the guest agents, happens outside of any transaction
+        to_configure = [vm for vm in changed_vms if not vm.get('template')]
+        to_address = [vm for vm in changed_vms + readdress
+                      if not vm.get('template') and vm.get('status') == "running"]
+        devices = _fetch_all("devices", _fetch_devices, pve, to_configure, max_workers)
+        addresses = _fetch_all("ip addresses", _fetch_ips, pve, to_address, max_workers)
+        result.config_refreshes, result.ip_refreshes = len(to_configure), len(to_address)
+        # a VM whose config could not be read keeps no fingerprint, so the next reconcile retries it
+        unconfigured = set(vm['vmid'] for vm in to_configure) - set(devices)
+        addressed = set(vm['vmid'] for vm in to_address)
+        fresh = set(vm['vmid'] for vm in changed_vms)
+
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            for vm in resources:
+                vmid = vm['vmid']
+                tags = VMTags.parse_tags(vm.get('tags', ""))
+                previous = stored.get(vmid)
+                checked, misses = (None, 0) if vmid in fresh else (previous['address_checked'],
+                                                                    previous['address_misses'])
+                if vmid in addressed:
+                    checked, misses = now, (0 if addresses.get(vmid) else misses + 1)
+                db.execute("INSERT OR REPLACE INTO vms (vmid, node, name, status, tags, allocation_id, role, pool, "
+                           "template, maxcpu, maxmem, uptime, fingerprint, updated, address_checked, address_misses) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (vmid, vm['node'], vm.get('name'), vm.get('status'), vm.get('tags', ""),
+                            tags.get_allocation(), tags.get_role(), tags.get_pool(), int(bool(vm.get('template'))),
+                            vm.get('maxcpu'), vm.get('maxmem'), vm.get('uptime', 0),
+                            "" if vmid in unconfigured else _fingerprint(vm), now, checked, misses))
+                if vm.get('status') != "running":
+                    db.execute("DELETE FROM ips WHERE vmid = ?", (vmid,))
+            for vmid, ips in addresses.items():
+                db.execute("DELETE FROM ips WHERE vmid = ?", (vmid,))
+                db.executemany("INSERT OR REPLACE INTO ips (vmid, interface, ipv4, purpose) VALUES (?, ?, ?, ?)",
+                               [(vmid, ip['name'], ip['ipv4'], ip['purpose']) for ip in ips])
+            for vmid, vm_devices in devices.items():
+                db.execute("DELETE FROM devices WHERE vmid = ?", (vmid,))
+                db.executemany("INSERT INTO devices (vmid, slot, device) VALUES (?, ?, ?)",
+                               [(vmid, slot, device) for slot, device in vm_devices.items()])
+            removed = [(vmid,) for vmid in result.removed]
+            db.executemany("DELETE FROM vms WHERE vmid = ?", removed)
+            db.executemany("DELETE FROM ips WHERE vmid = ?", removed)
+            db.executemany("DELETE FROM devices WHERE vmid = ?", removed)
+            db.executemany("DELETE FROM images WHERE template_vmid = ?", removed)
+            self._reconcile_images(db, resources)
+            self._reconcile_allocations(db, now)
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_reconcile', ?)", (str(now),))
+        result.duration = time.time() - start
+        logging.debug(f"reconciled local state: {result}")
+        return result
+
+    def _reconcile_images(self, db, resources):
+        for vm in resources:
+            tags = VMTags.parse_tags(vm.get('tags', ""))
+            if not vm.get('template') or not tags.get_tag(vm_templates.TEMPLATE_TAG):
+                continue
+            db.execute("INSERT OR REPLACE INTO images (template_vmid, node, storage, os_image, signature, stale) "
+                       "VALUES (?, ?, ?, ?, ?, ?)",
+                       (vm['vmid'], vm['node'], tags.get_tag(vm_templates.STORAGE_TAG),
+                        tags.get_tag(vm_templates.TEMPLATE_TAG), tags.get_tag(vm_templates.IMAGE_SIGNATURE_TAG),
+                        int(bool(tags.get_tag(vm_templates.STALE_TAG)))))
+
+    def _reconcile_allocations(self, db, now):
+        db.execute("INSERT INTO allocations (allocation_id, first_seen, last_seen) "
+                   "SELECT DISTINCT allocation_id, ?, ? FROM vms "
+                   "WHERE allocation_id IS NOT NULL AND template = 0 AND pool IS NULL "
+                   "ON CONFLICT (allocation_id) DO UPDATE SET last_seen = excluded.last_seen, deleted = NULL",
+                   (now, now))
+        db.execute("UPDATE allocations SET deleted = ? WHERE deleted IS NULL AND allocation_id NOT IN "
+                   "(SELECT allocation_id FROM vms WHERE allocation_id IS NOT NULL)", (now,))
+
+    def ensure_fresh(self, pve, max_age):
+        """reconcile if the store was not reconciled, by any process, in the last max_age seconds"""
+        if self.age() > max_age:
+            return self.reconcile(pve)
+        return None
+
+    def vms(self, allocation_id=None, role=None, include_templates=False, include_pool=True):
+        """the stored VMs, as their cluster resource entries plus their 'ip_addresses'
+        (as returned by utils.get_vm_ip_address) and passthrough 'devices'
+        """
+        conditions, params = [], []
+        if allocation_id is not None:
+            conditions.append("allocation_id = ?")
+            params.append(allocation_id)
+        if role is not None:
+            conditions.append("role = ?")
+            params.append(role)
+        if not include_templates:
+            conditions.append("template = 0")
+        if not include_pool:
+            conditions.append("pool IS NULL")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with closing(self._connect()) as db:
+            vms = [dict(row) for row in db.execute(f"SELECT * FROM vms {where} ORDER BY vmid", params)]
+            ips, devices = {}, {}
+            for row in db.execute("SELECT * FROM ips ORDER BY vmid, interface"):
+                ips.setdefault(row['vmid'], []).append(
+                    {"name": row['interface'], "ipv4": row['ipv4'], "purpose": row['purpose']})
+            for row in db.execute("SELECT * FROM devices ORDER BY vmid, slot"):
+                devices.setdefault(row['vmid'], {})[row['slot']] = row['device']
+        for vm in vms:
+            vm['ip_addresses'] = ips.get(vm['vmid'], [])
+            vm['devices'] = devices.get(vm['vmid'], {})
+        return vms
+
+    def allocations(self):
+        """{allocation id: [vm]}, in the format of utils.list_allocations_in_cluster"""
+        allocations = {}
+        for vm in self.vms(include_pool=False):
+            tags = VMTags.parse_tags(vm['tags'])
+            allocations.setdefault(vm['allocation_id'], []).append({
+                "vmid": vm['vmid'],
+                "name": tags.get_vm_name(),
+                "role": vm['role'],
+                "status": vm['status'],
+                "tags": tags.str()
+            })
+        return allocations
+
+    def allocation_history(self):
+        return self._query("SELECT * FROM allocations ORDER BY first_seen")
+
+    def images(self):
+        return self._query("SELECT * FROM images ORDER BY node, storage, os_image")
+
+    def record_phases(self, allocation_id, command, phase_totals: dict):
+        """store the {phase: (count, total seconds)} of a command run on an allocation"""
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            db.executemany("INSERT INTO phases (allocation_id, command, phase, count, seconds, recorded) "
+                           "VALUES (?, ?, ?, ?, ?, ?)",
+                           [(allocation_id, command, phase, count, seconds, now)
+                            for phase, (count, seconds) in phase_totals.items()])
+
+    def phases(self, allocation_id=None):
+        if allocation_id:
+            return self._query("SELECT * FROM phases WHERE allocation_id = ? ORDER BY recorded, phase",
+                               (allocation_id,))
+        return self._query("SELECT * FROM phases ORDER BY recorded, allocation_id, phase")
+
+
+_stores = {}
+
+
+def open_store(path=STATE_DB):
+    """the StateStore at path, created on first use"""
+    if path not in _stores:
+        _stores[path] = StateStore(path)
+    return _stores[path]
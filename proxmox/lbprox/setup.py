@@ -18,13 +18,18 @@ setup(
               'lbprox/deployment',
               'lbprox/snippets',
               'lbprox/dashboard',
+              'lbprox/placement',
+              'lbprox/simulator',
+              'lbprox/state',
               'lbprox/cli/allocations',
               'lbprox/cli/data_network',
+              'lbprox/cli/access_network',
               'lbprox/cli/image_store',
               'lbprox/cli/os_images',
               'lbprox/cli/dashboard',
               'lbprox/cli/prom_discovery',
-              'lbprox/cli/nodes'
+              'lbprox/cli/nodes',
+              'lbprox/cli/state'
     ],          
     entry_points={
         'console_scripts': [
@@ -0,0 +1,21 @@
+import pytest
+
+from lbprox.simulator import server
+
+
+@pytest.fixture
+def cluster():
+    return server.FakeCluster(3, delays=server.SimulatorDelays(api=0, agent=0, boot=0, scale=0.01))
+
+
+@pytest.fixture
+def fake_server(cluster):
+    fake_server = server.FakeProxmoxServer(cluster).start()
+    yield fake_server
+    fake_server.stop()
+
+
+@pytest.fixture
+def pve(fake_server):
+    """an api client of the simulated cluster"""
+    return server.connect(*fake_server.address)
@@ -0,0 +1,64 @@
+from lbprox.common import vm_templates
+from lbprox.placement import capacity
+from lbprox.placement.capacity import MachineDemand
+
+GB = 1024**3
+STORAGE_ID = "lb-local-storage"
+
+
+def _demand(name, os_image="rocky-9-target", cores=8, memory=16, ssd=0, vfs=0, ssds=0):
+    return MachineDemand(name, "target", cores, memory * GB, 10 * GB, ssd_bytes=ssd * GB, vfs=vfs,
+                         passthrough_ssds=ssds, os_image=os_image)
+
+
+def _template(cluster, node, vmid, os_image="rocky-9-target"):
+    volume = cluster.volumes[node][f"{STORAGE_ID}:iso/{os_image}.img"]
+    tags = f"node.{node};{vm_templates.STORAGE_TAG}.{STORAGE_ID};{vm_templates.TEMPLATE_TAG}.{os_image};" \
+           f"{vm_templates.IMAGE_SIGNATURE_TAG}.{vm_templates.volume_signature(volume)}"
+    cluster.add_vm(node, vmid, {"name": f"template-{os_image}", "tags": tags}, template=1)
+
+
+def test_node_capacities(cluster, pve):
+    cluster.add_vm("pve01", 100, {"name": "s00", "cores": 8, "memory": 16384})
+    capacities = capacity.node_capacities(pve, STORAGE_ID, cpu_overcommit=2.0, count_ssds=True)
+    assert sorted(capacities) == ["pve01", "pve02", "pve03"]
+    assert capacities["pve01"].free_cores == 128 * 2 - 8
+    assert capacities["pve02"].free_cores == 128 * 2
+    assert capacities["pve01"].free_passthrough_ssds == 8
+    assert capacities["pve01"].free_vfs == 0
+    assert list(capacity.node_capacities(pve, STORAGE_ID, nodes=["pve02"])) == ["pve02"]
+
+
+def test_preflight_fits(cluster, pve):
+    _template(cluster, "pve01", 9000)
+    capacities = capacity.node_capacities(pve, STORAGE_ID)
+    demands = [_demand("s00", ssd=20), _demand("s01")]
+    report = capacity.preflight(pve, STORAGE_ID, demands, {"s00": "pve01", "s01": "pve02"}, capacities)
+    assert report.ok(), report.problems()
+    usage = {node_usage.node: node_usage for node_usage in report.nodes}
+    # pve01 has a template of the image already, pve02 needs one built
+    assert usage["pve01"].needed["storage"] == 10 * GB + 20 * GB
+    assert usage["pve02"].needed["storage"] == 2 * 10 * GB
+    assert usage["pve01"].needed["cores"] == 8
+
+
+def test_preflight_reports_every_shortage(cluster, pve):
+    capacities = capacity.node_capacities(pve, STORAGE_ID, count_vfs=True)
+    capacities["pve02"].free_memory_bytes = 8 * GB
+    demands = [_demand("s00", vfs=20), _demand("s01", memory=6), _demand("s02", memory=6),
+               _demand("c00", os_image="no-such-image", cores=1, memory=1)]
+    placement = {"s00": "pve01", "s01": "pve02", "s02": "pve02", "c00": "pve03"}
+    report = capacity.preflight(pve, STORAGE_ID, demands, placement, capacities)
+    assert not report.ok()
+    problems = report.problems()
+    assert any(problem.startswith("pve01: vfs: need 20, free 16") for problem in problems)
+    assert any(problem.startswith("pve02: memory: need 12.0G, free 8.0G") for problem in problems)
+    assert "pve03: os image no-such-image not found on the storage" in problems
+    assert len(problems) == 3
+    assert "pve02" in str(capacity.CapacityError(report))
+
+
+def test_preflight_offline_node(cluster, pve):
+    capacities = capacity.node_capacities(pve, STORAGE_ID, nodes=["pve01"])
+    report = capacity.preflight(pve, STORAGE_ID, [_demand("s00")], {"s00": "pve09"}, capacities)
+    assert report.problems() == ["pve09: not an online cluster node"]
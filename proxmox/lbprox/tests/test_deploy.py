@@ -0,0 +1,85 @@
+import os
+
+import pytest
+import yaml
+
+from lbprox.common.vm_tags import VMTags
+from lbprox.deployment import deploy
+
+
+def _compose_environment(ansible_profile, server_count=1):
+    cluster_info = {
+        'clusterId': "c0",
+        'servers': {f"server{i:02}": {'name': f"server{i:02}", 'access_ip': f"10.0.0.{i}",
+                                      'data_ip': f"10.1.0.{i}", 'tags': VMTags()}
+                    for i in range(server_count)},
+    }
+    files = deploy.render_inventory(cluster_info, {}, "https://repo", light_app_path="/light-app",
+                                    ansible_profile=ansible_profile)
+    assert "ansible.cfg" not in files
+    compose = yaml.safe_load(files['docker-compose.yml'])
+    return compose['services']['lb-ansible']['environment']
+
+
+def test_baseline_keeps_the_repo_ansible_cfg():
+    env = _compose_environment("baseline")
+    assert not any(variable.startswith("ANSIBLE_CONFIG=") for variable in env)
+    assert [variable for variable in env if variable.startswith("ANSIBLE_")] == [
+        "ANSIBLE_LOG_PATH=/inventory/logs/ansible.log", "ANSIBLE_FORCE_COLOR=True", "ANSIBLE_VERBOSITY=3"]
+
+
+@pytest.mark.parametrize("server_count, forks", [(1, deploy.MIN_FORKS), (12, 12), (80, deploy.MAX_FORKS)])
+def test_tuned_forks_per_host(server_count, forks):
+    env = _compose_environment("tuned", server_count)
+    assert f"ANSIBLE_FORKS={forks}" in env
+    assert "ANSIBLE_PIPELINING=True" in env
+    assert "ANSIBLE_CACHE_PLUGIN=jsonfile" in env
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        deploy.ansible_environment("fast", 3)
+
+
+def _read(directory, relpath):
+    with open(os.path.join(directory, relpath)) as f:
+        return f.read()
+
+
+def test_sync_inventory(tmp_path):
+    directory = str(tmp_path)
+    files = {"hosts": "server00\n", os.path.join("host_vars", "server00.yml"): "name: server00\n"}
+    diff = deploy.sync_inventory(directory, files)
+    assert sorted(diff.added) == sorted(files) and not diff.changed and not diff.removed
+
+    mtime = os.stat(os.path.join(directory, "hosts")).st_mtime_ns
+    diff = deploy.sync_inventory(directory, dict(files))
+    assert not diff.modified() and sorted(diff.unchanged) == sorted(files)
+    assert os.stat(os.path.join(directory, "hosts")).st_mtime_ns == mtime
+
+    files = {"hosts": "server00\nserver01\n", os.path.join("host_vars", "server01.yml"): "name: server01\n"}
+    diff = deploy.sync_inventory(directory, files)
+    assert diff.changed == ["hosts"]
+    assert diff.added == [os.path.join("host_vars", "server01.yml")]
+    assert diff.removed == [os.path.join("host_vars", "server00.yml")]
+    assert _read(directory, "hosts") == "server00\nserver01\n"
+    assert not os.path.exists(os.path.join(directory, "host_vars", "server00.yml"))
+
+
+def test_sync_inventory_rewrites_deleted_files(tmp_path):
+    directory = str(tmp_path)
+    deploy.sync_inventory(directory, {"hosts": "server00\n"})
+    os.unlink(os.path.join(directory, "hosts"))
+    assert deploy.sync_inventory(directory, {"hosts": "server00\n"}).added == ["hosts"]
+    assert _read(directory, "hosts") == "server00\n"
+
+
+def test_sync_inventory_corrupted_manifest(tmp_path):
+    directory = str(tmp_path)
+    deploy.sync_inventory(directory, {"hosts": "server00\n"})
+    with open(os.path.join(directory, deploy.MANIFEST_FILE), "w") as f:
+        f.write("{not json")
+    # without a manifest every existing file is rewritten, and files it can't know of are kept
+    diff = deploy.sync_inventory(directory, {"hosts": "server00\n"})
+    assert diff.changed == ["hosts"] and not diff.removed
+    assert not deploy.sync_inventory(directory, {"hosts": "server00\n"}).modified()
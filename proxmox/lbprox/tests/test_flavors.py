@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from lbprox.cli.allocations import cli
+from lbprox.flavors import flavors
+
+
+@pytest.fixture(autouse=True)
+def config_directory(monkeypatch):
+    monkeypatch.setattr(flavors, "CONFIG_DIRECTORY",
+                        os.path.join(os.path.dirname(__file__), "..", "lbprox", "config"))
+
+
+@pytest.mark.parametrize("profile", [
+    {"aio": "native", "cache": "writeback"},
+    {"detect_zeroes": "unmap"},
+    {"detect_zeroes": "unmap", "discard": "ignore"},
+    {"num_queues": True},
+    {"ioeventfd": "on"},
+    {"cache": "fast"},
+    {"queues": 4},
+])
+def test_invalid_profiles(profile):
+    with pytest.raises(ValueError):
+        flavors.validate_ssd_profile(profile)
+
+
+def test_yaml_booleans_are_switch_values():
+    assert flavors.validate_ssd_profile({"detect_zeroes": False}) == {"detect_zeroes": "off"}
+
+
+def test_flavor_profiles_are_valid():
+    for name, machine_type in flavors.list_machine_types()["machine_types"].items():
+        ssds = machine_type["properties"].get("ssds")
+        flavors.get_ssd_profile(ssds)
+    for name in flavors.list_ssd_profiles():
+        flavors.get_ssd_profile({"profile": name})
+
+
+def test_existing_flavors_keep_qemu_defaults():
+    machine_types = flavors.list_machine_types()["machine_types"]
+    ssds = machine_types["target-small-1numa-large-emulated-ssd"]["properties"]["ssds"]
+    assert flavors.get_ssd_profile(ssds) == {}
+    args = cli.create_args_string(101, 1, "lb-local-storage", "b178", "s00", {})
+    assert "aio=" not in args and "ioeventfd" not in args
+
+
+def test_performance_profile_args():
+    args = cli.create_args_string(101, 2, "lb-local-storage", "b178", "s00",
+                                  flavors.get_ssd_profile({"profile": "performance"}))
+    assert args.count(",aio=io_uring,cache=none,discard=unmap,detect-zeroes=unmap") == 2
+    assert args.count(",ioeventfd=on,max_ioqpairs=8") == 2
@@ -0,0 +1,53 @@
+import pytest
+
+from lbprox.cli.image_store import cli
+
+
+class _Storage(object):
+    def __init__(self, storages, storage_id=None):
+        self.storages = storages
+        self.storage_id = storage_id
+
+    def __call__(self, storage_id):
+        return _Storage(self.storages, storage_id)
+
+    def get(self):
+        return list(self.storages.values())
+
+    def create(self, storage, **options):
+        self.storages[storage] = dict(options, storage=storage)
+
+    def put(self, **options):
+        if options.pop("delete", None) == "nodes":
+            self.storages[self.storage_id].pop("nodes")
+        self.storages[self.storage_id].update(options)
+
+
+class _Nodes(object):
+    def get(self):
+        return [{'node': node} for node in ("pve01", "pve02", "pve03")]
+
+
+class _Api(object):
+    def __init__(self, storages):
+        self.storage = _Storage(storages)
+        self.nodes = _Nodes()
+
+
+@pytest.mark.parametrize("existing, node_names, nodes", [
+    (None, ["pve01", "pve02", "pve03"], None),
+    (None, ["pve02", "pve01"], "pve02,pve01"),
+    ("pve01", ["pve02"], "pve01,pve02"),
+    ("pve01,pve02", ["pve02"], "pve01,pve02"),
+    ("pve01,pve02", ["pve03"], None),
+    ("", ["pve03"], None),
+])
+def test_register_storage(existing, node_names, nodes):
+    storages = {}
+    if existing is not None:
+        storages["lb-local-storage"] = {"storage": "lb-local-storage", "type": "dir"}
+        if existing:
+            storages["lb-local-storage"]["nodes"] = existing
+    pve = _Api(storages)
+    cli._register_storage(pve, "lb-local-storage", node_names)
+    assert storages["lb-local-storage"].get("nodes") == nodes
@@ -0,0 +1,27 @@
+import pytest
+
+from lbprox.common import metrics
+
+
+@pytest.mark.parametrize("url, template", [
+    ("https://pve:8006/api2/json/nodes/pve01/qemu/101/config", "nodes/{node}/qemu/{vmid}/config"),
+    ("https://pve:8006/api2/json/nodes/pve01/hardware/pci/0000:81:00.1", "nodes/{node}/hardware/pci/{pci_id}"),
+    ("https://pve:8006/api2/json/nodes/pve01/hardware/pci", "nodes/{node}/hardware/pci"),
+    ("https://pve:8006/api2/json/nodes/pve01/storage/local/content/local:iso%2Fa.iso",
+     "nodes/{node}/storage/{storage}/content/{volume}"),
+    ("https://pve:8006/api2/json/cluster/resources?type=vm", "cluster/resources"),
+])
+def test_endpoint_template(url, template):
+    assert metrics.endpoint_template(url) == template
+
+
+def test_snapshot_is_a_copy():
+    registry = metrics.Metrics()
+    url = "https://pve:8006/api2/json/nodes/pve01/qemu"
+    registry.observe("get", url, 200, 0.02)
+    snapshot = registry.snapshot()
+    registry.observe("get", url, 500, 0.3)
+    stats = snapshot[("GET", "nodes/{node}/qemu")]
+    assert (stats.count, stats.errors, sum(stats.buckets)) == (1, 0, 1)
+    stats = registry.snapshot()[("GET", "nodes/{node}/qemu")]
+    assert (stats.count, stats.errors, sum(stats.buckets), stats.max) == (2, 1, 2, 0.3)
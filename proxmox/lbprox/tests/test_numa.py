@@ -0,0 +1,86 @@
+import pytest
+
+from lbprox.placement import numa
+
+TOPOLOGY = numa.HostTopology.parse("""node 0 0-7 65536000 0 0
+node 1 8-15 1024000 0 0
+pci 0000:81:00.0 1
+pci 0000:01:00.0 0
+""")
+
+
+class _Qemu(object):
+    def __init__(self, vms, vmid=None):
+        self.vms = vms
+        self.vmid = vmid
+
+    def __call__(self, vmid):
+        return _Qemu(self.vms, int(vmid))
+
+    @property
+    def config(self):
+        return self
+
+    def get(self):
+        if self.vmid is None:
+            return [{'vmid': vmid} for vmid in self.vms]
+        return self.vms[self.vmid]
+
+
+class _Api(object):
+    def __init__(self, vms):
+        self.qemu = _Qemu(vms)
+
+    def nodes(self, hostname):
+        return self
+
+
+@pytest.fixture(autouse=True)
+def reservations():
+    numa._reserved_cpus.clear()
+    yield
+    numa._reserved_cpus.clear()
+
+
+def test_placement_prefers_device_nodes():
+    placement = numa.plan_numa_placement(TOPOLOGY, 4, 4096, 1, pci_ids=["01:00.0"])
+    assert placement.host_nodes() == [0]
+    assert placement.vm_config()["numa0"] == "cpus=0-3,memory=4096,hostnodes=0,policy=bind"
+    assert placement.vm_config()["affinity"] == "0-3"
+
+
+def test_memory_is_not_bound_to_a_node_without_it():
+    placement = numa.plan_numa_placement(TOPOLOGY, 4, 4096, 1, pci_ids=["81:00.0"])
+    assert placement.host_nodes() == [1]
+    assert not placement.bind_memory
+    config = placement.vm_config()
+    assert config["numa0"] == "cpus=0-3,memory=4096"
+    assert config["affinity"] == "8-11"
+
+
+def test_used_cpus_are_skipped():
+    placement = numa.plan_numa_placement(TOPOLOGY, 4, 4096, 1, used_cpus=range(0, 6))
+    assert placement.cpus() == [8, 9, 10, 11]
+    with pytest.raises(numa.PlacementError):
+        numa.plan_numa_placement(TOPOLOGY, 9, 4096, 1)
+
+
+def test_reservations_follow_the_vm_configs():
+    vms = {100: {'affinity': "0-1"}, 101: {}}
+    pve = _Api(vms)
+
+    def plan(used_cpus):
+        return numa.plan_numa_placement(TOPOLOGY, 2, 1024, 1, pci_ids=["01:00.0"], used_cpus=used_cpus)
+    assert numa.reserve_numa_placement(pve, "pve01", 101, plan).cpus() == [2, 3]
+    # 101's config is not written yet, its cpus stay reserved
+    vms[102] = {}
+    assert numa.reserve_numa_placement(pve, "pve01", 102, plan).cpus() == [4, 5]
+    # 100 was deleted and 102's placement failed, their cpus are free again
+    del vms[100]
+    numa.release_numa_placement("pve01", 102)
+    vms[103] = {}
+    assert numa.reserve_numa_placement(pve, "pve01", 103, plan).cpus() == [0, 1]
+    # a reused vmid pins what its config says, not the stale reservation
+    vms[101] = {'affinity': "6-7"}
+    vms[104] = {}
+    assert numa.reserve_numa_placement(pve, "pve01", 104, plan).cpus() == [2, 3]
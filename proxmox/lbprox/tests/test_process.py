@@ -0,0 +1,43 @@
+import subprocess
+import time
+
+import pytest
+
+from lbprox.common import process
+
+
+def test_output_and_exit_code(tmp_path):
+    log_path = str(tmp_path / "run.log")
+    result = process.run("echo out; echo err >&2; exit 3", log_path=log_path)
+    assert (result.returncode, result.stdout, result.stderr) == (3, "out\n", "err\n")
+    assert not result.ok() and result.describe() == "exit code 3"
+    with pytest.raises(subprocess.CalledProcessError):
+        result.check()
+    with open(log_path) as f:
+        assert sorted(f.read().splitlines()) == ["err", "out"]
+
+
+def test_input_and_tail():
+    result = process.run("cat; seq 1 10 >&2", input="a\nb\nc\n", tail_lines=2)
+    assert result.ok()
+    assert result.stdout == "b\nc\n" and result.stdout_truncated
+    assert result.stderr == "9\n10\n"
+    assert process.run("seq 1 5", keep_stdout=True, tail_lines=2).stdout == "1\n2\n3\n4\n5\n"
+
+
+def test_wall_timeout_kills_the_pipeline():
+    start = time.time()
+    result = process.run("sleep 30 | cat", timeout=1)
+    assert time.time() - start < 10
+    assert result.timed_out == process.WALL_TIMEOUT and result.describe() == "timed out after 1s"
+    with pytest.raises(subprocess.TimeoutExpired):
+        result.check()
+
+
+def test_idle_timeout():
+    result = process.run("echo started; sleep 30", idle_timeout=1)
+    assert result.timed_out == process.IDLE_TIMEOUT
+    assert result.stdout == "started\n"
+    # output keeps a slow command alive
+    result = process.run("for i in 1 2 3; do echo $i; sleep 0.6; done", idle_timeout=1)
+    assert result.ok(), result.describe()
@@ -0,0 +1,43 @@
+from lbprox.allocations import retag
+from lbprox.common import utils
+from lbprox.common.tag_index import Selector
+from lbprox.common.vm_tags import VMTags
+
+
+def test_diff_tags():
+    current = VMTags.parse_tags("vm.s00;cname.c01;ver.1")
+    new = VMTags.parse_tags("vm.s00;cname.c02;role.target")
+    assert retag.diff_tags(current, new) == {"cname": ("c01", "c02"), "role": (None, "target"),
+                                             "ver": ("1", None)}
+    assert retag.diff_tags(current, VMTags.parse_tags("ver.1;cname.c01;vm.s00")) == {}
+
+
+def test_plan_retag_keeps_the_parsed_tags_intact():
+    raw = "vm.s00;cname.c01;ver.1"
+    vms = [{'vmid': 100, 'node': "pve01", 'tags': raw}, {'vmid': 101, 'node': "pve01"}]
+    plan = retag.plan_retag(vms, {"cname": "c02"}, remove_keys=["ver"])
+    assert [tags.get_tags() for _, tags in plan] == [{"vm": "s00", "cname": "c02"}, {"cname": "c02"}]
+    # the parse cache is shared by every listing, the plan must not modify it
+    assert VMTags.parse_tags(raw).get_tags() == {"vm": "s00", "cname": "c01", "ver": "1"}
+
+
+def test_apply_retag(cluster, pve):
+    cluster.add_vm("pve01", 100, {"name": "s00", "tags": "vm.s00;cname.c01;allocation.b178"})
+    cluster.add_vm("pve02", 101, {"name": "s01", "tags": "vm.s01;cname.c02;allocation.b178"})
+    cluster.add_vm("pve03", 102, {"name": "s02", "tags": "vm.s02;cname.c01;allocation.b179"})
+    vms = utils.select_cluster_vms(pve, Selector.parse("allocation=b178"))
+    results = {result.vmid: result for result in retag.retag_vms(pve, vms, {"cname": "c02"})}
+    assert results[100].status == retag.CHANGED
+    assert results[100].changes == {"cname": ("c01", "c02")}
+    assert results[101].status == retag.UNCHANGED
+    assert 102 not in results
+    assert cluster.vms[100]["config"]["tags"] == "vm.s00;cname.c02;allocation.b178"
+    assert cluster.vms[102]["config"]["tags"] == "vm.s02;cname.c01;allocation.b179"
+
+
+def test_apply_retag_reports_failures(cluster, pve):
+    cluster.add_vm("pve01", 100, {"name": "s00", "tags": "vm.s00"})
+    vms = [{'vmid': 100, 'node': "pve01", 'tags': "vm.s00"}, {'vmid': 999, 'node': "pve01", 'tags': "vm.gone"}]
+    results = {result.vmid: result for result in retag.retag_vms(pve, vms, {"cname": "c01"})}
+    assert results[100].status == retag.CHANGED
+    assert results[999].status == retag.FAILED and results[999].failed()
@@ -0,0 +1,65 @@
+import pytest
+
+from lbprox.placement import scheduler
+from lbprox.placement.capacity import MachineDemand, NodeCapacity
+
+GB = 1024**3
+
+
+def _target(name, cores=8, memory=16, ssds=0, failure_domain="targets"):
+    return MachineDemand(name, "target", cores, memory * GB, 10 * GB, passthrough_ssds=ssds,
+                         failure_domain=failure_domain)
+
+
+def _client(name):
+    return MachineDemand(name, "initiator", 2, 2 * GB, 10 * GB, failure_domain="initiators")
+
+
+def _capacities(*nodes):
+    return {node: NodeCapacity(node, cores, memory * GB, 1024 * GB, free_passthrough_ssds=ssds)
+            for node, cores, memory, ssds in nodes}
+
+
+def test_spread_keeps_targets_apart():
+    capacities = _capacities(("pve01", 64, 256, 0), ("pve02", 64, 128, 0), ("pve03", 64, 128, 0))
+    demands = [_target(f"s0{i}") for i in range(3)] + [_client("c00")]
+    assignment = scheduler.schedule(demands, capacities)
+    assert sorted(assignment[f"s0{i}"] for i in range(3)) == ["pve01", "pve02", "pve03"]
+    # the client goes to the node with the most free memory left
+    assert assignment["c00"] == "pve01"
+
+
+def test_pack_fills_one_node():
+    capacities = _capacities(("pve01", 64, 256, 0), ("pve02", 64, 128, 0))
+    demands = [_target(f"s0{i}") for i in range(3)]
+    assignment = scheduler.schedule(demands, capacities, policy="pack", anti_affinity=False)
+    assert set(assignment.values()) == {"pve02"}
+
+
+def test_anti_affinity_yields_to_capacity():
+    # only two nodes for three targets, the third shares a node
+    capacities = _capacities(("pve01", 64, 256, 0), ("pve02", 64, 256, 0))
+    assignment = scheduler.schedule([_target(f"s0{i}") for i in range(3)], capacities)
+    assert len(assignment) == 3
+    assert set(assignment.values()) == {"pve01", "pve02"}
+
+
+def test_passthrough_devices_are_placed_first():
+    capacities = _capacities(("pve01", 16, 256, 4), ("pve02", 16, 256, 0))
+    demands = [_target("s00", cores=8), _target("s01", cores=8, ssds=4, failure_domain="other")]
+    assignment = scheduler.schedule(demands, capacities)
+    assert assignment == {"s01": "pve01", "s00": "pve02"}
+    assert capacities["pve01"].free_passthrough_ssds == 0
+
+
+def test_unschedulable():
+    capacities = _capacities(("pve01", 4, 256, 0), ("pve02", 64, 8, 0))
+    with pytest.raises(scheduler.SchedulingError) as raised:
+        scheduler.schedule([_target("s00"), _client("c00")], capacities)
+    message = str(raised.value)
+    assert "s00" in message and "pve01: cores" in message and "pve02: memory" in message
+    assert "c00" not in message
+    with pytest.raises(scheduler.SchedulingError):
+        scheduler.schedule([_client("c00")], {})
+    with pytest.raises(ValueError):
+        scheduler.schedule([_client("c00")], capacities, policy="random")
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from lbprox.simulator import server
+from lbprox.state import store
+
+
+@pytest.fixture
+def cluster():
+    # the guest agent of a started VM answers after boot * scale = 1s
+    return server.FakeCluster(2, delays=server.SimulatorDelays(api=0, agent=0, boot=100, scale=0.01))
+
+
+@pytest.fixture
+def state(tmp_path):
+    return store.StateStore(str(tmp_path / "state.db"))
+
+
+def _seed(cluster):
+    cluster.add_vm("pve01", 100, {"name": "b178-s00", "tags": "vm.s00;role.target;allocation.b178",
+                                  "hostpci1": "0000:81:00.0,pcie=0"}, status="running")
+    cluster.add_vm("pve02", 101, {"name": "b178-c00", "tags": "vm.c00;role.initiator;allocation.b178"})
+    cluster.add_vm("pve02", 9000, {"name": "template", "tags": "template.rocky-9-target;storage.lb-local-storage;"
+                                                               "imgsig.1-2"}, template=1)
+
+
+def test_reconcile(cluster, pve, state):
+    _seed(cluster)
+    result = state.reconcile(pve)
+    assert sorted(result.added) == [100, 101, 9000]
+    assert (result.config_refreshes, result.ip_refreshes) == (2, 1)
+    vms = {vm['vmid']: vm for vm in state.vms()}
+    assert sorted(vms) == [100, 101]
+    assert vms[100]['devices'] == {"hostpci1": "0000:81:00.0,pcie=0"}
+    assert len(vms[100]['ip_addresses']) == 2 and vms[101]['ip_addresses'] == []
+    assert [vm['vmid'] for vm in state.vms(role="initiator")] == [101]
+    assert [image['template_vmid'] for image in state.images()] == [9000]
+    assert sorted(vm['vmid'] for vm in state.allocations()["b178"]) == [100, 101]
+
+    # nothing changed, nothing is fetched again
+    result = state.reconcile(pve)
+    assert (result.unchanged, result.config_refreshes, result.ip_refreshes) == (3, 0, 0)
+
+    cluster.vms[101]["config"]["tags"] = "vm.c00;role.initiator;allocation.b179"
+    with cluster.lock:
+        del cluster.vms[100]
+    result = state.reconcile(pve)
+    assert (result.changed, result.removed, result.config_refreshes) == ([101], [100], 1)
+    assert list(state.allocations()) == ["b179"]
+    history = {allocation['allocation_id']: allocation for allocation in state.allocation_history()}
+    assert history["b178"]['deleted'] and not history["b179"]['deleted']
+
+
+def test_addresses_are_retried_with_backoff(cluster, pve, state, monkeypatch):
+    _seed(cluster)
+    cluster.vms[100]["started_at"] = time.time()
+    assert state.reconcile(pve).ip_refreshes == 1
+    assert state.vms()[0]['ip_addresses'] == []
+    # the first retry waits ADDRESS_RETRY_BASE seconds
+    assert state.reconcile(pve).ip_refreshes == 0
+    monkeypatch.setattr(store, "ADDRESS_RETRY_BASE", 0)
+    time.sleep(1.1)
+    assert state.reconcile(pve).ip_refreshes == 1
+    assert len(state.vms()[0]['ip_addresses']) == 2
+    # addressed VMs are not asked again
+    assert state.reconcile(pve).ip_refreshes == 0
+
+
+def test_ensure_fresh(cluster, pve, state):
+    _seed(cluster)
+    assert state.last_reconcile() == 0
+    assert state.ensure_fresh(pve, max_age=60) is not None
+    assert state.ensure_fresh(pve, max_age=60) is None
+    state.invalidate()
+    assert state.ensure_fresh(pve, max_age=60) is not None
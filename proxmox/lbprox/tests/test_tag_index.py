@@ -0,0 +1,70 @@
+import click
+import pytest
+
+from lbprox.cli.allocations import cli
+from lbprox.common import tag_index
+from lbprox.common.tag_index import Selector, TagIndex
+
+
+def _vm(vmid, tags):
+    return {'id': f"qemu/{vmid}", 'vmid': vmid, 'node': "pve01", 'tags': tags}
+
+
+@pytest.fixture
+def index():
+    return TagIndex([
+        _vm(100, "vm.b178-s00;role.target;allocation.b178"),
+        _vm(101, "vm.b178-c00;role.initiator;allocation.b178"),
+        _vm(102, "vm.b179-s00;role.target;allocation.b179;cid.7"),
+        # VMs lbprox did not create
+        _vm(200, "role.target"),
+        _vm(201, ""),
+    ])
+
+
+def _vmids(index, selector):
+    return [vm['vmid'] for vm in index.select(selector)]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("allocation=b178", "allocation=b178"),
+    ("allocation.b178", "allocation=b178"),
+    ("allocation==b178; role!=target", "allocation=b178,role!=target"),
+    ("role in (target, initiator),!cid", "role in (initiator,target),!cid"),
+    ("allocation notin (b178|b179),vm", "allocation notin (b178,b179),vm"),
+])
+def test_parse(text, expected):
+    assert repr(Selector.parse(text)) == expected
+
+
+@pytest.mark.parametrize("text", ["", " , ;", "role in (target", "role in ()", "=b178"])
+def test_parse_invalid(text):
+    with pytest.raises(ValueError):
+        Selector.parse(text)
+
+
+def test_select(index):
+    assert _vmids(index, Selector.parse("allocation=b178")) == [100, 101]
+    assert _vmids(index, Selector.parse("role=target,allocation!=b178")) == [102, 200]
+    assert _vmids(index, Selector.parse("role in (target,initiator),!cid")) == [100, 101, 200]
+    for selector in ("allocation=b178,role!=initiator", "role=target,cid notin (7)", "vm,!cid,role.target"):
+        ids = index.ids(Selector.parse(selector))
+        assert ids == {rid for rid, vm in index.resources.items()
+                       if Selector.parse(selector).matches(tag_index._parse(vm['tags']))}
+
+
+def test_negative_only_selector_does_not_reach_foreign_vms(index):
+    selector = Selector.parse("allocation!=b178")
+    assert not selector.positive()
+    assert _vmids(index, selector) == [102, 200, 201]
+    assert _vmids(index, selector.owned()) == [102]
+    assert repr(selector.owned().owned()) == repr(selector.owned())
+
+
+def test_target_selector(index):
+    with pytest.raises(click.BadParameter):
+        cli._target_selector(tags="allocation!=b178,!cid")
+    with pytest.raises(click.BadParameter):
+        cli._target_selector(tags=" ; ")
+    assert _vmids(index, cli._target_selector(tags="role=target")) == [100, 102]
+    assert _vmids(index, cli._target_selector(allocation_id="b179")) == [102]
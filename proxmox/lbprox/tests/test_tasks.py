@@ -0,0 +1,37 @@
+import gc
+import weakref
+
+import pytest
+
+from lbprox.common import tasks
+from lbprox.simulator import server
+
+
+def test_wait_for_task(cluster, pve):
+    upid = cluster._start_task("pve01", "qmstart", "100")
+    assert tasks.wait_for_task(pve, upid, tmo=5) == "OK"
+
+
+def test_failed_task(cluster, pve):
+    upid = cluster._start_task("pve01", "qmstart", "100", exit_status="start failed: no such vm")
+    with pytest.raises(tasks.TaskError) as raised:
+        tasks.wait_for_task(pve, upid, tmo=5)
+    assert raised.value.exit_status == "start failed: no such vm"
+
+
+def test_task_missing_from_the_task_list(cluster, pve):
+    upid = cluster._start_task("pve01", "qmstart", "100")
+    # pushed out of the task list window by newer tasks
+    cluster.tasks[upid]["starttime"] = 0
+    futures = tasks.wait_for_tasks(pve, [upid, cluster._start_task("pve01", "qmstop", "101")], tmo=5)
+    assert all(future.result() == "OK" for future in futures.values())
+
+
+def test_tracker_lives_with_its_client(fake_server):
+    pve = server.connect(*fake_server.address)
+    tracker = tasks.get_tracker(pve)
+    assert tasks.get_tracker(pve) is tracker
+    tracker = weakref.ref(tracker)
+    del pve
+    gc.collect()
+    assert tracker() is None
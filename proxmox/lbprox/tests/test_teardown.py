@@ -0,0 +1,57 @@
+import pytest
+
+from lbprox.allocations import teardown
+from lbprox.cli.allocations import cli as allocations_cli
+from lbprox.common import utils
+from lbprox.simulator.ssh import FakeSSHClient
+from lbprox.ssh import ssh
+
+
+@pytest.fixture(autouse=True)
+def fake_ssh(monkeypatch):
+    monkeypatch.setattr(ssh, "SSHClient", FakeSSHClient)
+    monkeypatch.setattr(FakeSSHClient, "latency", 0)
+    monkeypatch.setattr(FakeSSHClient, "commands", [])
+
+
+def _seed(cluster):
+    cluster.add_vm("pve01", 100, {"name": "b178-s00", "tags": "vm.s00;role.target;allocation.b178"},
+                   status="running")
+    cluster.add_vm("pve02", 101, {"name": "b178-c00", "tags": "vm.c00;role.initiator;allocation.b178"})
+    cluster.add_vm("pve02", 102, {"name": "c200-s00", "tags": "vm.s00;role.target;allocation.c200"},
+                   status="running")
+    # not created by lbprox, it carries an allocation tag but no vm tag
+    cluster.add_vm("pve01", 103, {"name": "foreign", "tags": "allocation.b178"}, status="running")
+
+
+def test_teardown_allocation(cluster, pve):
+    _seed(cluster)
+    vms = utils.select_cluster_vms(pve, allocations_cli._target_selector(allocation_id="b178"))
+    assert sorted(vm['vmid'] for vm in vms) == [100, 101]
+
+    results = teardown.teardown_vms(pve, vms, "lb-local-storage", "root", "secret", task_timeout=10)
+    assert sorted(result.vmid for result in results) == [100, 101]
+    assert all(not result.failed() and result.stage == "snippets" for result in results)
+    with cluster.lock:
+        assert sorted(cluster.vms) == [102, 103]
+    # one ssh session per node removes the snippets of all its VMs
+    assert sorted(hostname for hostname, _ in FakeSSHClient.commands) == ["pve01", "pve02"]
+    assert all("lb-local-storage/snippets" in command for _, command in FakeSSHClient.commands)
+
+
+def test_teardown_reports_failures(cluster, pve):
+    _seed(cluster)
+    vms = utils.select_cluster_vms(pve, allocations_cli._target_selector(allocation_id="b178"))
+    vms.append({"vmid": 999, "node": "pve02", "name": "gone", "status": "stopped"})
+
+    results = {result.vmid: result for result in teardown.teardown_vms(pve, vms, "lb-local-storage",
+                                                                        "root", "secret", task_timeout=10)}
+    assert results[999].failed() and results[999].stage == "destroy"
+    assert not results[100].failed() and not results[101].failed()
+    with cluster.lock:
+        assert sorted(cluster.vms) == [102, 103]
+    assert not any("999" in command for _, command in FakeSSHClient.commands)
+
+
+def test_teardown_nothing(pve):
+    assert teardown.teardown_vms(pve, [], "lb-local-storage", "root", "secret") == []
@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+from lbprox.common import threadpool
+
+
+class NodeSlotTest(unittest.TestCase):
+    def setUp(self):
+        threadpool.set_node_concurrency(1)
+
+    def tearDown(self):
+        threadpool.set_node_concurrency(threadpool.DEFAULT_NODE_CONCURRENCY)
+
+    def _run_nested(self, outer_jobs, inner_jobs):
+        def inner(node, idx):
+            return (node, idx)
+
+        def outer(node, idx):
+            executor = threadpool.JobExecutor("inner", max_workers=inner_jobs, node_of=lambda args: args[0])
+            return [job_result.result for job_result in executor.run(inner, [(node, i) for i in range(inner_jobs)])]
+
+        executor = threadpool.JobExecutor("outer", max_workers=outer_jobs, node_of=lambda args: args[0])
+        return executor.run_all(outer, [("pve01", i) for i in range(outer_jobs)])
+
+    def test_nested_executors_on_one_node(self):
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(self._run_nested(2, 3)), daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive(), "nested node-bound executors deadlocked")
+        self.assertEqual(2, len(results))
+        self.assertTrue(all(result.ok() and len(result.result) == 3 for result in results))
+
+    def test_slot_is_released(self):
+        with threadpool.node_slot("pve01"):
+            self.assertIn("pve01", threadpool.held_nodes())
+            with threadpool.node_slot("pve01"):
+                pass
+            self.assertIn("pve01", threadpool.held_nodes())
+        self.assertNotIn("pve01", threadpool.held_nodes())
+        # the single slot is free again for another thread
+        acquired = threading.Event()
+
+        def take():
+            with threadpool.node_slot("pve01"):
+                acquired.set()
+        thread = threading.Thread(target=take, daemon=True)
+        thread.start()
+        self.assertTrue(acquired.wait(timeout=5))
+
+    def test_nested_jobs_are_capped(self):
+        threadpool.set_node_concurrency(2)
+        lock = threading.Lock()
+        state = {"in_flight": 0, "peak": 0}
+
+        def inner(node, idx):
+            with lock:
+                state["in_flight"] += 1
+                state["peak"] = max(state["peak"], state["in_flight"])
+            time.sleep(0.02)
+            with lock:
+                state["in_flight"] -= 1
+
+        with threadpool.node_slot("pve01"):
+            executor = threadpool.JobExecutor("inner", max_workers=8, node_of=lambda args: args[0])
+            results = executor.run_all(inner, [("pve01", i) for i in range(8)])
+        self.assertTrue(all(result.ok() for result in results))
+        self.assertEqual(2, state["peak"])
+
+
+class RunWithThreadpoolTest(unittest.TestCase):
+    def test_none_args_do_not_end_the_jobs(self):
+        executor = threadpool.JobExecutor("none args", max_workers=1)
+        results = executor.run_all(lambda idx: idx, [(1,), None, (2,)])
+        self.assertEqual(3, len(results))
+        self.assertEqual([1, 2], sorted(result.result for result in results if result.ok()))
+
+    def test_all_failures_are_reported(self):
+        def job(idx):
+            if idx % 2:
+                raise ValueError(f"job {idx} failed")
+            return idx
+
+        with self.assertRaises(threadpool.JobsFailed) as raised:
+            threadpool.run_with_threadpool(job, [(i,) for i in range(6)], "odd jobs fail", max_workers=2)
+        failed = raised.exception.failed
+        self.assertEqual(6, len(raised.exception.results))
+        self.assertEqual([1, 3, 5], sorted(result.args[0] for result in failed))
+        for idx in (1, 3, 5):
+            self.assertIn(f"job {idx} failed", str(raised.exception))
+
+    def test_results(self):
+        self.assertEqual([0, 1, 4], sorted(threadpool.run_with_threadpool(lambda i: i * i, [(i,) for i in range(3)],
+                                                                         "squares")))
+
+
+if __name__ == '__main__':
+    unittest.main()
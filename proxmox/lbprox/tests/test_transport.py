@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from lbprox.common import threadpool
+from lbprox.common import transport
+
+
+class _Response(object):
+    status_code = 200
+
+
+@pytest.fixture
+def node_limit():
+    threadpool.set_node_concurrency(2)
+    yield 2
+    threadpool.set_node_concurrency(threadpool.DEFAULT_NODE_CONCURRENCY)
+
+
+def _concurrent_requests(url, count, held_node=None):
+    """the most requests in flight at once out of count parallel ones"""
+    lock = threading.Lock()
+    state = {"in_flight": 0, "peak": 0}
+
+    def send(method, url, *args, **kwargs):
+        with lock:
+            state["in_flight"] += 1
+            state["peak"] = max(state["peak"], state["in_flight"])
+        time.sleep(0.05)
+        with lock:
+            state["in_flight"] -= 1
+        return _Response()
+
+    session = requests.Session()
+    session.request = send
+    api = transport.Transport(session, transport.TransportPolicy())
+
+    def request():
+        if held_node:
+            with threadpool.node_slot(held_node):
+                api.request("GET", url)
+        else:
+            api.request("GET", url)
+    threads = [threading.Thread(target=request, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return state["peak"]
+
+
+def test_requests_share_the_node_slots(node_limit):
+    assert _concurrent_requests("https://pve:8006/api2/json/nodes/pve01/qemu", 6) == node_limit
+
+
+def test_requests_without_node_are_not_limited(node_limit):
+    assert _concurrent_requests("https://pve:8006/api2/json/cluster/resources", 6) == 6
+
+
+def test_job_slot_is_reentered(node_limit):
+    # jobs of pve01 already hold its slots, their requests do not wait for more
+    assert _concurrent_requests("https://pve:8006/api2/json/nodes/pve01/qemu", 6,
+                                held_node="pve01") == node_limit
+
+
+@pytest.mark.parametrize("config", [{"pool_size": 8, "node_concurency": 2},
+                                    {"node_concurrency": 4},
+                                    ["pool_size"]])
+def test_policy_rejects_unknown_settings(config):
+    with pytest.raises(ValueError):
+        transport.TransportPolicy.from_config(config)
+
+
+def test_policy_from_config():
+    policy = transport.TransportPolicy.from_config({"pool_size": 8, "retries": 1})
+    assert (policy.pool_size, policy.retries, policy.breaker_threshold) == (8, 1, 5)
+    assert transport.TransportPolicy.from_config(None).pool_size == 32
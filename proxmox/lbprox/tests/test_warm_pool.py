@@ -0,0 +1,51 @@
+from lbprox.allocations import warm_pool
+from lbprox.common.vm_tags import VMTags
+
+FLAVOR = "target-tiny-1numa-emulated-ssd"
+
+
+def _pool_vm(vmid, node, flavor=FLAVOR, building=False):
+    tags = f"vm.pool-{vmid};pool.{flavor}" + (f";{warm_pool.BUILDING_TAG}.1" if building else "")
+    return warm_pool.PoolVM({'vmid': vmid, 'node': node, 'name': f"pool-{vmid}", 'status': "stopped",
+                             'tags': tags})
+
+
+def _machine(name, role="target", machine_type=FLAVOR):
+    return {"name": name, "role": role, "machine_type": machine_type}
+
+
+def test_deficits():
+    pool_vms = [_pool_vm(100, "pve01"), _pool_vm(101, "pve02", building=True),
+                _pool_vm(102, "pve01", flavor="initiator-small")]
+    assert warm_pool.deficits(pool_vms, {FLAVOR: 3, "initiator-small": 1, "dms": 2}) == {FLAVOR: 1, "dms": 2}
+    assert warm_pool.deficits(pool_vms, {FLAVOR: 1}) == {}
+
+
+def test_match_machines_spreads_targets():
+    pool_vms = [_pool_vm(100, "pve01"), _pool_vm(101, "pve01"), _pool_vm(102, "pve02"),
+                _pool_vm(103, "pve03", building=True), _pool_vm(104, "pve03", flavor="initiator-small")]
+    machines = [_machine("s00"), _machine("s01"), _machine("s02"),
+                _machine("c00", role="initiator", machine_type="initiator-small")]
+    matches = warm_pool.match_machines(machines, pool_vms)
+    assert {name: pool_vm.vmid for name, pool_vm in matches.items()} == {"s00": 100, "s01": 102, "c00": 104}
+    # without anti affinity both pve01 VMs are used
+    matches = warm_pool.match_machines(machines, pool_vms, anti_affinity=False)
+    assert {name: pool_vm.vmid for name, pool_vm in matches.items()} == {"s00": 100, "s01": 101, "s02": 102,
+                                                                          "c00": 104}
+
+
+def test_a_pool_vm_is_claimed_once(cluster, pve):
+    cluster.add_vm("pve01", 100, {"name": "pool-100", "tags": f"vm.pool-100;pool.{FLAVOR}"})
+    pool_vm, = warm_pool.list_pool_vms(pve, FLAVOR)
+    claims = {name: (pool_vm, VMTags().set_vm_name(name).set_allocation(allocation), name)
+              for name, allocation in (("b178-s00", "b178"), ("b179-s00", "b179"))}
+    claimed = {}
+    for name, claim in claims.items():
+        claimed.update(warm_pool.claim_pool_vms(pve, {name: claim}))
+    assert list(claimed) == ["b178-s00"]
+    assert cluster.vms[100]["config"]["name"] == "b178-s00"
+    assert warm_pool.list_pool_vms(pve) == []
+
+    warm_pool.release_pool_vms(pve, claimed)
+    assert [pool_vm.vmid for pool_vm in warm_pool.list_pool_vms(pve, FLAVOR)] == [100]
+    assert cluster.vms[100]["config"]["name"] == "pool-100"